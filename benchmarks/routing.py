@@ -0,0 +1,277 @@
+"""
+Micro-benchmarks for Klein's request dispatch.
+
+Klein apps with 10, 100, 1,000 and 10,000 routes of several shapes are built,
+and requests spread over their routing tables are rendered through
+L{klein.KleinResource} with the request helpers of L{klein.test}.  For every
+combination, the per-request latency and the throughput are measured.
+
+Results are written as JSON, and can be compared against the results of a
+previous run::
+
+    python benchmarks/routing.py --output baseline.json
+    # ... upgrade werkzeug, change Klein ...
+    python benchmarks/routing.py --baseline baseline.json
+
+Comparing exits with a non-zero status if any benchmark got slower by more
+than the given tolerance.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import platform
+import sys
+
+from timeit import default_timer
+
+import twisted
+import werkzeug
+
+import klein
+from klein import Klein
+from klein.test.test_resource import requestMock, _render
+
+
+
+def static(app, count):
+    """
+    Add C{count} routes without converters, like C{/static3/page}.
+
+    @return: A L{list} of paths matching the routes.
+    """
+    paths = []
+    for i in range(count):
+        url = "/static{0}/page".format(i)
+        app.route(url, endpoint="static{0}".format(i))(_handler)
+        paths.append(url)
+    return paths
+
+
+
+def converters(app, count):
+    """
+    Add C{count} routes with several converters each, like
+    C{/users3/<int:uid>/posts/<slug>/<path:rest>}.
+
+    @return: A L{list} of paths matching the routes.
+    """
+    paths = []
+    for i in range(count):
+        url = "/users{0}/<int:uid>/posts/<slug>/<path:rest>".format(i)
+        app.route(url, endpoint="converters{0}".format(i))(_handler)
+        paths.append("/users{0}/42/posts/hello/a/b".format(i))
+    return paths
+
+
+
+def subroutes(app, count):
+    """
+    Add C{count} routes, in groups of ten nested two L{Klein.subroute}s
+    deep, like C{/tenant3/api/item7/<int:id>}.
+
+    @return: A L{list} of paths matching the routes.
+    """
+    paths = []
+    for group in range(max(count // 10, 1)):
+        with app.subroute("/tenant{0}".format(group)) as tenant:
+            with tenant.subroute("/api") as api:
+                for i in range(min(count, 10)):
+                    url = "/item{0}/<int:id>".format(i)
+                    api.route(url, endpoint="sub{0}_{1}".format(group, i))(
+                        _handler)
+                    paths.append(
+                        "/tenant{0}/api/item{1}/7".format(group, i))
+    return paths
+
+
+
+def branches(app, count):
+    """
+    Add C{count} C{branch=True} routes, like C{/files3/}.
+
+    @return: A L{list} of paths matching the routes.
+    """
+    paths = []
+    for i in range(count):
+        url = "/files{0}/".format(i)
+        app.route(url, branch=True, endpoint="branch{0}".format(i))(_handler)
+        paths.append("/files{0}/some/deep/file.txt".format(i))
+    return paths
+
+
+
+def _handler(request, **kwargs):
+    return b"ok"
+
+
+
+SHAPES = {
+    "static": static,
+    "converters": converters,
+    "subroutes": subroutes,
+    "branches": branches,
+}
+
+CONFIGURATIONS = {
+    "default": {},
+    "indexed": {"indexed_routing": True},
+    "cached": {"route_cache_size": 1024},
+}
+
+SIZES = [10, 100, 1000, 10000]
+
+
+
+def _sample(paths, count=20):
+    """
+    Pick up to C{count} paths spread evenly over C{paths}, always including
+    the last one, which is the most expensive to match for werkzeug.
+    """
+    step = max(len(paths) // count, 1)
+    sample = paths[::step][:count - 1]
+    sample.append(paths[-1])
+    return [path.encode("ascii") for path in sample]
+
+
+
+def measure(shape, size, configuration, duration):
+    """
+    Benchmark one combination.
+
+    @param shape: The name of the shape of the routes, a key of L{SHAPES}.
+    @param size: The number of routes.
+    @param configuration: The name of the L{Klein} configuration, a key of
+        L{CONFIGURATIONS}.
+    @param duration: Roughly how many seconds to spend rendering requests.
+
+    @return: A L{dict} of results.
+    """
+    app = Klein(**CONFIGURATIONS[configuration])
+    paths = _sample(SHAPES[shape](app, size))
+    resource = app.resource(freeze=True)
+
+    # Warm up, and make sure every request is actually routed.
+    for path in paths:
+        request = requestMock(path)
+        _render(resource, request)
+        if request.getWrittenData() != b"ok":
+            raise RuntimeError("{0} was not routed: {1!r}".format(
+                path, request.getWrittenData()))
+
+    timings = []
+    deadline = default_timer() + duration
+    while default_timer() < deadline:
+        for path in paths:
+            request = requestMock(path)
+            start = default_timer()
+            _render(resource, request)
+            timings.append(default_timer() - start)
+
+    timings.sort()
+    total = sum(timings)
+    return {
+        "shape": shape,
+        "size": size,
+        "configuration": configuration,
+        "requests": len(timings),
+        "throughput": len(timings) / total,
+        "mean": total / len(timings),
+        "p50": timings[len(timings) // 2],
+        "p90": timings[int(len(timings) * 0.9)],
+        "p99": timings[int(len(timings) * 0.99)],
+    }
+
+
+
+def _key(result):
+    return "{shape}/{size}/{configuration}".format(**result)
+
+
+
+def compare(results, baseline, tolerance):
+    """
+    Report how much C{results} deviate from C{baseline}.
+
+    @return: The keys of the results whose median latency regressed by more
+        than C{tolerance}, a fraction.
+    """
+    previous = dict((_key(result), result) for result in baseline["results"])
+    regressions = []
+    for result in results:
+        key = _key(result)
+        if key not in previous:
+            continue
+        change = result["p50"] / previous[key]["p50"] - 1
+        marker = ""
+        if change > tolerance:
+            regressions.append(key)
+            marker = "  REGRESSION"
+        print("{0:<32} {1:+7.1%}{2}".format(key, change, marker),
+              file=sys.stderr)
+    return regressions
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--shape", action="append", choices=sorted(SHAPES),
+                        help="Only benchmark these shapes of routes.")
+    parser.add_argument("--size", action="append", type=int,
+                        help="Only benchmark these numbers of routes.")
+    parser.add_argument("--configuration", action="append",
+                        choices=sorted(CONFIGURATIONS),
+                        help="Only benchmark these configurations of Klein.")
+    parser.add_argument("--duration", type=float, default=1.0,
+                        help="Seconds to spend on each benchmark.")
+    parser.add_argument("--output", help="Write the results to this file.")
+    parser.add_argument("--baseline",
+                        help="Compare the results to those in this file.")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="The fraction by which the median latency may "
+                        "regress before the comparison fails.")
+    options = parser.parse_args(argv)
+
+    results = []
+    for shape in options.shape or sorted(SHAPES):
+        for size in options.size or SIZES:
+            for configuration in (options.configuration or
+                                  sorted(CONFIGURATIONS)):
+                result = measure(shape, size, configuration, options.duration)
+                results.append(result)
+                print("{0:<32} {1:>10.0f} req/s  p50 {2:8.1f}us  "
+                      "p99 {3:8.1f}us".format(
+                          _key(result), result["throughput"],
+                          result["p50"] * 1e6, result["p99"] * 1e6),
+                      file=sys.stderr)
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "klein": klein.__version__,
+            "twisted": twisted.__version__,
+            "werkzeug": werkzeug.__version__,
+        },
+        "results": results,
+    }
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, options.tolerance):
+            return 1
+    return 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
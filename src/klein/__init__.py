@@ -1,7 +1,18 @@
 from __future__ import absolute_import, division
 
 from klein.app import Klein, run, route, resource
+from klein._body import RequestBody, RequestBodyTooLarge, StreamingRequest
+from klein._cache import CachePolicy
+from klein._compression import Compression
+from klein._deadlines import DeadlineExceeded
+from klein._fileresponse import FileResponse
+from klein._limits import ConcurrencyLimitExceeded
+from klein._metrics import Metrics
+from klein._multipart import Form, FormPart, MultipartParser
 from klein._plating import Plating
+from klein._processes import ProcessPoolFull, ProcessTimeout
+from klein._threads import ThreadPoolFull
+from klein._timing import HistogramTimingSink, LogTimingSink
 
 from ._version import __version__ as _incremental_version
 
@@ -13,8 +24,25 @@ __license__ = "MIT"
 __copyright__ = "Copyright 2016 {0}".format(__author__)
 
 __all__ = [
+    'CachePolicy',
+    'Compression',
+    'ConcurrencyLimitExceeded',
+    'DeadlineExceeded',
+    'FileResponse',
+    'Form',
+    'FormPart',
+    'HistogramTimingSink',
     'Klein',
+    'LogTimingSink',
+    'Metrics',
+    'MultipartParser',
     'Plating',
+    'ProcessPoolFull',
+    'ProcessTimeout',
+    'RequestBody',
+    'RequestBodyTooLarge',
+    'StreamingRequest',
+    'ThreadPoolFull',
     '__author__',
     '__copyright__',
     '__license__',
@@ -0,0 +1,585 @@
+# -*- test-case-name: klein.test.test_body -*-
+
+"""
+Streaming the bodies of requests to handlers as they are received.
+"""
+
+from __future__ import absolute_import, division
+
+import json
+
+from collections import deque
+from io import BytesIO
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.python.failure import Failure
+from twisted.web.server import Request
+
+from werkzeug.exceptions import (
+    BadRequest, RequestEntityTooLarge, UnsupportedMediaType)
+from werkzeug.http import parse_options_header
+
+from klein._stream import _StopAsyncIteration
+from klein.interfaces import IKleinRequest
+
+
+__all__ = ["RequestBody", "RequestBodyTooLarge", "StreamingRequest"]
+
+
+
+class RequestBodyTooLarge(RequestEntityTooLarge):
+    """
+    The body of a request is larger than its route accepts.  Unless an error
+    handler deals with it, the request is answered with 413.
+
+    @ivar max_size: The largest body accepted, in bytes.
+    @type max_size: L{int}
+    """
+
+    def __init__(self, max_size):
+        RequestEntityTooLarge.__init__(self)
+        self.max_size = max_size
+
+
+    def __repr__(self):
+        return "<RequestBodyTooLarge(max_size={0!r})>".format(self.max_size)
+
+
+
+class RequestBody(object):
+    """
+    The body of a request, which handlers get as the C{body} of the
+    L{IKleinRequest} of the request, and can read as it is received.
+
+    Its chunks can be read one at a time with L{next_chunk}, or with
+    C{async for} on Python 3.5 or later; given to a function as they are
+    received with L{consume}, to parse or hash the body without keeping it;
+    or read whole with L{read}.  Only one of them may be reading the body at
+    a time.
+
+    Requests made by L{StreamingRequest} are routed as soon as their headers
+    are received, so the chunks of their body are read as the client sends
+    them, and the client is paused while more than C{buffer_size} bytes of
+    them haven't been read.  The bodies of other requests have been received
+    and buffered by C{twisted.web} already, and are read from their
+    C{content}.
+
+    @ivar length: The size of the body in bytes, as its C{Content-Length}
+        says, or C{None} if it doesn't say.
+    @type length: L{int}
+
+    @ivar received: How many bytes of the body have been received so far.
+    @type received: L{int}
+
+    @ivar max_size: The largest body accepted, in bytes, or C{None}.
+    @type max_size: L{int}
+
+    @ivar complete: Whether the whole body has been received.
+    @type complete: L{bool}
+
+    @ivar chunk_size: How many bytes are read at a time from a buffered body.
+    @type chunk_size: L{int}
+
+    @ivar buffer_size: How many bytes of a streamed body are kept before the
+        client is paused.
+    @type buffer_size: L{int}
+    """
+
+    chunk_size = 2 ** 16
+    buffer_size = 2 ** 16
+
+    def __init__(self, length=None, producer=None, content=None):
+        """
+        @param length: The size of the body given by its C{Content-Length}.
+        @type length: L{int}
+
+        @param producer: The L{twisted.internet.interfaces.IPushProducer}
+            of the chunks of a streamed body, paused when too many are kept.
+
+        @param content: The file the whole body has been buffered in, to read
+            it from instead.
+        """
+        self.length = length
+        self.received = 0
+        self.max_size = None
+        self.complete = False
+        self._producer = producer
+        self._paused = False
+        self._content = content
+        self._chunks = deque()
+        self._buffered = 0
+        self._waiting = None
+        self._consumer = None
+        self._failure = None
+        self._discarding = False
+        self._stopped = []
+        if content is not None:
+            self.complete = True
+            self.received = length
+
+
+    @classmethod
+    def _fromContent(cls, content):
+        """
+        Make the body of a request buffered in C{content}, a file positioned
+        at its start.
+        """
+        if content is None:
+            return cls(0, content=BytesIO())
+        start = content.tell()
+        content.seek(0, 2)
+        length = content.tell() - start
+        content.seek(start)
+        return cls(length, content=content)
+
+
+    def limit(self, max_size):
+        """
+        Accept no body larger than C{max_size} bytes, or than the limit set
+        before if it is smaller.
+
+        @raise RequestBodyTooLarge: If the body is known to be larger
+            already, from its C{Content-Length} or what has been received.
+        """
+        if self.max_size is not None:
+            max_size = min(self.max_size, max_size)
+        self.max_size = max_size
+        size = self.received
+        if self.length is not None:
+            size = max(size, self.length)
+        if size > max_size:
+            self._fail(Failure(RequestBodyTooLarge(max_size)))
+            raise RequestBodyTooLarge(max_size)
+
+
+    def next_chunk(self):
+        """
+        Read the next chunk of the body.
+
+        @return: A L{Deferred} firing with the chunk, as L{bytes}, or with
+            C{b""} once the whole body has been read.  It fails with
+            L{RequestBodyTooLarge} if the body is larger than C{max_size},
+            and with the reason the connection was lost if it was lost
+            before the body was received.
+        """
+        self._checkNotReading()
+        chunk = self._take()
+        if chunk is not None:
+            return succeed(chunk)
+        if self._failure is not None:
+            return fail(self._failure)
+        if self.complete:
+            return succeed(b"")
+        self._waiting = Deferred()
+        return self._waiting
+
+
+    if _StopAsyncIteration is not None:
+        def __aiter__(self):
+            return self
+
+
+        def __anext__(self):
+            def stopAtEnd(chunk):
+                if not chunk:
+                    raise _StopAsyncIteration()
+                return chunk
+            return self.next_chunk().addCallback(stopAtEnd)
+
+
+    def consume(self, callback):
+        """
+        Call C{callback} with each chunk of the body, as it is received::
+
+            digest = hashlib.sha256()
+            yield IKleinRequest(request).body.consume(digest.update)
+
+        @return: A L{Deferred} firing with C{None} once the whole body has
+            been given to C{callback}, or failing like L{next_chunk}, or with
+            the exception C{callback} raised.
+        """
+        self._checkNotReading()
+        done = Deferred()
+        self._consumer = (callback, done)
+        self._resume()
+        self._deliver()
+        return done
+
+
+    def read(self):
+        """
+        Read the whole body.
+
+        @return: A L{Deferred} firing with the body, as L{bytes}, or failing
+            like L{next_chunk}.
+        """
+        chunks = []
+        return self.consume(chunks.append).addCallback(
+            lambda _: b"".join(chunks))
+
+
+    def _checkNotReading(self):
+        if self._waiting is not None or self._consumer is not None:
+            raise RuntimeError("The body of the request is being read.")
+
+
+    def _take(self):
+        """
+        Take the next chunk kept or buffered, if there is one.
+
+        @return: The chunk, or C{None}.
+        """
+        if self._chunks:
+            chunk = self._chunks.popleft()
+            self._buffered -= len(chunk)
+            if self._buffered <= self.buffer_size:
+                self._resume()
+            return chunk
+        if self._content is not None and self._failure is None:
+            chunk = self._content.read(self.chunk_size)
+            if chunk:
+                return chunk
+            self._content = None
+        return None
+
+
+    def _deliver(self):
+        """
+        Give the consumer every chunk available, and tell it when the body
+        has been consumed or failed.
+        """
+        while self._consumer is not None:
+            callback, done = self._consumer
+            chunk = self._take()
+            if chunk is None:
+                if self._failure is not None:
+                    self._consumer = None
+                    done.errback(self._failure)
+                elif self.complete:
+                    self._consumer = None
+                    done.callback(None)
+                return
+            try:
+                callback(chunk)
+            except BaseException:
+                self._consumer = None
+                self._discard()
+                done.errback(Failure())
+
+
+    def _received(self, data):
+        """
+        A chunk of a streamed body was received.
+        """
+        if self._failure is not None or not data:
+            return
+        self.received += len(data)
+        if self.max_size is not None and self.received > self.max_size:
+            self._fail(Failure(RequestBodyTooLarge(self.max_size)))
+            return
+        if self._discarding:
+            return
+        if self._waiting is not None:
+            waiting, self._waiting = self._waiting, None
+            waiting.callback(data)
+            return
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._consumer is not None:
+            self._deliver()
+        elif self._buffered > self.buffer_size:
+            self._pause()
+
+
+    def _finished(self):
+        """
+        The whole of a streamed body was received.
+        """
+        if self.complete or self._failure is not None:
+            return
+        self.complete = True
+        if self._waiting is not None:
+            waiting, self._waiting = self._waiting, None
+            waiting.callback(b"")
+        self._deliver()
+        self._notifyStopped()
+
+
+    def _fail(self, reason):
+        """
+        Stop receiving the body, for C{reason}, which reading it fails with.
+        """
+        if self._failure is not None or self.complete:
+            return
+        self._failure = reason
+        self._chunks.clear()
+        self._buffered = 0
+        self._resume()
+        if self._waiting is not None:
+            waiting, self._waiting = self._waiting, None
+            waiting.errback(reason)
+        self._deliver()
+        self._notifyStopped()
+
+
+    def _discard(self):
+        """
+        Throw away the rest of the body, which won't be read.
+        """
+        self._discarding = True
+        self._chunks.clear()
+        self._buffered = 0
+        self._content = None
+        self._resume()
+
+
+    def _whenStopped(self):
+        """
+        @return: A L{Deferred} firing with whether the whole body was
+            received, once it was or receiving it failed.
+        """
+        if self.complete or self._failure is not None:
+            return succeed(self.complete)
+        stopped = Deferred()
+        self._stopped.append(stopped)
+        return stopped
+
+
+    def _notifyStopped(self):
+        stopped, self._stopped = self._stopped, []
+        for d in stopped:
+            d.callback(self.complete)
+
+
+    def _pause(self):
+        if self._producer is not None and not self._paused:
+            self._paused = True
+            self._producer.pauseProducing()
+
+
+    def _resume(self):
+        if self._paused:
+            self._paused = False
+            self._producer.resumeProducing()
+
+
+
+class _SharedResult(object):
+    """
+    The result of a L{Deferred}, such as the parsed body of a request, given
+    to everyone asking for it rather than computed again.
+    """
+
+    def __init__(self, deferred):
+        self._done = False
+        self._result = None
+        self._waiting = []
+        deferred.addBoth(self._fire)
+
+
+    def _fire(self, result):
+        self._done = True
+        self._result = result
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            self._give(d)
+
+
+    def _give(self, d):
+        if isinstance(self._result, Failure):
+            d.errback(self._result)
+        else:
+            d.callback(self._result)
+
+
+    def result(self):
+        """
+        @return: A L{Deferred} firing with the result.
+        """
+        d = Deferred()
+        if self._done:
+            self._give(d)
+        else:
+            self._waiting.append(d)
+        return d
+
+
+
+def _isJSON(contentType):
+    """
+    Is C{contentType}, the C{Content-Type} of a request, JSON?
+    """
+    if contentType is None:
+        return False
+    mimetype, _ = parse_options_header(contentType.decode("latin-1"))
+    return mimetype == "application/json" or (
+        mimetype.startswith("application/") and mimetype.endswith("+json"))
+
+
+
+def _loadJSON(data):
+    """
+    Decode the JSON text C{data}, which RFC 7159 says is UTF-8, since
+    L{json.loads} only takes L{bytes} on Python 2 and 3.6 or later.
+
+    @raise ValueError: If C{data} isn't JSON.
+    """
+    return json.loads(data.decode("utf-8"))
+
+
+
+def _decodeJSON(request, body, max_size, decoder):
+    """
+    Decode the JSON sent as C{body}, the L{RequestBody} of C{request}, with
+    C{decoder}, or L{_loadJSON} if it is C{None}.
+
+    @return: A L{Deferred} firing with the decoded value, or failing with
+        L{UnsupportedMediaType} if the body isn't JSON, L{RequestBodyTooLarge}
+        if it is larger than C{max_size}, or L{BadRequest} if C{decoder}
+        fails to decode it.
+    """
+    if not _isJSON(request.getHeader(b"content-type")):
+        return fail(UnsupportedMediaType("The body of the request isn't "
+                                         "JSON."))
+    if max_size is not None:
+        try:
+            body.limit(max_size)
+        except RequestBodyTooLarge:
+            return fail()
+
+    if decoder is None:
+        decoder = _loadJSON
+
+    def decode(data):
+        try:
+            return decoder(data)
+        except ValueError as e:
+            raise BadRequest("The body of the request is malformed JSON: "
+                             "{0}".format(e))
+    return body.read().addCallback(decode)
+
+
+
+def _limitBody(max_size, call, instance, f, request, *args, **kwargs):
+    """
+    Call the handler C{f} with C{call}, unless the body of C{request} is
+    known to be larger than C{max_size} bytes, and fail reading it once it
+    turns out to be.
+    """
+    IKleinRequest(request).body.limit(max_size)
+    return call(instance, f, request, *args, **kwargs)
+
+
+
+# The state of twisted.web's HTTP/1.x channel and request which routing a
+# request before its body has been received relies on.  It has been there
+# since at least Twisted 13.2, but it is private, so requests are buffered
+# as usual wherever it is missing.
+_channelAttributes = ["_command", "_path", "_version"]
+_streamable = hasattr(Request, "_cleanup")
+
+
+
+def _canStream(channel):
+    """
+    Can requests be routed as soon as C{channel} has received their headers?
+    """
+    return _streamable and all(hasattr(channel, name)
+                               for name in _channelAttributes)
+
+
+
+class StreamingRequest(Request):
+    """
+    A request routed as soon as its headers are received, whose body is
+    streamed to its handler through the C{body} of its L{IKleinRequest}
+    rather than buffered first.  Make a site of it with::
+
+        Site(app.resource(), requestFactory=StreamingRequest)
+
+    Since the body isn't buffered, C{content} is empty, and C{args} only has
+    the arguments of the query string.  Handlers answering before the whole
+    body has been received have the rest of it thrown away, unless it is
+    larger than the route accepts, in which case the connection is closed.
+
+    Requests made over other channels than HTTP/1.x, or with versions of
+    Twisted lacking what streaming relies on, are buffered as usual.
+    """
+
+    _requestBody = None
+    _cleanupPending = False
+
+    def gotLength(self, length):
+        channel = self.channel
+        if not _canStream(channel):
+            Request.gotLength(self, length)
+            return
+
+        self.content = BytesIO()
+        # Only Twisted 17.1 and later pause the channel rather than its
+        # transport.
+        self._requestBody = RequestBody(
+            length, getattr(channel, "_networkProducer", self.transport))
+        if length == 0:
+            self._requestBody._finished()
+        Request.requestReceived(self, channel._command, channel._path,
+                                channel._version)
+        if self.startedWriting:
+            # The client needn't be told to send a body which won't be read.
+            self.requestHeaders.removeHeader(b"expect")
+
+
+    def handleContentChunk(self, data):
+        if self._requestBody is None:
+            Request.handleContentChunk(self, data)
+        else:
+            self._requestBody._received(data)
+
+
+    def requestReceived(self, command, path, version):
+        if self._requestBody is None:
+            Request.requestReceived(self, command, path, version)
+            return
+        self._requestBody._finished()
+        if self._cleanupPending:
+            self._cleanupPending = False
+            Request._cleanup(self)
+
+
+    def _cleanup(self):
+        body = self._requestBody
+        if body is None or body.complete:
+            Request._cleanup(self)
+            return
+        # The channel can't take the next request before the body of this
+        # one has been received.
+        self._cleanupPending = True
+        body._discard()
+        body._whenStopped().addCallback(self._bodyStopped)
+
+
+    def _bodyStopped(self, complete):
+        """
+        Receiving the body of the request, which was answered already,
+        stopped.  Close the connection unless the whole body was received.
+        """
+        if not complete and self._cleanupPending and self.channel is not None:
+            self.channel.persistent = False
+            # HTTPChannel.loseConnection is new in Twisted 16.3.
+            if hasattr(self.channel, "loseConnection"):
+                self.channel.loseConnection()
+            else:
+                self.channel.transport.loseConnection()
+
+
+    def connectionLost(self, reason):
+        if self._cleanupPending:
+            # The request was answered, so whoever is waiting for it to
+            # finish is told it did.
+            self._cleanupPending = False
+            notifications, self.notifications = self.notifications, []
+            for d in notifications:
+                d.callback(None)
+        if self._requestBody is not None:
+            self._requestBody._fail(reason)
+        Request.connectionLost(self, reason)
@@ -0,0 +1,331 @@
+# -*- test-case-name: klein.test.test_cache -*-
+
+"""
+Caching the responses of routes in memory.
+"""
+
+from __future__ import absolute_import, division
+
+from collections import OrderedDict
+
+from twisted.internet.defer import Deferred
+
+from klein.interfaces import IKleinRequest
+
+
+__all__ = ["CachePolicy", "ResponseCache"]
+
+
+
+# What an entry is counted as taking, besides its body and headers.
+_ENTRY_OVERHEAD = 256
+
+# Headers which belong to the response they were sent with, or to its
+# connection, rather than to its content, and so aren't cached.
+_UNCACHED_HEADERS = frozenset([
+    b"connection", b"date", b"keep-alive", b"proxy-authenticate",
+    b"proxy-authorization", b"te", b"trailer", b"transfer-encoding",
+    b"upgrade"])
+
+
+
+class CachePolicy(object):
+    """
+    How the responses of a route are cached, given as the C{cache} of
+    L{klein.Klein.route}.
+
+    Only the successful responses to C{GET} requests are cached, unless they
+    set cookies.  Responses are told apart by method, path, the values of
+    C{query_args} and the values of the headers in C{vary}, and are served
+    from the cache for C{ttl} seconds.
+
+    @ivar ttl: How long responses are served from the cache, in seconds.
+    @type ttl: L{float}
+
+    @ivar query_args: The names of the query arguments responses depend on.
+    @type query_args: L{tuple} of L{bytes}
+
+    @ivar vary: The names of the request headers responses depend on.  They
+        are listed in the C{Vary} header of the responses.
+    @type vary: L{tuple} of L{bytes}
+    """
+
+    def __init__(self, ttl, query_args=(), vary=()):
+        self.ttl = ttl
+        self.query_args = tuple(_bytes(arg) for arg in query_args)
+        self.vary = tuple(_bytes(header).lower() for header in vary)
+
+
+    def __repr__(self):
+        return "<CachePolicy(ttl={0!r}, query_args={1!r}, vary={2!r})>" \
+            .format(self.ttl, self.query_args, self.vary)
+
+
+
+def _addVary(request, names):
+    """
+    Add C{names} to the C{Vary} header of the response to C{request}, unless
+    it lists them already.
+    """
+    headers = request.responseHeaders
+    present = set()
+    for value in headers.getRawHeaders(b"vary", ()):
+        present.update(name.strip().lower() for name in value.split(b","))
+    if b"*" in present:
+        return
+    missing = [name for name in names if name not in present]
+    if missing:
+        headers.addRawHeader(b"vary", b", ".join(missing))
+
+
+
+def _bytes(value):
+    if not isinstance(value, bytes):
+        value = value.encode("ascii")
+    return value
+
+
+
+class _Entry(object):
+    """
+    A cached response.
+    """
+
+    __slots__ = ["endpoint", "path", "code", "headers", "body", "expires",
+                 "size"]
+
+    def __init__(self, endpoint, path, code, headers, body, expires):
+        self.endpoint = endpoint
+        self.path = path
+        self.code = code
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+        self.size = _ENTRY_OVERHEAD + len(body) + sum(
+            len(name) + sum(len(value) for value in values)
+            for name, values in headers)
+
+
+
+class ResponseCache(object):
+    """
+    The responses of the routes of an app added with a C{cache}, evicting
+    the least recently used when they take more than C{max_bytes}.
+
+    Responses served from the cache are written without matching the URL of
+    the request, calling the handler or rendering its result.
+
+    @ivar max_bytes: The most memory the cached responses may take, in
+        bytes.
+    @type max_bytes: L{int}
+
+    @ivar size: How much memory the cached responses take, in bytes.
+    @type size: L{int}
+
+    @ivar active: Whether any route caches its responses.  Requests are only
+        looked up in the cache if so.
+    @type active: L{bool}
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, clock=None):
+        """
+        @param max_bytes: The most memory the cached responses may take, in
+            bytes.
+        @type max_bytes: L{int}
+
+        @param clock: The L{twisted.internet.interfaces.IReactorTime} telling
+            when responses expire.  Defaults to the global reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.active = False
+        self._clock = clock
+        self._entries = OrderedDict()
+        # The policy of every path with cached responses, and their keys.
+        self._paths = {}
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def _key(self, policy, path, request):
+        """
+        The key of the response to C{request} for C{path}.
+        """
+        args = request.args
+        getHeader = request.getHeader
+        return (path,
+                tuple(tuple(args.get(arg, ())) for arg in policy.query_args),
+                tuple(getHeader(header) for header in policy.vary))
+
+
+    def _lookup(self, request, path):
+        """
+        Get the cached response to C{request}.
+
+        @param path: The method, URL scheme, host, script name and path of
+            C{request}.
+        @type path: L{tuple}
+
+        @return: The cached response, or C{None}.
+        @rtype: L{_Entry}
+        """
+        cached = self._paths.get(path)
+        if cached is None:
+            return None
+        key = self._key(cached[0], path, request)
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry.expires <= self._clock.seconds():
+            self._forget(key, entry)
+            return None
+        # Make it the most recently used.
+        self._entries[key] = entry
+        return entry
+
+
+    def _store(self, endpoint, policy, key, code, headers, body):
+        """
+        Cache a response for C{policy.ttl} seconds, evicting the least
+        recently used responses to make room for it.
+
+        @return: Whether the response was cached: it isn't if it is larger
+            than C{max_bytes}.
+        @rtype: L{bool}
+        """
+        entry = _Entry(endpoint, key[0], code, headers, body,
+                       self._clock.seconds() + policy.ttl)
+        if entry.size > self.max_bytes:
+            return False
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._forget(key, old)
+        while self.size + entry.size > self.max_bytes:
+            self._forget(*self._entries.popitem(last=False))
+        self._entries[key] = entry
+        self.size += entry.size
+        cached = self._paths.get(entry.path)
+        if cached is None:
+            cached = self._paths[entry.path] = (policy, set())
+        cached[1].add(key)
+        return True
+
+
+    def _forget(self, key, entry):
+        """
+        Account for C{entry}, which has been removed from C{_entries}.
+        """
+        self.size -= entry.size
+        cached = self._paths.get(entry.path)
+        if cached is not None:
+            cached[1].discard(key)
+            if not cached[1]:
+                del self._paths[entry.path]
+
+
+    def invalidate(self, endpoint=None, path=None):
+        """
+        Remove the cached responses of C{endpoint}, for C{path}, or both.
+        Giving neither removes every cached response.
+
+        @param endpoint: The name of the endpoint whose responses to remove.
+        @type endpoint: L{unicode}
+
+        @param path: The path, without query, whose responses to remove.
+        @type path: L{unicode}
+
+        @return: How many responses were removed.
+        @rtype: L{int}
+        """
+        removed = [
+            (key, entry) for key, entry in self._entries.items()
+            if (endpoint is None or entry.endpoint == endpoint) and
+            (path is None or entry.path[4] == path)]
+        for key, entry in removed:
+            del self._entries[key]
+            self._forget(key, entry)
+        return len(removed)
+
+
+    def _restore(self, entry, request):
+        """
+        Give the response to C{request} the code and headers of C{entry}.
+
+        @return: The body of C{entry}.
+        @rtype: L{bytes}
+        """
+        request.setResponseCode(entry.code)
+        setRawHeaders = request.responseHeaders.setRawHeaders
+        for name, values in entry.headers:
+            setRawHeaders(name, list(values))
+        return entry.body
+
+
+    def _candidate(self, endpoint, policy, request):
+        """
+        Arrange for the response to C{request}, which is being routed to
+        C{endpoint}, to be cached by L{_written}.
+        """
+        if request.method != b"GET":
+            return
+        kleinRequest = IKleinRequest(request)
+        mapper = kleinRequest.mapper
+        path = (request.method, mapper.url_scheme, mapper.server_name,
+                mapper.script_name, mapper.path_info)
+        kleinRequest._cache = (endpoint, policy,
+                               self._key(policy, path, request))
+        if policy.vary:
+            _addVary(request, policy.vary)
+
+
+    def _written(self, request, body):
+        """
+        Cache C{body}, about to be written as the whole body of the response
+        to C{request}, if the response is cacheable.
+
+        @return: Whether the response was cached.
+        @rtype: L{bool}
+        """
+        kleinRequest = IKleinRequest(request)
+        pending = kleinRequest._cache
+        if pending is None:
+            return False
+        kleinRequest._cache = None
+        endpoint, policy, key = pending
+        if policy.vary:
+            # In case the handler set a Vary header of its own.
+            _addVary(request, policy.vary)
+        if (not 200 <= request.code < 300 or request.code == 206 or
+                request.startedWriting or request.cookies or
+                request.responseHeaders.hasHeader(b"set-cookie")):
+            return False
+        return self._store(endpoint, policy, key, request.code,
+                           [(name, list(values)) for name, values
+                            in request.responseHeaders.getAllRawHeaders()
+                            if name.lower() not in _UNCACHED_HEADERS],
+                           body)
+
+
+
+def _cachingCall(cache, endpoint, policy, call, instance, f, request, *args,
+                 **kwargs):
+    """
+    Call the handler C{f} with C{call}, arranging for its response to be
+    cached unless it fails.
+    """
+    cache._candidate(endpoint, policy, request)
+    try:
+        result = call(instance, f, request, *args, **kwargs)
+    except BaseException:
+        IKleinRequest(request)._cache = None
+        raise
+    if isinstance(result, Deferred):
+        def failed(failure):
+            IKleinRequest(request)._cache = None
+            return failure
+        result.addErrback(failed)
+    return result
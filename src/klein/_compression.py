@@ -0,0 +1,315 @@
+# -*- test-case-name: klein.test.test_compression -*-
+
+"""
+Compressing responses with the content codings clients accept.
+"""
+
+from __future__ import absolute_import, division
+
+import hashlib
+import zlib
+
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from twisted.python.compat import intToBytes
+from twisted.web import iweb
+
+
+__all__ = ["Compression"]
+
+
+
+# The content codings offered, in order of preference.
+_CODINGS = (b"gzip", b"deflate")
+
+_WBITS = {
+    b"gzip": 16 + zlib.MAX_WBITS,
+    b"deflate": zlib.MAX_WBITS,
+}
+
+# Codes of responses without a body, or with a part of one.
+_UNCOMPRESSED_CODES = frozenset([204, 206, 304])
+
+DEFAULT_SKIP_TYPES = (
+    b"image/", b"video/", b"audio/", b"font/woff",
+    b"application/zip", b"application/gzip", b"application/x-gzip",
+    b"application/x-bzip2", b"application/x-xz", b"application/zstd",
+    b"application/octet-stream", b"application/pdf",
+)
+
+# Types matching DEFAULT_SKIP_TYPES which compress well nonetheless.
+_COMPRESSIBLE_TYPES = (b"image/svg+xml",)
+
+
+
+def _negotiate(acceptEncoding):
+    """
+    Choose the content coding to compress with, given the
+    C{Accept-Encoding} header of a request.
+
+    @type acceptEncoding: L{bytes}
+
+    @return: One of L{_CODINGS}, or C{None} if the client accepts none.
+    """
+    qualities = {}
+    for item in acceptEncoding.split(b","):
+        parts = item.split(b";")
+        coding = parts[0].strip().lower()
+        quality = 1.0
+        for parameter in parts[1:]:
+            name, _, value = parameter.partition(b"=")
+            if name.strip().lower() == b"q":
+                try:
+                    quality = float(value.strip())
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+
+    best, bestQuality = None, 0.0
+    for coding in _CODINGS:
+        quality = qualities.get(coding, qualities.get(b"*", 0.0))
+        if quality > bestQuality:
+            best, bestQuality = coding, quality
+    return best
+
+
+
+class Compression(object):
+    """
+    How responses are compressed, given as the C{compression} of
+    L{klein.Klein}.
+
+    Responses are compressed with gzip or deflate, as negotiated with the
+    C{Accept-Encoding} of requests, whether they are written in one piece
+    or streamed in chunks.  The compressed bodies of responses written in
+    one piece which are likely to be written again, because they have an
+    C{ETag} or are cached by the app's L{klein.ResponseCache}, are cached,
+    so that the same bodies aren't compressed again.
+
+    @ivar level: The compression level, from 1, the fastest, to 9, the
+        smallest.
+    @type level: L{int}
+
+    @ivar min_size: The size in bytes of the smallest response bodies to
+        compress, when their size is known.
+    @type min_size: L{int}
+
+    @ivar skip_types: The prefixes of the content types of the responses
+        not to compress, because they are compressed already.
+    @type skip_types: L{tuple} of L{bytes}
+
+    @ivar cache_bytes: The most memory the cached compressed bodies may
+        take, in bytes.  They are looked up by the SHA-1 digests of the bodies
+        they are compressed from, which aren't kept.
+    @type cache_bytes: L{int}
+    """
+
+    def __init__(self, level=6, min_size=1024, skip_types=DEFAULT_SKIP_TYPES,
+                 cache_bytes=16 * 1024 * 1024):
+        self.level = level
+        self.min_size = min_size
+        self.skip_types = tuple(skip_types)
+        self.cache_bytes = cache_bytes
+        self._cached = OrderedDict()
+        self._cachedBytes = 0
+
+
+    def _compressor(self, coding):
+        return zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[coding])
+
+
+    def _compress(self, coding, body, cache=False):
+        """
+        Compress C{body} whole, with the cached result if there is one.
+
+        @param cache: Whether to cache the result.  Only the bodies likely
+            to be compressed again are, so that others don't push them out.
+        @type cache: L{bool}
+        """
+        if not cache:
+            compressor = self._compressor(coding)
+            return compressor.compress(body) + compressor.flush()
+
+        key = (coding, hashlib.sha1(body).digest())
+        compressed = self._cached.pop(key, None)
+        if compressed is None:
+            compressor = self._compressor(coding)
+            compressed = compressor.compress(body) + compressor.flush()
+            if len(compressed) > self.cache_bytes:
+                return compressed
+            while self._cachedBytes + len(compressed) > self.cache_bytes:
+                _, oldCompressed = self._cached.popitem(last=False)
+                self._cachedBytes -= len(oldCompressed)
+            self._cachedBytes += len(compressed)
+        # Make it the most recently used.
+        self._cached[key] = compressed
+        return compressed
+
+
+    def _compresses(self, contentType):
+        """
+        Should responses of C{contentType} be compressed?
+        """
+        if contentType is None:
+            return True
+        contentType = contentType.lower()
+        return (contentType.startswith(_COMPRESSIBLE_TYPES) or
+                not contentType.startswith(self.skip_types))
+
+
+    def _encoderFor(self, request):
+        """
+        Make an encoder for the response to C{request}, if the client accepts
+        a coding, and the response isn't encoded already.
+
+        @rtype: L{_Encoder} or C{None}
+        """
+        if getattr(request, "_encoder", None) is not None:
+            return None
+        acceptEncoding = request.requestHeaders.getRawHeaders(
+            b"accept-encoding")
+        if not acceptEncoding:
+            return None
+        coding = _negotiate(b",".join(acceptEncoding))
+        if coding is None:
+            return None
+        return _Encoder(self, coding, request)
+
+
+
+@implementer(iweb._IRequestEncoder)
+class _Encoder(object):
+    """
+    Compress the body of a response as it is written, if it is worth it.
+
+    Whether it is is decided when the response starts being written, by its
+    code, headers and the size of its body if it is known.
+
+    @ivar compressing: Whether the body is compressed.
+    @type compressing: L{bool}
+    """
+
+    def __init__(self, compression, coding, request):
+        self._compression = compression
+        self._coding = coding
+        self._request = request
+        self._decided = False
+        self._compressor = None
+        self._whole = False
+        self.compressing = False
+
+
+    def _start(self, size=None):
+        """
+        Decide whether to compress the body, whose size is C{size} if known,
+        and adjust the headers if so.
+
+        The C{Content-Length} is removed, since the size of the compressed
+        body isn't known until it has all been written; L{whole} sets it
+        again.
+        """
+        self._decided = True
+        request = self._request
+        headers = request.responseHeaders
+        if request.code in _UNCOMPRESSED_CODES or headers.hasHeader(
+                b"content-encoding"):
+            return
+        contentType = headers.getRawHeaders(b"content-type", [None])[0]
+        if contentType is None:
+            contentType = request.defaultContentType
+        if not self._compression._compresses(contentType):
+            return
+        headers.addRawHeader(b"vary", b"accept-encoding")
+        if size is None:
+            length = headers.getRawHeaders(b"content-length")
+            if length:
+                try:
+                    size = int(length[0])
+                except ValueError:
+                    pass
+        if size is not None and size < self._compression.min_size:
+            return
+
+        self.compressing = True
+        headers.setRawHeaders(b"content-encoding", [self._coding])
+        headers.removeHeader(b"content-length")
+        # The compressed body isn't identical to the uncompressed one.
+        etag = headers.getRawHeaders(b"etag")
+        if etag and not etag[0].startswith(b"W/"):
+            headers.setRawHeaders(b"etag", [b"W/" + etag[0]])
+        if request.etag is not None and not request.etag.startswith(b"W/"):
+            request.etag = b"W/" + request.etag
+
+
+    def whole(self, body, repeats=False):
+        """
+        Compress C{body}, the whole body of the response.
+
+        @param repeats: Whether the same body is likely to be written again,
+            so that its compressed body is worth caching.  Bodies with an
+            C{ETag} are anyway.
+        @type repeats: L{bool}
+
+        @return: The body to write.
+        @rtype: L{bytes}
+        """
+        request = self._request
+        if self._decided or request.startedWriting:
+            return body
+        if request.method == b"HEAD" and not body:
+            # Give the response the headers the response to a GET would
+            # have, whose body is known by its Content-Length at most.
+            self._start()
+            self._whole = True
+            return body
+        self._start(len(body))
+        if not self.compressing:
+            return body
+        self._whole = True
+        compressed = self._compression._compress(
+            self._coding, body,
+            repeats or request.responseHeaders.hasHeader(b"etag"))
+        # The size of the compressed body is known, so it needn't be chunked.
+        self._request.responseHeaders.setRawHeaders(
+            b"content-length", [intToBytes(len(compressed))])
+        return compressed
+
+
+    def encode(self, data):
+        if not self._decided:
+            self._start()
+        if not self.compressing or self._whole:
+            return data
+        if self._compressor is None:
+            self._compressor = self._compression._compressor(self._coding)
+        # Flush every chunk, so that streamed chunks reach the client as
+        # they are written.
+        return (self._compressor.compress(data) +
+                self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+
+    def finish(self):
+        if not self._decided:
+            # Nothing was written.
+            self._start(0)
+        if not self.compressing or self._whole:
+            return b""
+        if self._compressor is None:
+            self._compressor = self._compression._compressor(self._coding)
+        remaining = self._compressor.flush()
+        self._compressor = None
+        return remaining
+
+
+
+def _compressWhole(request, body, repeats=False):
+    """
+    Compress C{body}, the whole body of the response to C{request}, if it is
+    being compressed.  See L{_Encoder.whole}.
+    """
+    encoder = getattr(request, "_encoder", None)
+    if isinstance(encoder, _Encoder):
+        return encoder.whole(body, repeats)
+    return body
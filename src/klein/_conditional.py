@@ -0,0 +1,161 @@
+# -*- test-case-name: klein.test.test_conditional -*-
+
+"""
+Entity tags, and answering conditional requests with 304.
+"""
+
+from __future__ import absolute_import, division
+
+import hashlib
+import math
+
+from twisted.python.compat import unicode
+from twisted.web.http import datetimeToString, stringToDatetime
+
+
+
+_NOT_MODIFIED = 304
+
+_CONDITIONAL_METHODS = (b"GET", b"HEAD")
+
+
+
+def _quote(version, weak=False):
+    """
+    Make an entity tag of C{version}.
+
+    @type version: L{bytes} or L{unicode}
+
+    @rtype: L{bytes}
+    """
+    if isinstance(version, unicode):
+        version = version.encode("utf-8")
+    tag = b'"' + version.replace(b'"', b"") + b'"'
+    if weak:
+        tag = b"W/" + tag
+    return tag
+
+
+
+def _bodyETag(body, weak=False):
+    """
+    Make an entity tag of the hash of C{body}.
+    """
+    return _quote(hashlib.sha1(body).hexdigest()[:32].encode("ascii"), weak)
+
+
+
+def _opaque(tag):
+    """
+    The part of C{tag} compared by the weak comparison of entity tags.
+    """
+    tag = tag.strip()
+    if tag.startswith(b"W/"):
+        tag = tag[2:]
+    return tag
+
+
+
+def _matches(ifNoneMatch, tag):
+    """
+    Does C{tag} match the C{If-None-Match} header C{ifNoneMatch}?
+    """
+    if ifNoneMatch.strip() == b"*":
+        return True
+    tag = _opaque(tag)
+    return any(_opaque(candidate) == tag
+               for candidate in ifNoneMatch.split(b","))
+
+
+
+def _lastModified(request):
+    """
+    When the response to C{request} says its content was last modified, in
+    seconds since the epoch, or C{None}.
+    """
+    if request.lastModified:
+        return request.lastModified
+    header = request.responseHeaders.getRawHeaders(b"last-modified")
+    if header:
+        try:
+            return stringToDatetime(header[0])
+        except ValueError:
+            pass
+    return None
+
+
+
+def _isFresh(request):
+    """
+    Does the client have the content of the response to C{request} already,
+    according to the conditions of C{request}?
+
+    C{If-None-Match} is compared to the entity tag of the response, and
+    C{If-Modified-Since} to its last modification time, if it has them.
+    """
+    if request.method not in _CONDITIONAL_METHODS:
+        return False
+    ifNoneMatch = request.getHeader(b"if-none-match")
+    if ifNoneMatch is not None:
+        tag = request.etag
+        if tag is None:
+            tags = request.responseHeaders.getRawHeaders(b"etag")
+            if not tags:
+                return False
+            tag = tags[0]
+        return _matches(ifNoneMatch, tag)
+
+    ifModifiedSince = request.getHeader(b"if-modified-since")
+    if ifModifiedSince is not None:
+        lastModified = _lastModified(request)
+        if lastModified is None:
+            return False
+        try:
+            since = stringToDatetime(ifModifiedSince.split(b";", 1)[0])
+        except ValueError:
+            return False
+        return since >= lastModified
+    return False
+
+
+
+def _notModified(request, version=None, last_modified=None, weak=False):
+    """
+    Give the response to C{request} the entity tag C{version} and the last
+    modification time C{last_modified}, and answer C{request} with 304 if the
+    client has its content already.
+
+    @return: Whether C{request} is answered with 304.
+    @rtype: L{bool}
+    """
+    if version is not None:
+        request.setHeader(b"etag", _quote(version, weak))
+    if last_modified is not None:
+        request.setHeader(b"last-modified",
+                          datetimeToString(int(math.ceil(last_modified))))
+    if _isFresh(request):
+        request.setResponseCode(_NOT_MODIFIED)
+        return True
+    return False
+
+
+
+def _conditionalBody(request, body, weak=False):
+    """
+    Tag the response to C{request}, whose whole body is C{body}, with the
+    hash of C{body} unless it has an entity tag already, and answer
+    C{request} with 304 if the client has C{body} already.
+
+    @return: The body to write.
+    @rtype: L{bytes}
+    """
+    if (request.code != 200 or request.startedWriting or
+            request.method not in _CONDITIONAL_METHODS):
+        return body
+    if request.etag is None and not request.responseHeaders.hasHeader(
+            b"etag"):
+        request.setHeader(b"etag", _bodyETag(body, weak))
+    if _isFresh(request):
+        request.setResponseCode(_NOT_MODIFIED)
+        return b""
+    return body
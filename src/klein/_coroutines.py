@@ -0,0 +1,49 @@
+# -*- test-case-name: klein.test.test_coroutines -*-
+
+"""
+Support for handlers defined with C{async def}.
+"""
+
+from __future__ import absolute_import, division
+
+try:
+    from inspect import iscoroutine
+except ImportError:
+    # Python 2 has no coroutines.
+    def iscoroutine(obj):
+        return False
+
+try:
+    from twisted.internet.defer import ensureDeferred
+except ImportError:
+    ensureDeferred = None
+
+
+__all__ = ["maybeEnsureDeferred"]
+
+
+
+def maybeEnsureDeferred(result):
+    """
+    Drive C{result} with C{ensureDeferred} if it is a coroutine, as returned
+    by calling an C{async def} function.
+
+    Cancelling the returned L{Deferred} cancels whatever the coroutine is
+    awaiting.
+
+    @param result: The result of a handler.
+
+    @raise RuntimeError: If C{result} is a coroutine, but the installed
+        version of Twisted cannot drive it.
+
+    @return: A L{twisted.internet.defer.Deferred} firing with the result of
+        the coroutine, or C{result} itself if it isn't one.
+    """
+    if iscoroutine(result):
+        if ensureDeferred is None:
+            result.close()
+            raise RuntimeError(
+                "async def handlers require a version of Twisted with "
+                "twisted.internet.defer.ensureDeferred.")
+        return ensureDeferred(result)
+    return result
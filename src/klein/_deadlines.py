@@ -0,0 +1,73 @@
+# -*- test-case-name: klein.test.test_deadlines -*-
+
+"""
+Bounding how long handlers may take.
+"""
+
+from __future__ import absolute_import, division
+
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.python.failure import Failure
+
+from werkzeug.exceptions import GatewayTimeout
+
+from klein.interfaces import IKleinRequest
+
+
+__all__ = ["DeadlineExceeded"]
+
+
+
+class DeadlineExceeded(GatewayTimeout):
+    """
+    A handler was cancelled because it didn't answer before its deadline.
+    Unless an error handler deals with it, the request is answered with 504.
+
+    @ivar timeout: How long the handler was allowed to take, in seconds.
+    @type timeout: L{float}
+    """
+
+    def __init__(self, timeout):
+        GatewayTimeout.__init__(self)
+        self.timeout = timeout
+
+
+    def __repr__(self):
+        return "<DeadlineExceeded(timeout={0!r})>".format(self.timeout)
+
+
+
+def _callWithDeadline(clock, timeout, call, instance, f, request, *args,
+                      **kwargs):
+    """
+    Call the handler C{f} with C{call}, giving it C{timeout} seconds to
+    answer C{request} before its L{Deferred}, if it returns one, is
+    cancelled.
+
+    The deadline is set on the L{IKleinRequest} of C{request} first, so the
+    handler can tell how much time it has left.
+    """
+    kleinRequest = IKleinRequest(request)
+    kleinRequest.deadline = clock.seconds() + timeout
+    kleinRequest.clock = clock
+
+    result = call(instance, f, request, *args, **kwargs)
+    if isinstance(result, Deferred) and not result.called:
+        # Deferred.addTimeout needs Twisted 16.5.
+        timedOut = []
+
+        def cancel():
+            timedOut.append(True)
+            result.cancel()
+
+        def done(result):
+            if delayed.active():
+                delayed.cancel()
+            elif (timedOut and isinstance(result, Failure) and
+                  result.check(CancelledError)):
+                return Failure(DeadlineExceeded(timeout))
+            return result
+
+        delayed = clock.callLater(timeout, cancel)
+        result.addBoth(done)
+    return result
@@ -0,0 +1,343 @@
+# -*- test-case-name: klein.test.test_dispatch -*-
+
+"""
+An index of a C{werkzeug.routing.Map} which narrows matching down to the few
+rules which could possibly match a path.
+"""
+
+from __future__ import absolute_import, division
+
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+from werkzeug.routing import Rule, RoutingException
+
+
+__all__ = ["RouteIndex", "werkzeugMatch"]
+
+
+# Newer versions of werkzeug match with a state machine over the whole map
+# rather than rule by rule.
+_ruleMatching = hasattr(Rule, "match")
+
+# Before werkzeug 0.14, Rule.match took the path alone.
+_matchTakesMethod = False
+if _ruleMatching:
+    _matchCode = Rule.match.__code__
+    _matchTakesMethod = (
+        "method" in _matchCode.co_varnames[:_matchCode.co_argcount])
+    del _matchCode
+
+
+
+def _ruleMatch(rule, path, method):
+    """
+    Match C{path} against C{rule}, as C{werkzeug.routing.MapAdapter.match}
+    does, with however many arguments this version of werkzeug takes.
+    """
+    if _matchTakesMethod:
+        return rule.match(path, method)
+    return rule.match(path)
+
+
+
+def _literalSegments(rule):
+    """
+    Compute the literal path segments a rule's path starts with.
+
+    Empty segments are dropped, so that the result does not depend on how
+    slashes are merged.
+
+    @param rule: A rule.
+    @type rule: C{werkzeug.routing.Rule}
+
+    @return: The segments of C{rule}'s path that precede its first converter.
+    @rtype: L{list} of L{unicode}
+    """
+    segments = []
+    for segment in rule.rule.split(u"/"):
+        if u"<" in segment:
+            break
+        if segment:
+            segments.append(segment)
+    return segments
+
+
+
+def _pathSegments(path_info):
+    """
+    Split a path into its non-empty segments.
+    """
+    return [segment for segment in path_info.split(u"/") if segment]
+
+
+
+def _isRegular(url_map, rule):
+    """
+    Can a match of C{rule} be returned without any of werkzeug's redirect
+    handling?
+
+    @param url_map: The map C{rule} is bound to.
+    @type url_map: C{werkzeug.routing.Map}
+
+    @param rule: A rule.
+    @type rule: C{werkzeug.routing.Rule}
+
+    @rtype: L{bool}
+    """
+    if rule.alias or rule.redirect_to is not None:
+        return False
+    if getattr(rule, "websocket", False):
+        return False
+    if url_map.redirect_defaults:
+        for other in url_map.iter_rules(rule.endpoint):
+            if other is not rule and other.defaults:
+                return False
+    return True
+
+
+
+def _isMethodIndependent(rule):
+    """
+    Can C{rule} affect the outcome of matching a path it matches even if it
+    doesn't allow the method of the request?
+
+    Depending on the version of werkzeug, redirects for strict slashes and
+    aliases may be raised before the method is checked.
+
+    @param rule: A rule.
+    @type rule: C{werkzeug.routing.Rule}
+
+    @rtype: L{bool}
+    """
+    return bool(rule.alias or (rule.strict_slashes and not rule.is_leaf))
+
+
+
+class _Node(object):
+    """
+    A node of the literal segment trie.
+
+    @ivar children: A L{dict} mapping the next literal segment to a child
+        L{_Node}.
+    @ivar rules: The C{(position, rule, regular)} triples of the rules whose
+        literal segments end at this node.
+    @ivar candidates: The C{(rule, regular)} pairs of every rule attached to
+        this node or one of its ancestors, in the map's matching order.
+    @ivar byMethod: A L{dict} mapping methods to a L{tuple} of two lists of
+        C{(rule, regular)} pairs taken from C{candidates}; the rules which
+        need to be matched for that method, and the rules which could only
+        contribute to the methods allowed for the path.  Methods no rule
+        mentions share the entry for C{None}.
+    """
+
+    def __init__(self):
+        self.children = {}
+        self.rules = []
+        self.candidates = []
+        self.byMethod = {}
+
+
+    def forMethod(self, method, knownMethods):
+        """
+        Split the candidates of this node for C{method}.
+
+        @param method: An upper case method.
+        @type method: L{unicode}
+
+        @param knownMethods: Every method allowed by some rule.
+        @type knownMethods: L{frozenset} of L{unicode}
+
+        @return: The entry of C{byMethod} for C{method}.
+        """
+        if method not in knownMethods:
+            method = None
+        entry = self.byMethod.get(method)
+        if entry is None:
+            matching = []
+            others = []
+            for candidate in self.candidates:
+                rule = candidate[0]
+                if (rule.methods is None or method in rule.methods
+                        or _isMethodIndependent(rule)):
+                    matching.append(candidate)
+                else:
+                    others.append(candidate)
+            entry = self.byMethod[method] = (matching, others)
+        return entry
+
+
+
+class RouteIndex(object):
+    """
+    A trie of the literal leading path segments of the rules of a
+    C{werkzeug.routing.Map}.
+
+    Matching a path only runs the regular expressions and converters of rules
+    whose literal segments are a prefix of the path and which allow the
+    method of the request, in the same order as the map would, so results are
+    identical to C{MapAdapter.match}.  Whenever a match involves werkzeug's
+    redirect handling (strict slashes, aliases, defaults and C{redirect_to}),
+    or if the installed werkzeug doesn't match rule by rule, matching falls
+    back to the map itself.
+
+    When a path only matches rules which don't allow the method of the
+    request, the methods which are allowed are returned rather than a
+    C{MethodNotAllowed} exception raised.
+
+    The index is built lazily and must be invalidated with L{invalidate} when
+    rules are added to the map.
+    """
+
+    def __init__(self, url_map):
+        """
+        @param url_map: The map to index.
+        @type url_map: C{werkzeug.routing.Map}
+        """
+        self._url_map = url_map
+        self._root = None
+        self._knownMethods = frozenset()
+
+
+    def invalidate(self):
+        """
+        Discard the index, so that it is rebuilt on the next match.
+        """
+        self._root = None
+
+
+    def build(self):
+        """
+        Build the index now rather than on the next match.
+        """
+        self._root = self._build()
+
+
+    def _build(self):
+        """
+        Index the rules of the map.
+
+        @return: The root of the trie.
+        @rtype: L{_Node}
+        """
+        url_map = self._url_map
+        root = _Node()
+        knownMethods = set()
+        for position, rule in enumerate(url_map.iter_rules()):
+            if rule.build_only:
+                continue
+            knownMethods.update(rule.methods or ())
+            node = root
+            for segment in _literalSegments(rule):
+                node = node.children.setdefault(segment, _Node())
+            node.rules.append((position, rule, _isRegular(url_map, rule)))
+
+        def collect(node, inherited):
+            entries = sorted(inherited + node.rules, key=lambda e: e[0])
+            node.candidates = [(rule, regular)
+                               for (position, rule, regular) in entries]
+            for child in node.children.values():
+                collect(child, entries)
+
+        collect(root, [])
+        self._knownMethods = frozenset(knownMethods)
+        return root
+
+
+    def _node(self, path_info):
+        """
+        Find the deepest node for C{path_info}.
+        """
+        node = self._root
+        if node is None:
+            node = self._root = self._build()
+        for segment in _pathSegments(path_info):
+            child = node.children.get(segment)
+            if child is None:
+                break
+            node = child
+        return node
+
+
+    def candidates(self, path_info):
+        """
+        Find the rules which could match C{path_info}.
+
+        @param path_info: The path to match.
+        @type path_info: L{unicode}
+
+        @return: The C{(rule, regular)} pairs of the candidate rules, in
+            matching order.
+        @rtype: L{list} of L{tuple}
+        """
+        return self._node(path_info).candidates
+
+
+    def match(self, mapper):
+        """
+        Match the URL C{mapper} is bound to.
+
+        @param mapper: An adapter of the indexed map.
+        @type mapper: C{werkzeug.routing.MapAdapter}
+
+        @raise werkzeug.exceptions.HTTPException: If the URL does not resolve
+            for a reason other than the method of the request, exactly as
+            C{mapper.match} would.
+
+        @return: A L{tuple} of the matched C{werkzeug.routing.Rule} and a
+            L{dict} of the converted arguments, or of C{None} and a
+            L{frozenset} of the methods which the path does allow.
+        """
+        if not _ruleMatching:
+            return werkzeugMatch(mapper)
+
+        url_map = mapper.map
+        path_info = mapper.path_info
+        method = mapper.default_method.upper()
+        path = u"%s|%s" % (
+            url_map.host_matching and mapper.server_name or mapper.subdomain,
+            path_info and u"/" + path_info.lstrip(u"/"),
+        )
+
+        node = self._node(path_info)
+        matching, others = node.forMethod(method, self._knownMethods)
+
+        have_match_for = set()
+        for rule, regular in matching:
+            try:
+                rv = _ruleMatch(rule, path, method)
+            except RoutingException:
+                return werkzeugMatch(mapper)
+            if rv is None:
+                continue
+            if rule.methods is not None and method not in rule.methods:
+                have_match_for.update(rule.methods)
+                continue
+            if not regular:
+                return werkzeugMatch(mapper)
+            return rule, rv
+
+        for rule, regular in others:
+            try:
+                rv = _ruleMatch(rule, path, method)
+            except RoutingException:
+                return werkzeugMatch(mapper)
+            if rv is not None:
+                have_match_for.update(rule.methods)
+
+        if have_match_for:
+            return None, frozenset(have_match_for)
+        raise NotFound()
+
+
+
+def werkzeugMatch(mapper):
+    """
+    Match the URL C{mapper} is bound to with werkzeug, returning the allowed
+    methods rather than raising C{MethodNotAllowed} like L{RouteIndex.match}.
+
+    werkzeug still raises C{MethodNotAllowed} after considering every rule,
+    which is caught here; only L{RouteIndex.match} avoids both.
+    """
+    try:
+        return mapper.match(return_rule=True)
+    except MethodNotAllowed as e:
+        return None, frozenset(e.valid_methods)
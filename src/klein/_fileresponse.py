@@ -0,0 +1,360 @@
+# -*- test-case-name: klein.test.test_fileresponse -*-
+
+"""
+Responses serving the contents of files and buffers.
+"""
+
+from __future__ import absolute_import, division
+
+import errno
+import mimetypes
+import mmap
+import os
+
+from twisted.internet import tcp
+from twisted.python.compat import _PY3, unicode
+
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import parse_range_header
+
+
+__all__ = ["FileResponse"]
+
+
+
+# Errors of os.sendfile meaning it can't be used for a pair of descriptors,
+# rather than that sending failed.
+_sendfileUnsupported = frozenset(
+    getattr(errno, name) for name in
+    ["EINVAL", "ENOSYS", "ENOTSOCK", "EOPNOTSUPP", "ENOTSUP"]
+    if hasattr(errno, name))
+
+# The private state of tcp.Connection that writing to its socket directly
+# relies on.  Transports without it are written to as usual.
+_transportAttributes = ["dataBuffer", "offset", "_tempDataBuffer",
+                        "producer", "producerPaused"]
+
+
+
+def _sendfileTransport(request):
+    """
+    Find the transport of C{request}, if the body of its response may be
+    written to its socket with C{os.sendfile}.
+
+    That is only the case for plain TCP connections, with an HTTP/1.x
+    channel writing the body as it is, unencrypted, not chunked and not
+    compressed.
+
+    @return: A L{tcp.Connection} or L{None}.
+    """
+    if getattr(os, "sendfile", None) is None or getattr(request, "chunked",
+                                                        True):
+        return None
+    encoder = getattr(request, "_encoder", None)
+    if encoder is not None and getattr(encoder, "compressing", True):
+        return None
+    transport = getattr(getattr(request, "channel", None), "transport", None)
+    if not isinstance(transport, tcp.Connection) or transport.TLS:
+        return None
+    if not all(hasattr(transport, name) for name in _transportAttributes):
+        return None
+    return transport
+
+
+
+def _buffered(transport):
+    """
+    Has C{transport} data buffered, which must be sent before anything is
+    written to its socket directly?
+    """
+    return (bool(transport._tempDataBuffer) or
+            len(transport.dataBuffer) > transport.offset)
+
+
+
+def _waitUntilWritable(transport):
+    """
+    Pause the producer of the response being written to C{transport} until
+    its socket is writable again.
+
+    This is what C{transport} does itself when its buffer is full: it asks
+    its producer, the HTTP channel, to pause the response's producer, and
+    resumes it once it could write to its socket.
+    """
+    if transport.producer is not None:
+        transport.producerPaused = True
+        transport.producer.pauseProducing()
+    transport.startWriting()
+
+
+
+class FileResponse(object):
+    """
+    A response serving the contents of a file or buffer, which handlers may
+    return.
+
+    The body may be a path to a file, a file object open for reading in
+    binary mode, an L{mmap.mmap}, or anything supporting the buffer protocol,
+    like a L{memoryview}.  The C{Content-Length} of the response is set, and
+    a single byte range of the body is served as a 206 response if asked to
+    with a C{Range} header.  Ranges outside the body are answered with 416.
+
+    Files are memory-mapped if possible, and written in chunks.  With
+    C{use_sendfile}, regular files served over plain TCP connections are
+    written with C{os.sendfile} instead, so that their contents don't go
+    through the process.  That writes to the socket of a
+    L{twisted.internet.tcp.Connection} around it, relying on its private
+    state, so it is only done when asked for.
+
+    Files, whether opened from a path or given open, are closed once the
+    response is written.  Memory maps and buffers are left alone, and on
+    Python 3 are written without being copied, so they mustn't change until
+    the response has been sent.
+
+    @ivar content_type: The C{Content-Type} of the response, unless the
+        handler set one.
+    @type content_type: L{bytes}
+
+    @ivar chunk_size: How many bytes are written at a time.
+    @type chunk_size: L{int}
+
+    @ivar use_sendfile: Whether files may be written with C{os.sendfile}.
+        Off by default.
+    @type use_sendfile: L{bool}
+    """
+
+    chunk_size = 2 ** 16
+
+    def __init__(self, body, content_type=None, chunk_size=None,
+                 use_sendfile=False):
+        """
+        @param body: A path, file object, L{mmap.mmap} or buffer.
+
+        @param content_type: The C{Content-Type} of the response.  When not
+            given it is guessed from the name of the file, and defaults to
+            C{application/octet-stream}.
+        @type content_type: L{bytes} or L{unicode}
+
+        @param chunk_size: How many bytes to write at a time.
+        @type chunk_size: L{int}
+
+        @param use_sendfile: Whether files may be written with
+            C{os.sendfile}.
+        @type use_sendfile: L{bool}
+        """
+        if hasattr(body, "__fspath__"):
+            body = body.__fspath__()
+        self._body = body
+        self._path = isinstance(body, (bytes, unicode))
+
+        if content_type is None:
+            name = body if self._path else getattr(body, "name", None)
+            if isinstance(name, bytes):
+                name = name.decode("utf-8", "replace")
+            if isinstance(name, unicode):
+                content_type = mimetypes.guess_type(name)[0]
+        if content_type is None:
+            content_type = "application/octet-stream"
+        if isinstance(content_type, unicode):
+            content_type = content_type.encode("ascii")
+        self.content_type = content_type
+
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        self.use_sendfile = use_sendfile
+
+
+    def _open(self):
+        """
+        Open the body.
+
+        @return: A L{tuple} of a file object, or L{None}, what to read the
+            body from, and its size in bytes.
+        """
+        if self._path:
+            f = open(self._body, "rb")
+        elif isinstance(self._body, mmap.mmap):
+            return None, self._body, len(self._body)
+        elif hasattr(self._body, "read"):
+            f = self._body
+        else:
+            view = memoryview(self._body)
+            if view.ndim != 1 or view.itemsize != 1:
+                # memoryview.cast is new in Python 3.3.
+                if hasattr(view, "cast"):
+                    view = view.cast("B")
+                else:
+                    view = memoryview(view.tobytes())
+            return None, view, len(view)
+
+        try:
+            size = os.fstat(f.fileno()).st_size
+        except (AttributeError, ValueError, EnvironmentError):
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+        return f, f, size
+
+
+    def _range(self, request, size):
+        """
+        Find the byte range of the body to serve.
+
+        Ranges are only served for C{GET} requests.  Several ranges, ranges
+        which aren't understood and conditional ranges are ignored, and the
+        whole body served.
+
+        @raise RequestedRangeNotSatisfiable: If the range is outside the
+            body.
+
+        @return: A L{tuple} of the offsets of its first byte and of the byte
+            after its last, or L{None} to serve the whole body.
+        """
+        header = request.getHeader(b"range")
+        if (header is None or request.method != b"GET" or
+                request.getHeader(b"if-range") is not None):
+            return None
+        ranges = parse_range_header(header.decode("latin-1"))
+        if (ranges is None or ranges.units != "bytes" or
+                len(ranges.ranges) != 1):
+            return None
+
+        start, stop = ranges.ranges[0]
+        if stop is None:
+            if start < 0:
+                start = max(size + start, 0)
+            stop = size
+        if start >= size:
+            # RequestedRangeNotSatisfiable only sets Content-Range itself in
+            # recent versions of werkzeug.
+            request.setHeader(b"content-range", u"bytes */{0}".format(
+                size).encode("ascii"))
+            raise RequestedRangeNotSatisfiable()
+        return start, min(stop, size)
+
+
+    def render(self, request):
+        """
+        Set the status and headers of the response to C{request}.
+
+        @return: An iterable of the chunks of the body to stream, or L{bytes}
+            if there is no body to write.
+        """
+        f, source, size = self._open()
+        try:
+            byteRange = self._range(request, size)
+        except BaseException:
+            self._close(f)
+            raise
+        start, stop = byteRange or (0, size)
+
+        request.setHeader(b"accept-ranges", b"bytes")
+        if not request.responseHeaders.hasHeader(b"content-type"):
+            request.setHeader(b"content-type", self.content_type)
+        if byteRange is not None:
+            request.setResponseCode(206)
+            request.setHeader(b"content-range", u"bytes {0}-{1}/{2}".format(
+                start, stop - 1, size).encode("ascii"))
+        request.setHeader(b"content-length", u"{0}".format(
+            stop - start).encode("ascii"))
+
+        if request.method == b"HEAD" or start == stop:
+            self._close(f)
+            return b""
+        return self._chunks(request, f, source, start, stop)
+
+
+    def _chunks(self, request, f, source, start, stop):
+        """
+        Write the body from C{start} to C{stop}, with C{os.sendfile} as long
+        as possible, and yield the chunks of whatever is left.
+        """
+        try:
+            fileno = None
+            if f is not None and self.use_sendfile:
+                try:
+                    fileno = f.fileno()
+                except (AttributeError, ValueError, EnvironmentError):
+                    pass
+
+            if fileno is not None:
+                # Writing nothing writes the headers, which must be sent
+                # before the body can be written to the socket.
+                yield b""
+                transport = _sendfileTransport(request)
+                while transport is not None and start < stop:
+                    if _buffered(transport):
+                        _waitUntilWritable(transport)
+                        yield b""
+                        continue
+                    try:
+                        sent = os.sendfile(
+                            transport.getHandle().fileno(), fileno, start,
+                            min(stop - start, self.chunk_size))
+                    except EnvironmentError as e:
+                        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            _waitUntilWritable(transport)
+                            yield b""
+                            continue
+                        if e.errno in _sendfileUnsupported:
+                            break
+                        raise
+                    if not sent:
+                        break
+                    start += sent
+                    request.sentLength += sent
+                    yield b""
+
+            for chunk in self._read(f, source, start, stop):
+                yield chunk
+        finally:
+            self._close(f)
+
+
+    def _read(self, f, source, start, stop):
+        """
+        Yield the chunks of the body from C{start} to C{stop}, from a memory
+        map of the file if possible.
+
+        On Python 3 the chunks of memory maps and buffers are views of them,
+        written without copying them.
+        """
+        mapped = None
+        if f is not None:
+            try:
+                source = mapped = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, ValueError, EnvironmentError):
+                f.seek(start)
+        if _PY3 and isinstance(source, mmap.mmap):
+            source = memoryview(source)
+
+        try:
+            while start < stop:
+                size = min(stop - start, self.chunk_size)
+                if source is f:
+                    chunk = f.read(size)
+                else:
+                    chunk = source[start:start + size]
+                    if not _PY3 and isinstance(chunk, memoryview):
+                        # bytes() of a view is its repr on Python 2.
+                        chunk = chunk.tobytes()
+                if not chunk:
+                    raise IOError(
+                        "{0!r} ended before the {1} bytes of its "
+                        "response.".format(self._body, stop))
+                start += len(chunk)
+                yield chunk
+        finally:
+            if mapped is not None:
+                del source
+                try:
+                    mapped.close()
+                except BufferError:
+                    # Chunks are still buffered by the transport; the map
+                    # is closed once they are gone.
+                    pass
+
+
+    def _close(self, f):
+        if f is not None:
+            f.close()
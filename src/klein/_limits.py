@@ -0,0 +1,218 @@
+# -*- test-case-name: klein.test.test_limits -*-
+
+"""
+Limiting how many requests are handled at once, by endpoint or by group of
+endpoints.
+"""
+
+from __future__ import absolute_import, division
+
+from collections import deque
+
+from twisted.internet.defer import Deferred, maybeDeferred
+
+from werkzeug.exceptions import ServiceUnavailable
+
+
+__all__ = ["ConcurrencyLimit", "ConcurrencyLimitExceeded"]
+
+
+
+class ConcurrencyLimitExceeded(ServiceUnavailable):
+    """
+    A request was refused before its handler ran, because its concurrency
+    limit was reached and as many requests were waiting already.  Unless an
+    error handler deals with it, the request is answered with 503, and a
+    C{Retry-After} header.
+
+    @ivar limit: The name of the concurrency limit.
+    @type limit: L{unicode}
+
+    @ivar in_flight: How many requests were being handled.
+    @type in_flight: L{int}
+
+    @ivar queue_depth: How many requests were waiting.
+    @type queue_depth: L{int}
+
+    @ivar retry_after: After how many seconds clients should try again, or
+        C{None}.
+    @type retry_after: L{int}
+    """
+
+    def __init__(self, limit, in_flight, queue_depth, retry_after):
+        ServiceUnavailable.__init__(self)
+        self.limit = limit
+        self.in_flight = in_flight
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+
+
+    def get_headers(self, *args, **kwargs):
+        # werkzeug 2 and later pass a scope along with the environ.
+        headers = ServiceUnavailable.get_headers(self, *args, **kwargs)
+        if self.retry_after is not None:
+            headers.append(("Retry-After", str(self.retry_after)))
+        return headers
+
+
+    def __repr__(self):
+        return "<ConcurrencyLimitExceeded(limit={0!r}, in_flight={1!r}, " \
+            "queue_depth={2!r})>".format(self.limit, self.in_flight,
+                                         self.queue_depth)
+
+
+
+class _Waiter(object):
+    """
+    A call waiting for its turn.
+    """
+
+    __slots__ = ["f", "args", "kwargs", "deferred", "running"]
+
+    def __init__(self, f, args, kwargs):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.deferred = None
+        self.running = None
+
+
+
+class ConcurrencyLimit(object):
+    """
+    A named limit on how many handlers run at once, with a bounded queue of
+    handlers waiting for their turn.
+
+    A handler runs until the L{Deferred} it returns, if any, fires.
+
+    @ivar name: The name of the limit.
+    @type name: L{unicode}
+
+    @ivar max_concurrent: The maximum number of handlers running at once.
+    @type max_concurrent: L{int}
+
+    @ivar max_queue: The maximum number of handlers waiting for their turn.
+    @type max_queue: L{int}
+
+    @ivar retry_after: The C{Retry-After} of the responses to requests which
+        are refused, in seconds, or C{None} to leave it out.
+    @type retry_after: L{int}
+
+    @ivar in_flight: How many handlers are running.
+    @type in_flight: L{int}
+    """
+
+    def __init__(self, name, max_concurrent=10, max_queue=0, retry_after=1):
+        """
+        @param name: The name of the limit.
+        @type name: L{unicode}
+
+        @param max_concurrent: The maximum number of handlers running at
+            once.
+        @type max_concurrent: L{int}
+
+        @param max_queue: The maximum number of handlers waiting for their
+            turn.
+        @type max_queue: L{int}
+
+        @param retry_after: The C{Retry-After} of the responses to requests
+            which are refused, in seconds, or C{None} to leave it out.
+        @type retry_after: L{int}
+        """
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self._waiting = deque()
+        self._draining = False
+
+
+    @property
+    def queue_depth(self):
+        """
+        How many handlers are waiting for their turn.
+        """
+        return len(self._waiting)
+
+
+    def configure(self, max_concurrent=None, max_queue=None,
+                  retry_after=None):
+        """
+        Change the settings of the limit.  Those which aren't given are left
+        alone.
+        """
+        if max_concurrent is not None:
+            self.max_concurrent = max_concurrent
+        if max_queue is not None:
+            self.max_queue = max_queue
+        if retry_after is not None:
+            self.retry_after = retry_after
+        self._drain()
+
+
+    def run(self, f, *args, **kwargs):
+        """
+        Call C{f} with C{args} and C{kwargs} now if fewer than
+        C{max_concurrent} handlers are running, or once it is its turn.
+
+        @raise ConcurrencyLimitExceeded: If C{max_concurrent} handlers are
+            running, and C{max_queue} are waiting already.
+
+        @return: The result of C{f}, or a L{Deferred} firing with it if
+            C{f} has to wait.  Cancelling that L{Deferred} while C{f} waits
+            means it won't be called.
+        """
+        if self.in_flight < self.max_concurrent and not self._waiting:
+            return self._run(f, *args, **kwargs)
+        if len(self._waiting) >= self.max_queue:
+            raise ConcurrencyLimitExceeded(self.name, self.in_flight,
+                                           len(self._waiting),
+                                           self.retry_after)
+        waiter = _Waiter(f, args, kwargs)
+        waiter.deferred = Deferred(lambda d: self._cancel(waiter))
+        self._waiting.append(waiter)
+        return waiter.deferred
+
+
+    def _run(self, f, *args, **kwargs):
+        self.in_flight += 1
+        try:
+            result = f(*args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        if isinstance(result, Deferred):
+            return result.addBoth(self._release)
+        self._release()
+        return result
+
+
+    def _release(self, result=None):
+        self.in_flight -= 1
+        self._drain()
+        return result
+
+
+    def _drain(self):
+        """
+        Run waiting handlers while fewer than C{max_concurrent} are running.
+        """
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            while self._waiting and self.in_flight < self.max_concurrent:
+                waiter = self._waiting.popleft()
+                waiter.running = maybeDeferred(
+                    self._run, waiter.f, *waiter.args, **waiter.kwargs)
+                waiter.running.chainDeferred(waiter.deferred)
+        finally:
+            self._draining = False
+
+
+    def _cancel(self, waiter):
+        if waiter.running is None:
+            self._waiting.remove(waiter)
+        else:
+            waiter.running.cancel()
@@ -0,0 +1,245 @@
+# -*- test-case-name: klein.test.test_metrics -*-
+
+"""
+Counting the requests of every endpoint, and exposing the counts to
+Prometheus.
+"""
+
+from __future__ import absolute_import, division
+
+from twisted.python.compat import unicode
+
+from klein._timing import DEFAULT_BUCKETS, Histogram
+
+
+__all__ = ["Metrics"]
+
+
+
+# Response codes are counted from 100 to 599.
+_FIRST_CODE = 100
+_CODES = 500
+
+
+
+class _EndpointMetrics(object):
+    """
+    The counts of the requests routed to one endpoint.
+
+    @ivar requests: The number of requests answered.
+    @type requests: L{int}
+
+    @ivar in_flight: The number of requests being handled.
+    @type in_flight: L{int}
+
+    @ivar codes: The number of responses with every response code, from 100
+        on.
+    @type codes: L{list} of L{int}
+
+    @ivar latency: The time taken to answer the requests, in seconds.
+    @type latency: L{Histogram}
+    """
+
+    __slots__ = ["requests", "in_flight", "codes", "latency"]
+
+    def __init__(self, buckets):
+        self.requests = 0
+        self.in_flight = 0
+        self.codes = [0] * _CODES
+        self.latency = Histogram(buckets)
+
+
+
+def _label(value):
+    """
+    Quote C{value} as the value of a label of the Prometheus text format.
+    """
+    if value is None:
+        value = u""
+    elif not isinstance(value, unicode):
+        value = unicode(value)
+    return u'"{0}"'.format(value.replace(u"\\", u"\\\\")
+                           .replace(u'"', u'\\"').replace(u"\n", u"\\n"))
+
+
+
+def _number(value):
+    """
+    Format C{value} as a sample value of the Prometheus text format.
+    """
+    if value == float("inf"):
+        return u"+Inf"
+    return u"{0!r}".format(value)
+
+
+
+class Metrics(object):
+    """
+    Count the requests an app answers, by endpoint: how many were answered,
+    with which response codes, how many are being handled, and how long they
+    took.
+
+    Pass it to L{klein.Klein} to count its requests, and L{mount} it to serve
+    the counts to Prometheus::
+
+        metrics = Metrics()
+        app = Klein(metrics=metrics)
+        metrics.mount(app)
+
+    Counting a request takes constant time, and allocates nothing but for
+    the first request of every endpoint.  Requests which aren't routed to an
+    endpoint are counted under an empty endpoint name.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, namespace=u"klein"):
+        """
+        @param buckets: The upper bounds of the buckets of the latency
+            histograms, in seconds.
+        @type buckets: L{tuple} of L{float}
+
+        @param namespace: The prefix of the names of the metrics.
+        @type namespace: L{unicode}
+        """
+        self._buckets = tuple(buckets)
+        self._namespace = namespace
+        self._endpoints = {}
+
+
+    def _metrics(self, endpoint):
+        """
+        Get the counts of C{endpoint}, creating them the first time.
+        """
+        metrics = self._endpoints.get(endpoint)
+        if metrics is None:
+            metrics = self._endpoints[endpoint] = _EndpointMetrics(
+                self._buckets)
+        return metrics
+
+
+    def _routed(self, endpoint):
+        """
+        Count a request routed to C{endpoint} as being handled.
+
+        @return: The counts of C{endpoint}.
+        @rtype: L{_EndpointMetrics}
+        """
+        metrics = self._metrics(endpoint)
+        metrics.in_flight += 1
+        return metrics
+
+
+    def _answered(self, metrics, code, duration):
+        """
+        Count a request as answered.
+
+        @param metrics: What L{_routed} returned for the request, or C{None}
+            if it wasn't routed.
+        @type metrics: L{_EndpointMetrics}
+
+        @param code: The response code.
+        @type code: L{int}
+
+        @param duration: How long it took to answer the request, in seconds.
+        @type duration: L{float}
+        """
+        if metrics is None:
+            metrics = self._metrics(None)
+        else:
+            metrics.in_flight -= 1
+        metrics.requests += 1
+        code -= _FIRST_CODE
+        if 0 <= code < _CODES:
+            metrics.codes[code] += 1
+        metrics.latency.observe(duration)
+
+
+    def exposition(self):
+        """
+        Render the counts in the Prometheus text exposition format.
+
+        @rtype: L{bytes}
+        """
+        name = self._namespace + u"_"
+        endpoints = sorted(self._endpoints.items(),
+                           key=lambda item: item[0] or u"")
+        lines = []
+
+        def family(metric, kind, help):
+            lines.append(u"# HELP {0}{1} {2}".format(name, metric, help))
+            lines.append(u"# TYPE {0}{1} {2}".format(name, metric, kind))
+
+        family(u"requests_total", u"counter",
+               u"Requests answered, by endpoint.")
+        for endpoint, metrics in endpoints:
+            lines.append(u"{0}requests_total{{endpoint={1}}} {2}".format(
+                name, _label(endpoint), metrics.requests))
+
+        family(u"responses_total", u"counter",
+               u"Responses, by endpoint and response code.")
+        for endpoint, metrics in endpoints:
+            for offset, count in enumerate(metrics.codes):
+                if count:
+                    lines.append(
+                        u"{0}responses_total{{endpoint={1},code=\"{2}\"}} {3}"
+                        .format(name, _label(endpoint), offset + _FIRST_CODE,
+                                count))
+
+        family(u"requests_in_flight", u"gauge",
+               u"Requests being handled, by endpoint.")
+        for endpoint, metrics in endpoints:
+            if endpoint is not None:
+                lines.append(
+                    u"{0}requests_in_flight{{endpoint={1}}} {2}".format(
+                        name, _label(endpoint), metrics.in_flight))
+
+        family(u"request_duration_seconds", u"histogram",
+               u"Time taken to answer requests, by endpoint.")
+        for endpoint, metrics in endpoints:
+            latency = metrics.latency
+            bounds = latency.bounds + (float("inf"),)
+            for bound, count in zip(bounds, latency.cumulative()):
+                lines.append(
+                    u"{0}request_duration_seconds_bucket{{endpoint={1},"
+                    u"le=\"{2}\"}} {3}".format(name, _label(endpoint),
+                                               _number(bound), count))
+            lines.append(
+                u"{0}request_duration_seconds_sum{{endpoint={1}}} {2}".format(
+                    name, _label(endpoint), _number(latency.total)))
+            lines.append(
+                u"{0}request_duration_seconds_count{{endpoint={1}}} {2}"
+                .format(name, _label(endpoint), latency.count))
+
+        return (u"\n".join(lines) + u"\n").encode("utf-8")
+
+
+    def render(self, request):
+        """
+        Answer C{request} with the counts in the Prometheus text exposition
+        format.
+
+        @return: The body of the response.
+        @rtype: L{bytes}
+        """
+        request.setHeader(b"content-type",
+                          b"text/plain; version=0.0.4; charset=utf-8")
+        return self.exposition()
+
+
+    def mount(self, app, url=u"/metrics", endpoint=u"metrics"):
+        """
+        Add a route to C{app} serving the counts with L{render}.
+
+        @param app: The app to add the route to.
+        @type app: L{klein.Klein}
+
+        @param url: The URL of the route.
+        @type url: L{unicode}
+
+        @param endpoint: The name of the endpoint of the route.
+        @type endpoint: L{unicode}
+        """
+        def metrics(*args):
+            # Apps bound to an instance pass it first.
+            return self.render(args[-1])
+
+        app.route(url, endpoint=endpoint, methods=["GET"])(metrics)
@@ -0,0 +1,370 @@
+# -*- test-case-name: klein.test.test_multipart -*-
+
+"""
+Parsing the forms sent as the bodies of requests, as they are received.
+"""
+
+from __future__ import absolute_import, division
+
+import tempfile
+
+from io import BytesIO
+
+from six.moves.urllib.parse import unquote_to_bytes
+
+from twisted.internet.defer import fail
+
+from werkzeug.exceptions import BadRequest, UnsupportedMediaType
+from werkzeug.http import parse_options_header
+
+
+__all__ = ["Form", "FormPart", "MultipartParser"]
+
+
+
+# States of MultipartParser.
+_PREAMBLE = "preamble"
+_DELIMITED = "delimited"
+_HEADERS = "headers"
+_BODY = "body"
+_END = "end"
+
+
+
+class FormPart(object):
+    """
+    A field of a form, or a file sent with it.
+
+    @ivar name: The name of the field.
+    @type name: L{unicode}
+
+    @ivar filename: The name of the file, or C{None} if the part isn't one.
+    @type filename: L{unicode}
+
+    @ivar content_type: The C{Content-Type} of the part.
+    @type content_type: L{bytes}
+
+    @ivar headers: The headers of the part, by their lowercase names.
+    @type headers: L{dict} of L{bytes} to L{bytes}
+
+    @ivar file: The contents of the part, in memory or, once they are larger
+        than the C{spool_size} they were parsed with, in a temporary file.
+
+    @ivar size: The size of the contents of the part, in bytes.
+    @type size: L{int}
+    """
+
+    def __init__(self, name, filename=None, content_type=b"text/plain",
+                 headers=None, file=None):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.headers = headers if headers is not None else {}
+        self.file = file if file is not None else BytesIO()
+        self.size = 0
+
+
+    def __repr__(self):
+        return "<FormPart(name={0!r}, filename={1!r}, size={2!r})>".format(
+            self.name, self.filename, self.size)
+
+
+    @property
+    def value(self):
+        """
+        The contents of the part, read whole.
+
+        @rtype: L{bytes}
+        """
+        self.file.seek(0)
+        return self.file.read()
+
+
+    def _write(self, data):
+        if data:
+            self.file.write(data)
+            self.size += len(data)
+
+
+
+class Form(object):
+    """
+    The fields of a form sent as the body of a request, and the files sent
+    with it, which handlers get from the C{form} of the L{IKleinRequest} of
+    the request::
+
+        form = yield IKleinRequest(request).form()
+        title = form[u"title"].value
+        for upload in form.getall(u"attachment"):
+            store(upload.filename, upload.file)
+
+    The temporary files of the parts are removed once the request is
+    answered, or right away if it was already answered or the client went
+    away by the time the form was parsed.
+
+    @ivar parts: The parts of the form, in order.
+    @type parts: L{list} of L{FormPart}
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+
+
+    def __contains__(self, name):
+        return any(part.name == name for part in self.parts)
+
+
+    def __getitem__(self, name):
+        for part in self.parts:
+            if part.name == name:
+                return part
+        raise KeyError(name)
+
+
+    def get(self, name, default=None):
+        """
+        The first part called C{name}, or C{default} if there is none.
+        """
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+
+    def getall(self, name):
+        """
+        The parts called C{name}.
+
+        @rtype: L{list} of L{FormPart}
+        """
+        return [part for part in self.parts if part.name == name]
+
+
+    def close(self):
+        """
+        Close the files of the parts, removing the temporary ones.
+        """
+        for part in self.parts:
+            part.file.close()
+
+
+
+class MultipartParser(object):
+    """
+    Parse a C{multipart/form-data} body into L{FormPart}s, incrementally, as
+    its chunks are given to L{feed}, so that only the contents of its parts
+    are kept, in temporary files once they are large.
+
+    @ivar parts: The parts parsed so far.
+    @type parts: L{list} of L{FormPart}
+    """
+
+    def __init__(self, boundary, spool_size=2 ** 20, max_parts=1000,
+                 max_header_size=2 ** 14):
+        """
+        @param boundary: The C{boundary} of the C{Content-Type} of the body.
+        @type boundary: L{bytes}
+
+        @param spool_size: The size in bytes above which the contents of a
+            part are written to a temporary file rather than kept in memory.
+        @type spool_size: L{int}
+
+        @param max_parts: The most parts accepted.
+        @type max_parts: L{int}
+
+        @param max_header_size: The largest headers of a part accepted, in
+            bytes.
+        @type max_header_size: L{int}
+        """
+        self.parts = []
+        self.spool_size = spool_size
+        self.max_parts = max_parts
+        self.max_header_size = max_header_size
+        self._delimiter = b"\r\n--" + boundary
+        # The first delimiter is at the very start of the body, without the
+        # line break that comes before the others.
+        self._buffer = b"\r\n"
+        self._state = _PREAMBLE
+        self._part = None
+
+
+    def feed(self, data):
+        """
+        Parse the next chunk of the body.
+
+        @raise BadRequest: If the body is malformed.
+        """
+        self._buffer += data
+        while self._step():
+            pass
+
+
+    def finish(self):
+        """
+        Finish parsing the body, which was all fed.
+
+        @raise BadRequest: If the body ended before its last part did.
+
+        @return: The parsed form.
+        @rtype: L{Form}
+        """
+        if self._state != _END:
+            raise BadRequest("The form ended before its last part.")
+        return Form(self.parts)
+
+
+    def _step(self):
+        """
+        Parse as much of the buffered body as possible in the current state.
+
+        @return: Whether to carry on in the next state.
+        """
+        buf = self._buffer
+        if self._state == _PREAMBLE:
+            index = buf.find(self._delimiter)
+            if index < 0:
+                self._buffer = buf[-(len(self._delimiter) - 1):]
+                return False
+            self._buffer = buf[index + len(self._delimiter):]
+            self._state = _DELIMITED
+            return True
+
+        if self._state == _DELIMITED:
+            if len(buf) < 2:
+                return False
+            if buf.startswith(b"--"):
+                self._buffer = b""
+                self._state = _END
+                return False
+            index = buf.find(b"\r\n")
+            if index < 0:
+                self._checkHeaderSize(buf)
+                return False
+            if buf[:index].strip(b" \t"):
+                raise BadRequest("The form has a malformed boundary.")
+            self._buffer = buf[index + 2:]
+            self._state = _HEADERS
+            return True
+
+        if self._state == _HEADERS:
+            if buf.startswith(b"\r\n"):
+                block, self._buffer = b"", buf[2:]
+            else:
+                index = buf.find(b"\r\n\r\n")
+                if index < 0:
+                    self._checkHeaderSize(buf)
+                    return False
+                block, self._buffer = buf[:index], buf[index + 4:]
+            self._checkHeaderSize(block)
+            self._startPart(block)
+            self._state = _BODY
+            return True
+
+        if self._state == _BODY:
+            index = buf.find(self._delimiter)
+            if index >= 0:
+                self._part._write(buf[:index])
+                self._part.file.seek(0)
+                self._part = None
+                self._buffer = buf[index + len(self._delimiter):]
+                self._state = _DELIMITED
+                return True
+            # Keep what could be the start of the delimiter.
+            keep = len(self._delimiter) - 1
+            if len(buf) > keep:
+                self._part._write(buf[:-keep])
+                self._buffer = buf[-keep:]
+            return False
+
+        self._buffer = b""
+        return False
+
+
+    def _checkHeaderSize(self, headers):
+        if len(headers) > self.max_header_size:
+            raise BadRequest("The headers of a part of the form are too "
+                             "large.")
+
+
+    def _startPart(self, block):
+        """
+        Start a part with the headers in C{block}.
+        """
+        if len(self.parts) >= self.max_parts:
+            raise BadRequest("The form has too many parts.")
+        headers = {}
+        for line in block.split(b"\r\n") if block else ():
+            name, colon, value = line.partition(b":")
+            if not colon:
+                raise BadRequest("The form has a malformed header.")
+            headers[name.strip().lower()] = value.strip()
+
+        disposition, options = parse_options_header(
+            headers.get(b"content-disposition", b"").decode("utf-8",
+                                                            "replace"))
+        if disposition != "form-data" or "name" not in options:
+            raise BadRequest("A part of the form has no name.")
+        self._part = FormPart(
+            options["name"], options.get("filename"),
+            headers.get(b"content-type", b"text/plain"), headers,
+            tempfile.SpooledTemporaryFile(max_size=self.spool_size))
+        self.parts.append(self._part)
+
+
+
+def _urlencodedForm(body):
+    """
+    Parse an C{application/x-www-form-urlencoded} body into a L{Form}.
+    """
+    parts = []
+    for field in body.split(b"&"):
+        if not field:
+            continue
+        name, _, value = field.replace(b"+", b" ").partition(b"=")
+        part = FormPart(unquote_to_bytes(name).decode("utf-8", "replace"))
+        part._write(unquote_to_bytes(value))
+        part.file.seek(0)
+        parts.append(part)
+    return Form(parts)
+
+
+
+def _parseForm(request, body, spool_size):
+    """
+    Parse the form sent as C{body}, the L{klein.RequestBody} of C{request},
+    as it is received.
+
+    @return: A L{Deferred} firing with a L{Form}, or failing with
+        L{BadRequest} if the form is malformed, or L{UnsupportedMediaType}
+        if the body isn't a form.
+    """
+    contentType = request.getHeader(b"content-type") or b""
+    mimetype, options = parse_options_header(contentType.decode("latin-1"))
+
+    if mimetype == "application/x-www-form-urlencoded":
+        return body.read().addCallback(_urlencodedForm)
+    if mimetype != "multipart/form-data":
+        return fail(UnsupportedMediaType("The body of the request isn't a "
+                                         "form."))
+    boundary = options.get("boundary")
+    if not boundary:
+        return fail(BadRequest("The form has no boundary."))
+
+    parser = MultipartParser(boundary.encode("latin-1"), spool_size)
+
+    def failed(reason):
+        Form(parser.parts).close()
+        return reason
+
+    def parsed(form):
+        if request.finished or getattr(request, "_disconnected", False):
+            # notifyFinish would never fire.
+            form.close()
+        else:
+            request.notifyFinish().addBoth(lambda ignored: form.close())
+        return form
+
+    d = body.consume(parser.feed)
+    d.addCallback(lambda ignored: parser.finish())
+    d.addErrback(failed)
+    return d.addCallback(parsed)
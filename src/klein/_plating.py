@@ -9,9 +9,12 @@ from json import dumps
 
 from six import text_type, integer_types
 
+from twisted.internet.defer import Deferred
 from twisted.web.template import TagLoader, Element
 from twisted.web.error import MissingRenderMethod
 
+from klein._coroutines import maybeEnsureDeferred
+
 def _should_return_json(request):
     """
     Should the given request result in a JSON entity-body?
@@ -105,10 +108,7 @@ class Plating(object):
         @wraps(routing)
         def mydecorator(method):
             loader = TagLoader(content_template)
-            @routing
-            @wraps(method)
-            def mymethod(request, *args, **kw):
-                data = method(request, *args, **kw)
+            def present(data, request):
                 if _should_return_json(request):
                     json_data = self._defaults.copy()
                     json_data.update(data)
@@ -122,6 +122,13 @@ class Plating(object):
                                       b'text/html; charset=utf-8')
                     data[self.CONTENT] = loader.load()
                     return self._elementify(data)
+            @routing
+            @wraps(method)
+            def mymethod(request, *args, **kw):
+                data = maybeEnsureDeferred(method(request, *args, **kw))
+                if isinstance(data, Deferred):
+                    return data.addCallback(present, request)
+                return present(data, request)
             return method
         return mydecorator
 
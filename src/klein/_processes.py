@@ -0,0 +1,491 @@
+# -*- test-case-name: klein.test.test_processes -*-
+
+"""
+Running CPU-bound handlers in pools of worker processes.
+
+Worker processes run L{_main}.  They read pickled calls from their
+standard input, and write the pickled outcome of each to their standard
+output, both prefixed with their length.
+"""
+
+from __future__ import absolute_import, division
+
+import os
+import pickle
+import struct
+import sys
+import traceback
+
+from collections import deque
+
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python.failure import Failure
+
+from werkzeug.exceptions import GatewayTimeout, ServiceUnavailable
+
+
+__all__ = ["ProcessPool", "ProcessPoolFull", "ProcessTimeout"]
+
+
+
+_header = struct.Struct("!I")
+
+
+
+def _frame(data):
+    return _header.pack(len(data)) + data
+
+
+
+class ProcessTimeout(GatewayTimeout):
+    """
+    A call to a worker process took too long, and the worker was killed.
+    Unless an error handler deals with it, the request is answered with 504.
+
+    @ivar pool: The name of the process pool.
+    @type pool: L{unicode}
+
+    @ivar timeout: How long the call was allowed to take, in seconds.
+    @type timeout: L{float}
+    """
+
+    def __init__(self, pool, timeout):
+        GatewayTimeout.__init__(self)
+        self.pool = pool
+        self.timeout = timeout
+
+
+    def __repr__(self):
+        return "<ProcessTimeout(pool={0!r}, timeout={1!r})>".format(
+            self.pool, self.timeout)
+
+
+
+class ProcessPoolFull(ServiceUnavailable):
+    """
+    A call couldn't be made, because the queue of its process pool is full.
+    Unless an error handler deals with it, the request is answered with 503.
+
+    @ivar pool: The name of the process pool.
+    @type pool: L{unicode}
+
+    @ivar queue_depth: How many calls were waiting for a worker.
+    @type queue_depth: L{int}
+    """
+
+    def __init__(self, pool, queue_depth):
+        ServiceUnavailable.__init__(self)
+        self.pool = pool
+        self.queue_depth = queue_depth
+
+
+    def __repr__(self):
+        return "<ProcessPoolFull(pool={0!r}, queue_depth={1!r})>".format(
+            self.pool, self.queue_depth)
+
+
+
+class _Call(object):
+    """
+    A call waiting for, or running in, a worker process.
+    """
+
+    __slots__ = ["payload", "timeout", "deferred", "worker", "timer"]
+
+    def __init__(self, payload, timeout):
+        self.payload = payload
+        self.timeout = timeout
+        self.deferred = None
+        self.worker = None
+        self.timer = None
+
+
+
+class _Worker(ProcessProtocol):
+    """
+    The protocol talking to a worker process of a L{ProcessPool}.
+
+    @ivar tasks: How many calls the process has completed.
+    @type tasks: L{int}
+
+    @ivar call: The L{_Call} the process is running, if any.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._buffer = b""
+        self.tasks = 0
+        self.call = None
+        self.ended = Deferred()
+
+
+    def run(self, call):
+        """
+        Send C{call} to the process.
+        """
+        self.call = call
+        call.worker = self
+        self.transport.write(_frame(call.payload))
+
+
+    def retire(self):
+        """
+        Let the process exit once it has read every call sent to it.
+        """
+        self.transport.closeStdin()
+
+
+    def kill(self):
+        """
+        Kill the process.
+        """
+        try:
+            self.transport.signalProcess("KILL")
+        except ProcessExitedAlready:
+            pass
+
+
+    def outReceived(self, data):
+        self._buffer += data
+        while len(self._buffer) >= _header.size:
+            (length,) = _header.unpack(self._buffer[:_header.size])
+            end = _header.size + length
+            if len(self._buffer) < end:
+                return
+            outcome = self._buffer[_header.size:end]
+            self._buffer = self._buffer[end:]
+            call, self.call = self.call, None
+            if call is None:
+                # The call was discarded, and the process killed.
+                return
+            self.tasks += 1
+            self._pool._completed(self, call, outcome)
+
+
+    def processEnded(self, reason):
+        self._pool._ended(self, reason)
+        self.ended.callback(None)
+
+
+
+class ProcessPool(object):
+    """
+    A named pool of worker processes, running picklable functions.
+
+    Workers are started as calls need them, up to C{size} of them, and are
+    stopped when the reactor shuts down.  Calls beyond that wait for a
+    worker, up to C{max_queue} of them.  Functions and their arguments are
+    pickled to be sent to the workers, so functions must be defined at the
+    top level of a module the workers can import, and so must the classes
+    of their arguments, results and exceptions.
+
+    @ivar name: The name of the pool.
+    @type name: L{unicode}
+
+    @ivar size: The maximum number of worker processes.
+    @type size: L{int}
+
+    @ivar max_tasks: The number of calls after which a worker is replaced by
+        a new one, or C{None} to keep workers for as long as they live.
+    @type max_tasks: L{int}
+
+    @ivar timeout: How long calls may take by default, in seconds, before
+        their worker is killed, or C{None} to let them take as long as they
+        do.
+    @type timeout: L{float}
+
+    @ivar max_queue: The maximum number of calls waiting for a worker.
+    @type max_queue: L{int}
+    """
+
+    def __init__(self, name, size=None, max_tasks=None, timeout=None,
+                 max_queue=100, reactor=None):
+        """
+        @param name: The name of the pool.
+        @type name: L{unicode}
+
+        @param size: The maximum number of worker processes.  Defaults to the
+            number of CPUs.
+        @type size: L{int}
+
+        @param max_tasks: The number of calls after which a worker is
+            replaced by a new one.  Defaults to C{None}, which keeps workers
+            for as long as they live.
+        @type max_tasks: L{int}
+
+        @param timeout: How long calls may take by default, in seconds.
+            Defaults to C{None}, which lets them take as long as they do.
+        @type timeout: L{float}
+
+        @param max_queue: The maximum number of calls waiting for a worker.
+        @type max_queue: L{int}
+
+        @param reactor: The reactor spawning the worker processes.  Defaults
+            to the global reactor.
+        """
+        if size is None:
+            try:
+                from multiprocessing import cpu_count
+                size = cpu_count()
+            except (ImportError, NotImplementedError):
+                size = 2
+        self.name = name
+        self.size = size
+        self.max_tasks = max_tasks
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self._reactor = reactor
+        # Workers which can take calls, and every worker which hasn't exited.
+        self._workers = set()
+        self._processes = set()
+        self._idle = []
+        self._queue = deque()
+        self._shutdownTrigger = None
+
+
+    def configure(self, size=None, max_tasks=None, timeout=None,
+                  max_queue=None):
+        """
+        Change the settings of the pool.  Those which aren't given are left
+        alone.  Workers which are running already are not replaced.
+        """
+        if size is not None:
+            self.size = size
+        if max_tasks is not None:
+            self.max_tasks = max_tasks
+        if timeout is not None:
+            self.timeout = timeout
+        if max_queue is not None:
+            self.max_queue = max_queue
+
+
+    @property
+    def queue_depth(self):
+        """
+        How many calls are waiting for a worker.
+        """
+        return len(self._queue)
+
+
+    def _getReactor(self):
+        if self._reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+        return self._reactor
+
+
+    def submit(self, f, *args, **kwargs):
+        """
+        Call C{f} with C{args} and C{kwargs} in a worker process, allowing it
+        the default C{timeout} of the pool.
+
+        @raise pickle.PicklingError: If the call can't be pickled.
+
+        @raise ProcessPoolFull: If every worker is busy, and C{max_queue}
+            calls are waiting for one already.
+
+        @return: A L{Deferred} firing with the result of C{f}, or failing
+            with its exception, or with L{ProcessTimeout} if it took too long.
+            Cancelling it kills the worker running the call, if any.
+        """
+        return self.submit_with_timeout(self.timeout, f, *args, **kwargs)
+
+
+    def submit_with_timeout(self, timeout, f, *args, **kwargs):
+        """
+        Like L{submit}, allowing the call C{timeout} seconds, or as long as
+        it takes if C{timeout} is C{None}.
+        """
+        if (len(self._queue) >= self.max_queue and
+                not self._idle and len(self._workers) >= self.size):
+            raise ProcessPoolFull(self.name, len(self._queue))
+        call = _Call(pickle.dumps((f, args, kwargs), pickle.HIGHEST_PROTOCOL),
+                     timeout)
+        call.deferred = Deferred(lambda d: self._cancel(call))
+        self._queue.append(call)
+        self._dispatch()
+        return call.deferred
+
+
+    def _dispatch(self):
+        """
+        Send waiting calls to idle workers, starting workers if need be.
+        """
+        while self._queue and (self._idle or len(self._workers) < self.size):
+            if self._idle:
+                worker = self._idle.pop()
+            else:
+                worker = self._spawn()
+            call = self._queue.popleft()
+            if call.timeout is not None:
+                call.timer = self._getReactor().callLater(
+                    call.timeout, self._timedOut, call)
+            worker.run(call)
+
+
+    def _spawn(self):
+        reactor = self._getReactor()
+        if self._shutdownTrigger is None:
+            self._shutdownTrigger = reactor.addSystemEventTrigger(
+                "before", "shutdown", self.stop)
+        env = dict(os.environ)
+        # Workers need to import what the pickled calls refer to.
+        env["PYTHONPATH"] = os.pathsep.join(path for path in sys.path if path)
+        worker = _Worker(self)
+        reactor.spawnProcess(
+            worker, sys.executable,
+            [sys.executable, "-c",
+             "from {0} import _main; _main()".format(__name__)],
+            env=env, childFDs={0: "w", 1: "r", 2: 2})
+        self._workers.add(worker)
+        self._processes.add(worker)
+        return worker
+
+
+    def _completed(self, worker, call, outcome):
+        """
+        C{worker} answered C{call} with C{outcome}.
+        """
+        if self.max_tasks is not None and worker.tasks >= self.max_tasks:
+            self._workers.discard(worker)
+            worker.retire()
+        else:
+            self._idle.append(worker)
+
+        if call.timer is not None:
+            call.timer.cancel()
+        try:
+            outcome = pickle.loads(outcome)
+        except Exception:
+            call.deferred.errback()
+        else:
+            if outcome[0]:
+                call.deferred.callback(outcome[1])
+            else:
+                error = outcome[1]
+                error.remote_traceback = outcome[2]
+                call.deferred.errback(Failure(error))
+        self._dispatch()
+
+
+    def _discard(self, worker):
+        """
+        Kill C{worker}, whose call is not wanted anymore.
+        """
+        self._workers.discard(worker)
+        worker.call = None
+        worker.kill()
+        self._dispatch()
+
+
+    def _timedOut(self, call):
+        call.timer = None
+        self._discard(call.worker)
+        call.deferred.errback(ProcessTimeout(self.name, call.timeout))
+
+
+    def _cancel(self, call):
+        if call.timer is not None:
+            call.timer.cancel()
+            call.timer = None
+        if call.worker is None:
+            self._queue.remove(call)
+        else:
+            self._discard(call.worker)
+
+
+    def _ended(self, worker, reason):
+        """
+        The process of C{worker} ended.
+        """
+        self._workers.discard(worker)
+        self._processes.discard(worker)
+        if worker in self._idle:
+            self._idle.remove(worker)
+        call = worker.call
+        if call is not None:
+            # It died running a call.
+            worker.call = None
+            if call.timer is not None:
+                call.timer.cancel()
+            call.deferred.errback(reason)
+        self._dispatch()
+
+
+    def stop(self):
+        """
+        Stop every worker: idle ones once they have read every call sent to
+        them, and busy ones right away.  Calls waiting for a worker fail with
+        L{twisted.internet.defer.CancelledError}.
+
+        @return: A L{Deferred} firing once every worker has exited.
+        """
+        if self._shutdownTrigger is not None:
+            self._getReactor().removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        while self._queue:
+            self._queue[0].deferred.cancel()
+        for worker in list(self._workers):
+            if worker.call is None:
+                worker.retire()
+            else:
+                worker.call.deferred.cancel()
+        self._workers.clear()
+        del self._idle[:]
+        return DeferredList([worker.ended for worker in self._processes])
+
+
+
+def _readExactly(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+
+def _serve(calls, outcomes):
+    """
+    Run the calls read from C{calls}, and write their outcomes to
+    C{outcomes}, until C{calls} ends.
+    """
+    while True:
+        header = _readExactly(calls, _header.size)
+        if header is None:
+            return
+        payload = _readExactly(calls, _header.unpack(header)[0])
+        if payload is None:
+            return
+        try:
+            f, args, kwargs = pickle.loads(payload)
+            outcome = (True, f(*args, **kwargs))
+        except BaseException as e:
+            outcome = (False, e, traceback.format_exc())
+        try:
+            data = pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+            pickle.loads(data)
+        except Exception:
+            data = pickle.dumps(
+                (False, RuntimeError(
+                    "The outcome of the call could not be pickled: "
+                    "{0!r}".format(outcome[1])), traceback.format_exc()),
+                pickle.HIGHEST_PROTOCOL)
+        outcomes.write(_frame(data))
+        outcomes.flush()
+
+
+
+def _main():
+    # Keep standard input and output for the calls, so that the functions
+    # called writing or reading them don't corrupt what is exchanged.
+    calls = os.fdopen(os.dup(0), "rb")
+    outcomes = os.fdopen(os.dup(1), "wb")
+    os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+    os.dup2(2, 1)
+    _serve(calls, outcomes)
+
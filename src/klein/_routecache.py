@@ -0,0 +1,119 @@
+# -*- test-case-name: klein.test.test_routecache -*-
+
+"""
+Memoization of URL resolution results for L{klein.Klein}.
+"""
+
+from __future__ import absolute_import, division
+
+from collections import OrderedDict
+from copy import copy
+
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+
+
+__all__ = ["RouteCache"]
+
+
+
+class RouteCache(object):
+    """
+    A bounded, least-recently-used cache of the results of
+    C{werkzeug.routing.MapAdapter.match}.
+
+    Successful resolutions are stored as the matched rule and its converted
+    arguments.  Resolutions which failed with a C{NotFound} or
+    C{MethodNotAllowed} are stored as negative entries, and a fresh copy of the
+    exception is raised every time the entry is hit.  Resolutions to C{None}
+    and the methods the path allows, as returned by
+    L{klein._dispatch.RouteIndex.match}, are stored as they are.
+
+    @ivar maxsize: The maximum number of resolutions to remember.
+    @type maxsize: L{int}
+
+    @ivar hits: The number of lookups answered from the cache.
+    @type hits: L{int}
+
+    @ivar misses: The number of lookups which had to consult the mapper.
+    @type misses: L{int}
+
+    @ivar evictions: The number of entries discarded to stay within
+        C{maxsize}.
+    @type evictions: L{int}
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        @param maxsize: The maximum number of resolutions to remember.
+        @type maxsize: L{int}
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, not {0!r}"
+                             .format(maxsize))
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def clear(self):
+        """
+        Forget every cached resolution.  The counters are left untouched.
+        """
+        self._entries.clear()
+
+
+    def match(self, mapper, key, match=None):
+        """
+        Resolve the URL C{mapper} is bound to, consulting the cache first.
+
+        @param mapper: The adapter to match with on a cache miss.
+        @type mapper: C{werkzeug.routing.MapAdapter}
+
+        @param key: A hashable value which uniquely identifies everything
+            C{mapper} takes into account while matching; the host, script
+            name, path, method and URL scheme.
+
+        @param match: A one-argument callable which matches with C{mapper} on
+            a cache miss, returning the same as C{mapper.match} called with
+            C{return_rule=True}.  By default, C{mapper.match} itself.
+
+        @raise werkzeug.exceptions.HTTPException: If the URL does not resolve.
+
+        @return: A L{tuple} of the matched C{werkzeug.routing.Rule} and a
+            L{dict} of the converted arguments, or whatever else C{match}
+            returned.
+        """
+        entries = self._entries
+        try:
+            entry = entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            try:
+                if match is None:
+                    entry = mapper.match(return_rule=True)
+                else:
+                    entry = match(mapper)
+            except (NotFound, MethodNotAllowed) as e:
+                entry = (None, e)
+            entries[key] = entry
+            if len(entries) > self.maxsize:
+                entries.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+            entries[key] = entry
+
+        rule, result = entry
+        if rule is not None:
+            return rule, dict(result)
+        if isinstance(result, Exception):
+            # Copying drops the traceback of the previous raise, so that it
+            # doesn't grow with every hit.
+            raise copy(result)
+        return entry
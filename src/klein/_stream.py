@@ -0,0 +1,290 @@
+# -*- test-case-name: klein.test.test_stream -*-
+
+"""
+Streaming the chunks of iterables returned by handlers as response bodies.
+"""
+
+from __future__ import absolute_import, division
+
+from six.moves import builtins
+
+from twisted.internet import task
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.internet.interfaces import IPushProducer
+from twisted.python.compat import _PY3, unicode
+from twisted.python.failure import Failure
+
+from zope.interface import implementer
+
+
+__all__ = ["IterableProducer", "isStreamable"]
+
+
+
+# Asynchronous iterables are only streamed on versions of Python which have
+# them, since StopAsyncIteration is new in Python 3.5.
+_StopAsyncIteration = getattr(builtins, "StopAsyncIteration", None)
+
+# Views are written as they are on Python 3, without copying them.  The
+# transports of Python 2 join their buffers as str, which views aren't.
+_chunkTypes = (bytes, memoryview) if _PY3 else (bytes,)
+
+
+
+def isStreamable(result):
+    """
+    Is C{result}, the result of a handler, an iterable of chunks to stream?
+
+    Only iterators, like generators, and asynchronous iterables are
+    streamed.  Containers, such as strings, L{bytearray}s, lists and
+    dictionaries, are iterable too, but are returned as they are.
+    """
+    if _isAsyncIterable(result):
+        return True
+    try:
+        return iter(result) is result
+    except TypeError:
+        return False
+
+
+
+def _isAsyncIterable(result):
+    """
+    Is C{result} an asynchronous iterable, on a version of Python which has
+    them?
+    """
+    return _StopAsyncIteration is not None and hasattr(result, "__aiter__")
+
+
+
+def _drive(awaitable):
+    """
+    Drive C{awaitable}, such as the result of an asynchronous iterator's
+    C{__anext__}, without requiring C{async def} syntax.
+
+    It may await L{Deferred}s, and, if an asyncio reactor is running,
+    asyncio futures.
+
+    @return: A L{Deferred} firing with the result of C{awaitable}.  Cancelling
+        it cancels the L{Deferred} C{awaitable} is waiting for.
+    """
+    iterator = awaitable.__await__()
+    waiting = [None]
+
+    def cancel(result):
+        if waiting[0] is not None:
+            waiting[0].cancel()
+
+    result = Deferred(cancel)
+
+    def resume(outcome):
+        # Like inlineCallbacks, hand the result of a Deferred to what awaits
+        # it, or raise its failure there.
+        if isinstance(outcome, Failure):
+            step(lambda: outcome.throwExceptionIntoGenerator(iterator))
+        else:
+            step(lambda: iterator.send(outcome))
+
+    def step(send):
+        while True:
+            waiting[0] = None
+            try:
+                yielded = send()
+            except StopIteration as e:
+                result.callback(getattr(e, "value", None))
+                return
+            except BaseException:
+                result.errback(Failure())
+                return
+
+            if isinstance(yielded, Deferred):
+                waiting[0] = yielded
+                yielded.addBoth(resume)
+            elif hasattr(yielded, "add_done_callback"):
+                waiting[0] = yielded
+                yielded.add_done_callback(
+                    lambda _: step(lambda: iterator.send(None)))
+            else:
+                error = TypeError(
+                    "Streamed responses can only await Deferreds and asyncio "
+                    "futures, not {0!r}.".format(yielded))
+                send = lambda: iterator.throw(error)
+                continue
+            return
+
+    step(lambda: iterator.send(None))
+    return result
+
+
+
+@implementer(IPushProducer)
+class IterableProducer(object):
+    """
+    Write the chunks of an iterable, or an asynchronous iterable, to a
+    request as its transport asks for them.
+
+    The iterable is consumed by a cooperative task, one chunk at a time, so
+    that other requests are served in between.  The task pauses whenever the
+    transport buffer of the request is full, and while an asynchronous
+    iterable is producing its next chunk.  Chunks which are text are encoded
+    as UTF-8, and on Python 3 chunks may be L{memoryview}s too.
+
+    @ivar written: Whether any chunk has been written yet.
+    @type written: L{bool}
+    """
+
+    def __init__(self, request, iterable, cooperate=task.cooperate):
+        """
+        @param request: The request to write the chunks to.
+        @type request: L{twisted.web.iweb.IRequest}
+
+        @param iterable: An iterable, or asynchronous iterable, of L{bytes}
+            or L{unicode}.
+
+        @param cooperate: The function scheduling the task consuming
+            C{iterable}, like L{twisted.internet.task.cooperate}.
+        """
+        self._request = request
+        self._asynchronous = _isAsyncIterable(iterable)
+        if self._asynchronous:
+            self._iterator = iterable.__aiter__()
+        else:
+            self._iterator = iter(iterable)
+        self._cooperate = cooperate
+        self._task = None
+        self._waiting = None
+        self._exhausted = False
+        self._paused = False
+        self._stopped = False
+        self._done = Deferred(lambda d: self.stopProducing())
+        self.written = False
+
+
+    def start(self):
+        """
+        Register with the request, and start writing the chunks.
+
+        @return: A L{Deferred} firing with C{None} when every chunk has been
+            written, or failing if the iterable does.  Cancelling it stops
+            the iteration.  The request is left to be finished by the caller.
+        """
+        self._request.registerProducer(self, True)
+        self._task = self._cooperate(self._chunks())
+        if self._paused:
+            self._task.pause()
+        self._task.whenDone().addCallbacks(self._completed, self._failed)
+        return self._done
+
+
+    def _chunks(self):
+        """
+        Write one chunk at every iteration.
+        """
+        if self._asynchronous:
+            while not self._exhausted:
+                # The task waits for the next chunk with a Deferred of its
+                # own, which is left alone if the task is stopped meanwhile.
+                proceed = Deferred()
+                self._waiting = _drive(self._iterator.__anext__())
+                self._waiting.addCallbacks(self._write, self._stopAsync)
+                self._waiting.addBoth(self._proceed, proceed)
+                yield proceed
+        else:
+            for chunk in self._iterator:
+                self._write(chunk)
+                yield None
+
+
+    def _write(self, chunk):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode("utf-8")
+        if not isinstance(chunk, _chunkTypes):
+            raise TypeError(
+                "Streamed chunks must be bytes or text, not {0!r}."
+                .format(chunk))
+        self.written = True
+        self._request.write(chunk)
+
+
+    def _proceed(self, result, proceed):
+        self._waiting = None
+        if not self._stopped:
+            proceed.callback(result)
+
+
+    def _stopAsync(self, failure):
+        failure.trap(_StopAsyncIteration)
+        self._exhausted = True
+
+
+    def _unregister(self):
+        self._request.unregisterProducer()
+
+
+    def _completed(self, ignored):
+        self._unregister()
+        if not self._done.called:
+            self._done.callback(None)
+
+
+    def _failed(self, failure):
+        self._unregister()
+        if failure.check(task.TaskStopped):
+            self._stopped = True
+            self._close()
+            if not self._done.called:
+                self._done.errback(CancelledError())
+        elif not self._done.called:
+            self._done.errback(failure)
+
+
+    def _close(self):
+        """
+        Let the iterable clean up after being stopped early.
+        """
+        if self._waiting is not None:
+            self._waiting.cancel()
+        if self._asynchronous:
+            if hasattr(self._iterator, "aclose"):
+                _drive(self._iterator.aclose()).addErrback(lambda f: None)
+        elif hasattr(self._iterator, "close"):
+            self._iterator.close()
+
+
+    def pauseProducing(self):
+        """
+        Stop writing chunks until L{resumeProducing} is called.
+        """
+        if self._paused:
+            return
+        self._paused = True
+        if self._task is not None:
+            try:
+                self._task.pause()
+            except task.TaskFinished:
+                pass
+
+
+    def resumeProducing(self):
+        """
+        Write chunks again.
+        """
+        if not self._paused:
+            return
+        self._paused = False
+        if self._task is not None:
+            try:
+                self._task.resume()
+            except task.NotPaused:
+                pass
+
+
+    def stopProducing(self):
+        """
+        Stop iterating for good, because the request has gone away.
+        """
+        if self._task is not None:
+            try:
+                self._task.stop()
+            except task.TaskFinished:
+                pass
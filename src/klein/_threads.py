@@ -0,0 +1,218 @@
+# -*- test-case-name: klein.test.test_threads -*-
+
+"""
+Running blocking handlers in bounded pools of threads.
+"""
+
+from __future__ import absolute_import, division
+
+import math
+import threading
+
+from twisted.internet.defer import Deferred
+from twisted.python.threadpool import ThreadPool
+
+from werkzeug.exceptions import ServiceUnavailable
+
+from klein._timing import _clock
+
+
+__all__ = ["HandlerThreadPool", "ThreadPoolFull"]
+
+
+
+class ThreadPoolFull(ServiceUnavailable):
+    """
+    A handler couldn't be run, because the queue of its thread pool is full.
+    Unless an error handler deals with it, the request is answered with 503,
+    saying how many calls were waiting and for how long, and a
+    C{Retry-After} header.
+
+    @ivar pool: The name of the thread pool.
+    @type pool: L{unicode}
+
+    @ivar queue_depth: How many calls were waiting for a thread.
+    @type queue_depth: L{int}
+
+    @ivar wait_time: How long calls recently waited for a thread, in
+        seconds.
+    @type wait_time: L{float}
+
+    @ivar retry_after: After how many seconds clients should try again: the
+        wait time rounded up, and at least 1.
+    @type retry_after: L{int}
+    """
+
+    def __init__(self, pool, queue_depth, wait_time):
+        ServiceUnavailable.__init__(
+            self, u"{0} calls are waiting for a thread of the pool {1}, "
+            u"for {2:.3f} seconds recently.".format(queue_depth, pool,
+                                                   wait_time))
+        self.pool = pool
+        self.queue_depth = queue_depth
+        self.wait_time = wait_time
+        self.retry_after = max(int(math.ceil(wait_time)), 1)
+
+
+    def get_headers(self, *args, **kwargs):
+        # werkzeug 2 and later pass a scope along with the environ.
+        headers = ServiceUnavailable.get_headers(self, *args, **kwargs)
+        headers.append(("Retry-After", str(self.retry_after)))
+        return headers
+
+
+    def __repr__(self):
+        return "<ThreadPoolFull(pool={0!r}, queue_depth={1!r}, " \
+            "wait_time={2!r})>".format(self.pool, self.queue_depth,
+                                       self.wait_time)
+
+
+
+class HandlerThreadPool(object):
+    """
+    A named pool of threads running handlers, with a bounded queue of calls
+    waiting for a thread.
+
+    The threads are started with the first call, and stopped when the
+    reactor shuts down.
+
+    @ivar name: The name of the pool, and of its threads.
+    @type name: L{unicode}
+
+    @ivar max_threads: The maximum number of threads.
+    @type max_threads: L{int}
+
+    @ivar max_queue: The maximum number of calls waiting for a thread.
+    @type max_queue: L{int}
+
+    @ivar queue_depth: How many calls are waiting for a thread.
+    @type queue_depth: L{int}
+
+    @ivar wait_time: How long calls recently waited for a thread, in
+        seconds: a moving average giving the most recent calls the most
+        weight.
+    @type wait_time: L{float}
+    """
+
+    # The weight of the most recent call in the average wait time.
+    _smoothing = 0.2
+
+    def __init__(self, name, max_threads=10, max_queue=100, reactor=None):
+        """
+        @param name: The name of the pool.
+        @type name: L{unicode}
+
+        @param max_threads: The maximum number of threads.
+        @type max_threads: L{int}
+
+        @param max_queue: The maximum number of calls waiting for a thread.
+        @type max_queue: L{int}
+
+        @param reactor: The reactor results are delivered to.  Defaults to
+            the global reactor.
+        """
+        self.name = name
+        self.max_queue = max_queue
+        self.queue_depth = 0
+        self.wait_time = 0.0
+        self._pool = ThreadPool(0, max_threads, name)
+        self._lock = threading.Lock()
+        self._reactor = reactor
+        self._shutdownTrigger = None
+
+
+    @property
+    def max_threads(self):
+        return self._pool.max
+
+
+    def resize(self, max_threads=None, max_queue=None):
+        """
+        Change the bounds of the pool.  Those which aren't given are left
+        alone.
+
+        @param max_threads: The maximum number of threads.
+        @type max_threads: L{int}
+
+        @param max_queue: The maximum number of calls waiting for a thread.
+        @type max_queue: L{int}
+        """
+        if max_threads is not None:
+            self._pool.adjustPoolsize(0, max_threads)
+        if max_queue is not None:
+            self.max_queue = max_queue
+
+
+    def _getReactor(self):
+        if self._reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+        return self._reactor
+
+
+    def _start(self):
+        self._pool.start()
+        self._shutdownTrigger = self._getReactor().addSystemEventTrigger(
+            "during", "shutdown", self.stop)
+
+
+    def stop(self):
+        """
+        Stop the threads, once they are done with the calls they are
+        running.  They are started again by the next call.
+        """
+        if self._shutdownTrigger is not None:
+            self._getReactor().removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        if self._pool.started:
+            self._pool.stop()
+            # Stopped thread pools can't be started again.
+            self._pool = ThreadPool(0, self._pool.max, self.name)
+
+
+    def submit(self, f, *args, **kwargs):
+        """
+        Call C{f} with C{args} and C{kwargs} in one of the threads.
+
+        @raise ThreadPoolFull: If C{max_queue} calls are waiting for a thread
+            already.
+
+        @return: A L{Deferred} firing in the reactor thread with the result
+            of C{f}.  Cancelling it before C{f} is called means C{f} won't be
+            called; after that, its result is ignored.
+        """
+        with self._lock:
+            if self.queue_depth >= self.max_queue:
+                raise ThreadPoolFull(self.name, self.queue_depth,
+                                     self.wait_time)
+            self.queue_depth += 1
+        if self._shutdownTrigger is None:
+            self._start()
+
+        reactor = self._getReactor()
+        cancelled = []
+        submitted = _clock()
+        d = Deferred(lambda d: cancelled.append(True))
+
+        def call():
+            waited = _clock() - submitted
+            with self._lock:
+                self.queue_depth -= 1
+                self.wait_time += self._smoothing * (waited - self.wait_time)
+            if cancelled:
+                return None
+            return f(*args, **kwargs)
+
+        def deliver(success, result):
+            if d.called:
+                return
+            if success:
+                d.callback(result)
+            else:
+                d.errback(result)
+
+        self._pool.callInThreadWithCallback(
+            lambda success, result: reactor.callFromThread(
+                deliver, success, result),
+            call)
+        return d
@@ -0,0 +1,285 @@
+# -*- test-case-name: klein.test.test_timing -*-
+
+"""
+Timing the phases of handling requests.
+"""
+
+from __future__ import absolute_import, division
+
+from bisect import bisect_left
+
+from twisted.internet.defer import Deferred
+from twisted.python import log
+
+from zope.interface import implementer
+
+from klein.interfaces import ITimingSink
+
+try:
+    from time import monotonic as _clock
+except ImportError:
+    # Python 2 has no monotonic clock.
+    from time import time as _clock
+
+
+__all__ = ["Histogram", "HistogramTimingSink", "LogTimingSink", "PHASES"]
+
+
+
+# The phases of handling a request, in order.
+EXTRACT = "extract"
+BIND = "bind"
+MATCH = "match"
+HANDLER = "handler"
+PROCESS = "process"
+ERROR = "error"
+WRITE = "write"
+
+PHASES = (EXTRACT, BIND, MATCH, HANDLER, PROCESS, ERROR, WRITE)
+
+# Upper bounds of the buckets of a histogram of durations, in seconds.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+
+class _RequestTimer(object):
+    """
+    The durations of the phases of handling one request, recorded one after
+    the other and reported to the timing sinks of an app once the request
+    has been answered, as well as to its L{klein.Metrics}, if any.
+
+    @ivar endpoint: The name of the endpoint the request was routed to, or
+        C{None} if it wasn't.
+    @type endpoint: L{str}
+
+    @ivar timings: The phases timed so far, and their durations in seconds,
+        or C{None} if there are no sinks to report them to.
+    @type timings: L{list} of L{tuple} of L{str} and L{float}
+    """
+
+    __slots__ = ["endpoint", "timings", "_sinks", "_metrics", "_request",
+                 "_endpointMetrics", "_phase", "_started", "_began"]
+
+    def __init__(self, sinks, metrics=None, request=None):
+        """
+        @param sinks: The L{ITimingSink}s to report to.
+        @type sinks: L{list}
+
+        @param metrics: The metrics to count the request in, if any.
+        @type metrics: L{klein.Metrics}
+
+        @param request: The request being timed, whose response code is
+            counted in C{metrics}.
+        @type request: L{twisted.web.iweb.IRequest}
+        """
+        self.endpoint = None
+        self.timings = [] if sinks else None
+        self._sinks = sinks
+        self._metrics = metrics
+        self._request = request
+        self._endpointMetrics = None
+        self._phase = None
+        self._started = None
+        self._began = _clock() if metrics is not None else None
+
+
+    def start(self, phase):
+        """
+        Stop timing the current phase, if any, and start timing C{phase}.
+        """
+        if self.timings is None:
+            return
+        now = _clock()
+        if self._phase is not None:
+            self.timings.append((self._phase, now - self._started))
+        self._phase = phase
+        self._started = now
+
+
+    def stop(self, result=None):
+        """
+        Stop timing the current phase, if any.
+
+        @return: C{result}, so that this can be added as a callback.
+        """
+        if self._phase is not None:
+            self.timings.append((self._phase, _clock() - self._started))
+            self._phase = None
+        return result
+
+
+    def timed(self, phase, f, *args):
+        """
+        Call C{f} with C{args}, timing it as C{phase}.  If it returns a
+        L{Deferred}, the phase lasts until that fires.
+        """
+        if self.timings is None:
+            return f(*args)
+        self.start(phase)
+        try:
+            result = f(*args)
+        except BaseException:
+            self.stop()
+            raise
+        if isinstance(result, Deferred):
+            return result.addBoth(self.stop)
+        self.stop()
+        return result
+
+
+    def routed(self, endpoint):
+        """
+        Note that the request was routed to C{endpoint}.
+        """
+        self.endpoint = endpoint
+        if self._metrics is not None:
+            self._endpointMetrics = self._metrics._routed(endpoint)
+
+
+    def report(self, result=None):
+        """
+        Report the timings to every sink, and count the request in the
+        metrics.  Sinks failing are logged.
+
+        @return: C{result}, so that this can be added as a callback.
+        """
+        if self._metrics is not None:
+            self._metrics._answered(self._endpointMetrics,
+                                    self._request.code,
+                                    _clock() - self._began)
+        if self.timings is None:
+            return result
+        self.stop()
+        for sink in self._sinks:
+            try:
+                sink.record(self.endpoint, self.timings)
+            except Exception:
+                log.err(None, "Unhandled Error recording timings")
+        return result
+
+
+
+def _timed(timer, phase, f, *args):
+    """
+    Call C{f} with C{args}, timing it as C{phase} with C{timer} unless it is
+    C{None}.
+    """
+    if timer is None:
+        return f(*args)
+    return timer.timed(phase, f, *args)
+
+
+
+def _timedCallback(result, timer, phase, f, *args):
+    """
+    Like L{_timed}, as a callback of a L{Deferred}: C{f} is called with
+    C{result} and C{args}.
+    """
+    return _timed(timer, phase, f, result, *args)
+
+
+
+class Histogram(object):
+    """
+    Counts of observed values, in buckets with fixed upper bounds.
+
+    @ivar bounds: The inclusive upper bound of every bucket but the last,
+        which counts whatever is larger.
+    @type bounds: L{tuple} of L{float}
+
+    @ivar counts: The number of values observed in every bucket.
+    @type counts: L{list} of L{int}
+
+    @ivar count: The number of values observed.
+    @type count: L{int}
+
+    @ivar total: The sum of the values observed.
+    @type total: L{float}
+    """
+
+    __slots__ = ["bounds", "counts", "count", "total"]
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        """
+        @param bounds: The upper bounds of the buckets, in increasing order.
+        @type bounds: L{tuple} of L{float}
+        """
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+
+    def observe(self, value):
+        """
+        Count C{value} in its bucket.
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+
+    def cumulative(self):
+        """
+        @return: The number of values observed up to the upper bound of every
+            bucket, including the last one.
+        @rtype: L{list} of L{int}
+        """
+        counts = []
+        running = 0
+        for count in self.counts:
+            running += count
+            counts.append(running)
+        return counts
+
+
+
+@implementer(ITimingSink)
+class HistogramTimingSink(object):
+    """
+    Keep a L{Histogram} of the durations of every phase of every endpoint in
+    memory.
+
+    @ivar histograms: The histograms, by endpoint name and phase.  Requests
+        which weren't routed to an endpoint are counted under C{None}.
+    @type histograms: L{dict} mapping L{tuple} of L{str} and L{str} to
+        L{Histogram}
+    """
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        """
+        @param bounds: The upper bounds of the buckets of the histograms, in
+            seconds.
+        @type bounds: L{tuple} of L{float}
+        """
+        self._bounds = tuple(bounds)
+        self.histograms = {}
+
+
+    def record(self, endpoint, timings):
+        """
+        Observe every duration of C{timings} in its histogram.
+        """
+        for phase, duration in timings:
+            histogram = self.histograms.get((endpoint, phase))
+            if histogram is None:
+                histogram = self.histograms[endpoint, phase] = Histogram(
+                    self._bounds)
+            histogram.observe(duration)
+
+
+
+@implementer(ITimingSink)
+class LogTimingSink(object):
+    """
+    Log the timings of every request, in milliseconds, on one line.
+    """
+
+    def record(self, endpoint, timings):
+        """
+        Log C{timings}.
+        """
+        log.msg("Timings of {0}: {1}".format(
+            endpoint, " ".join("{0}={1:.3f}ms".format(phase, duration * 1000)
+                               for phase, duration in timings)))
@@ -0,0 +1,199 @@
+# -*- test-case-name: klein.test.test_urlbuilder -*-
+
+"""
+URL building which remembers which rule builds the URLs of an endpoint.
+"""
+
+from __future__ import absolute_import, division
+
+from werkzeug.datastructures import MultiDict
+from werkzeug.routing import Map, Rule
+
+try:
+    from werkzeug.urls import url_join
+except ImportError:
+    # werkzeug 3 dropped url_join, long after building stopped using it.
+    url_join = None
+
+
+__all__ = ["URLBuilder"]
+
+
+
+def _joinsInternalURLs():
+    """
+    Does C{MapAdapter.build} join the paths of the URLs it builds for the
+    adapter's own host to its script name with C{url_join}, which resolves
+    any dot segments in them, rather than just putting the script name in
+    front?  Versions of werkzeug before 0.15 do.
+    """
+    mapper = Map([Rule(u"/<path:rest>", endpoint="rest")]).bind(u"", u"/")
+    return mapper.build("rest", {"rest": u"a/../b"}) != u"/a/../b"
+
+_joinsInternal = url_join is not None and _joinsInternalURLs()
+
+
+
+class URLBuilder(object):
+    """
+    Build URLs exactly like C{werkzeug.routing.MapAdapter.build}, but without
+    looking for a suitable rule every time.
+
+    For each map, endpoint, method and set of argument names, the rule
+    C{build} would use is found once, and URLs are then assembled by the
+    rule directly, behind the prefix C{build} would put in front of them for
+    the adapter's host, script name and URL scheme.  Endpoints with rules
+    which have defaults, argument values given as a C{MultiDict}, and rules
+    failing to build the given values are left to C{build}.
+
+    The remembered rules must be discarded with L{invalidate} when rules are
+    added to the map.
+
+    @ivar maxsize: The maximum number of remembered rules, and of remembered
+        prefixes.
+    @type maxsize: L{int}
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._rules = {}
+        self._prefixes = {}
+
+
+    def invalidate(self):
+        """
+        Forget which rules build which URLs.
+        """
+        self._rules.clear()
+        self._prefixes.clear()
+
+
+    def _rule(self, mapper, endpoint, method, names):
+        """
+        Find the rule C{mapper.build} would try first.
+
+        @param names: The names of the arguments.
+        @type names: L{frozenset}
+
+        @return: A C{werkzeug.routing.Rule}, or C{None} if there is no
+            suitable rule or the endpoint's rules have defaults.
+        """
+        key = (mapper.map, endpoint, method, mapper.default_method, names)
+        try:
+            return self._rules[key]
+        except KeyError:
+            pass
+
+        found = None
+        mapper.map.update()
+        rules = mapper.map._rules_by_endpoint.get(endpoint, ())
+        if not any(rule.defaults for rule in rules):
+            if method is None:
+                methods = [mapper.default_method, None]
+            else:
+                methods = [method]
+            for candidateMethod in methods:
+                for rule in rules:
+                    if (candidateMethod is not None and
+                            rule.methods is not None and
+                            candidateMethod not in rule.methods):
+                        continue
+                    if rule.arguments.issubset(names):
+                        found = rule
+                        break
+                if found is not None:
+                    break
+
+        if len(self._rules) >= self.maxsize:
+            self._rules.clear()
+        self._rules[key] = found
+        return found
+
+
+    def _prefix(self, mapper, domain_part, force_external):
+        """
+        Find what C{mapper.build} puts in front of the paths of the URLs it
+        builds for rules building C{domain_part}.
+
+        @return: A L{tuple} of the prefix, and whether the URL is external.
+        """
+        key = (domain_part, force_external, mapper.map.host_matching,
+               mapper.server_name,
+               mapper.subdomain, mapper.script_name, mapper.url_scheme)
+        try:
+            return self._prefixes[key]
+        except KeyError:
+            pass
+
+        host = mapper.get_host(domain_part)
+        if not force_external and (
+            (mapper.map.host_matching and host == mapper.server_name) or
+            (not mapper.map.host_matching and
+             domain_part == mapper.subdomain)
+        ):
+            prefix = (mapper.script_name.rstrip("/") + "/", False)
+        else:
+            prefix = ("%s//%s%s/" % (
+                mapper.url_scheme + ":" if mapper.url_scheme else "",
+                host,
+                mapper.script_name[:-1],
+            ), True)
+
+        if len(self._prefixes) >= self.maxsize:
+            self._prefixes.clear()
+        self._prefixes[key] = prefix
+        return prefix
+
+
+    def build(self, mapper, endpoint, values=None, method=None,
+              force_external=False, append_unknown=True):
+        """
+        Build a URL, with the same arguments and result as
+        C{mapper.build}.
+
+        @param mapper: The adapter to build the URL for.
+        @type mapper: C{werkzeug.routing.MapAdapter}
+
+        @raise werkzeug.routing.BuildError: If no URL can be built.
+
+        @rtype: L{str}
+        """
+        if isinstance(values, MultiDict):
+            return mapper.build(endpoint, values, method, force_external,
+                                append_unknown)
+
+        if values:
+            built = dict((name, value) for (name, value) in values.items()
+                         if value is not None)
+        else:
+            built = {}
+
+        rule = self._rule(mapper, endpoint, method, frozenset(built))
+        rv = None
+        if rule is not None:
+            rv = rule.build(built, append_unknown)
+        if rv is None or len(rv) != 2:
+            return mapper.build(endpoint, values, method, force_external,
+                                append_unknown)
+
+        domain_part, path = rv
+        prefix, external = self._prefix(mapper, domain_part, force_external)
+        if external:
+            return str(prefix + path.lstrip("/"))
+        if _joinsInternal:
+            return str(url_join(mapper.script_name, "./" + path.lstrip("/")))
+        return prefix + path.lstrip("/")
+
+
+    def build_many(self, mapper, endpoint, many_values, method=None,
+                   force_external=False, append_unknown=True):
+        """
+        Build a URL for each of C{many_values}.
+
+        @param many_values: An iterable of the values to build URLs with.
+
+        @return: A L{list} of the URLs, in the same order.
+        """
+        return [self.build(mapper, endpoint, values, method, force_external,
+                           append_unknown)
+                for values in many_values]
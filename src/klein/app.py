@@ -10,7 +10,7 @@ import weakref
 from collections import namedtuple
 from contextlib import contextmanager
 
-from functools import wraps
+from functools import partial, wraps
 
 from werkzeug.routing import Map, Rule, Submount
 
@@ -24,15 +24,31 @@ from zope.interface import implementer
 
 from klein.resource import KleinResource
 from klein.interfaces import IKleinRequest
+from klein._body import (
+    RequestBody, StreamingRequest, _SharedResult, _decodeJSON, _limitBody)
+from klein._cache import CachePolicy, ResponseCache, _cachingCall
+from klein._compression import Compression
+from klein._conditional import _notModified
+from klein._coroutines import maybeEnsureDeferred
+from klein._deadlines import _callWithDeadline
+from klein._dispatch import RouteIndex, werkzeugMatch
+from klein._limits import ConcurrencyLimit
+from klein._multipart import _parseForm
+from klein._processes import ProcessPool
+from klein._routecache import RouteCache
+from klein._threads import HandlerThreadPool
+from klein._urlbuilder import URLBuilder
 
 __all__ = ['Klein', 'run', 'route', 'resource']
 
 
 def _call(instance, f, *args, **kwargs):
     if instance is None:
-        return f(*args, **kwargs)
+        result = f(*args, **kwargs)
+    else:
+        result = f(instance, *args, **kwargs)
 
-    return f(instance, *args, **kwargs)
+    return maybeEnsureDeferred(result)
 
 
 @implementer(IKleinRequest)
@@ -41,14 +57,138 @@ class KleinRequest(object):
     def __init__(self, request):
         self.branch_segments = ['']
         self.mapper = None
+        self.url_builder = None
+        self.deadline = None
+        self.clock = None
+        self._cache = None
+        self._body = None
+        self._form = None
+        self._json = None
+        self._request = request
 
-    def url_for(self, *args, **kwargs):
-        return self.mapper.build(*args, **kwargs)
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = getattr(self._request, "_requestBody", None)
+            if self._body is None:
+                self._body = RequestBody._fromContent(self._request.content)
+        return self._body
+
+    def form(self, spool_size=2 ** 20):
+        if self._form is None:
+            self._form = _SharedResult(
+                _parseForm(self._request, self.body, spool_size))
+        return self._form.result()
+
+    def json(self, max_size=None, decoder=None):
+        if self._json is None:
+            self._json = _SharedResult(
+                _decodeJSON(self._request, self.body, max_size, decoder))
+        return self._json.result()
+
+    def remaining_time(self):
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - self.clock.seconds())
+
+    def not_modified(self, version=None, last_modified=None, weak=False):
+        return _notModified(self._request, version, last_modified, weak)
+
+    def _qualify(self, endpoint):
+        """
+        Find the name C{endpoint} has in the routing table of the request:
+        that of a route added by default within a L{Klein.host} block is
+        qualified with its host name.
+        """
+        url_map = self.mapper.map
+        prefix = getattr(url_map, "klein_endpoint_prefix", None)
+        if prefix is not None:
+            qualified = prefix + endpoint
+            if qualified in url_map._rules_by_endpoint:
+                return qualified
+        return endpoint
+
+    def url_for(self, endpoint, values=None, method=None,
+                force_external=False, append_unknown=True):
+        endpoint = self._qualify(endpoint)
+        if self.url_builder is None:
+            return self.mapper.build(endpoint, values, method, force_external,
+                                     append_unknown)
+        return self.url_builder.build(self.mapper, endpoint, values, method,
+                                      force_external, append_unknown)
+
+    def url_for_many(self, endpoint, many_values, method=None,
+                     force_external=False, append_unknown=True):
+        endpoint = self._qualify(endpoint)
+        if self.url_builder is None:
+            return [self.mapper.build(endpoint, values, method,
+                                      force_external, append_unknown)
+                    for values in many_values]
+        return self.url_builder.build_many(self.mapper, endpoint, many_values,
+                                           method, force_external,
+                                           append_unknown)
 
 
 registerAdapter(KleinRequest, Request, IKleinRequest)
 
 
+
+class _RoutingState(object):
+    """
+    The routing state of a L{Klein}, shared with the instances bound from it
+    through L{Klein.__get__}.
+
+    @ivar frozen: Whether the routing table has been frozen with
+        L{Klein.freeze}.
+    @type frozen: L{bool}
+
+    @ivar segment_counts: A L{dict} mapping endpoint names to the number of
+        path segments their route consumes, computed when the routing table
+        is frozen, or C{None} if it isn't.
+    """
+
+    def __init__(self):
+        self.frozen = False
+        self.segment_counts = None
+
+
+
+class _VirtualHost(object):
+    """
+    The routing table of a host name added to with L{Klein.host}.
+
+    @ivar url_map: The C{werkzeug.routing.Map} of the host's routes.  Its
+        C{klein_endpoint_prefix} qualifies the default endpoints of the
+        host's routes, so that they don't clash with those of other hosts.
+    @ivar route_index: A L{RouteIndex} of C{url_map} used for matching, or
+        C{None} if the map is matched directly.
+    """
+
+    def __init__(self, hostname, indexed_routing):
+        self.url_map = Map()
+        self.url_map.klein_endpoint_prefix = hostname + u":"
+        self.route_index = None
+        if indexed_routing:
+            self.route_index = RouteIndex(self.url_map)
+
+
+
+def _hostname(server_name):
+    """
+    Normalize the host name of C{server_name}, which may include a port, for
+    looking up the virtual host serving it.
+
+    @type server_name: L{unicode}
+
+    @rtype: L{unicode}
+    """
+    host, sep, port = server_name.rpartition(u":")
+    if sep and port.isdigit() and (u":" not in host or host.endswith(u"]")):
+        server_name = host
+    return server_name.lower()
+
+
+
 class Klein(object):
     """
     L{Klein} is an object which is responsible for maintaining the routing
@@ -57,15 +197,130 @@ class Klein(object):
     @ivar _url_map: A C{werkzeug.routing.Map} object which will be used for
         routing resolution.
     @ivar _endpoints: A C{dict} mapping endpoint names to handler functions.
+    @ivar _error_handlers: A C{list} of the C{list}s of exception types and
+        the error handlers registered with L{Klein.handle_errors}, in order.
+    @ivar _error_dispatch: A C{dict} caching the result of
+        L{Klein._error_handlers_for} for each exception type.
+    @ivar _route_cache: A L{RouteCache} memoizing URL resolution, or C{None}
+        if resolution results are not cached.
+    @ivar _route_index: A L{RouteIndex} of C{_url_map} used for matching, or
+        C{None} if the map is matched directly.
+    @ivar _hosts: A L{dict} mapping host names to the L{_VirtualHost}s
+        added with L{Klein.host}.
+    @ivar _endpoint_prefix: What qualifies the default endpoints of the
+        routes added, that of the host within a L{Klein.host} block.
+    @ivar _routing: The L{_RoutingState} of the routing table.
+    @ivar _url_builder: The L{URLBuilder} building URLs for the requests
+        this app handles.
+    @ivar _timing_sinks: A C{list} of the timing sinks added with
+        L{Klein.add_timing_sink}.
+    @ivar _metrics: The L{klein.Metrics} counting the requests of this app,
+        or C{None}.
+    @ivar _thread_pools: A C{dict} mapping names to the L{HandlerThreadPool}s
+        of L{Klein.thread_pool}.
+    @ivar _process_pools: A C{dict} mapping names to the L{ProcessPool}s of
+        L{Klein.process_pool}.
+    @ivar _concurrency_limits: A C{dict} mapping names to the
+        L{ConcurrencyLimit}s of L{Klein.concurrency_limit}.
+    @ivar _response_cache: The L{ResponseCache} of the routes added with a
+        C{cache}.
+    @ivar _etags: Whether to tag buffered responses with the hash of their
+        body: C{False}, C{True} for strong entity tags, or C{"weak"}.
+    @ivar _compression: The L{klein.Compression} of the responses, or
+        C{None}.
+    @ivar _timeout: The default timeout of handlers, in seconds, or C{None}.
+    @ivar _max_body_size: The default size of the largest request bodies
+        accepted, in bytes, or C{None}.
+    @ivar _clock: The L{twisted.internet.interfaces.IReactorTime} measuring
+        the deadlines of handlers.
     """
 
     _bound_klein_instances = weakref.WeakKeyDictionary()
 
-    def __init__(self):
+    def __init__(self, route_cache_size=None, indexed_routing=False,
+                 automatic_options=False, metrics=None, timeout=None,
+                 etags=False, compression=None, max_body_size=None):
+        """
+        @param route_cache_size: If not C{None}, the number of URL resolution
+            results to keep in a least-recently-used cache in front of
+            C{werkzeug} matching.  Defaults to C{None}, which disables the
+            cache.
+        @type route_cache_size: L{int}
+
+        @param indexed_routing: If C{True}, index the routing table by the
+            literal path segments of its rules, and by method, so that
+            matching a URL only considers the few rules which could match it,
+            and finds the allowed methods of URLs without raising
+            C{MethodNotAllowed}.  This pays off for apps with many routes, or
+            many requests answered with 405.  Defaults to C{False}, which
+            leaves matching to werkzeug; it raises C{MethodNotAllowed} for
+            other methods, which is caught to find the allowed methods.
+        @type indexed_routing: L{bool}
+
+        @param automatic_options: If C{True}, answer C{OPTIONS} requests for
+            paths which have routes, but none for C{OPTIONS}, with an empty
+            response listing the allowed methods in its C{Allow} header.
+            Defaults to C{False}, which answers them with a 405 like any other
+            method that isn't allowed.
+        @type automatic_options: L{bool}
+
+        @param metrics: If not C{None}, count the requests this app answers,
+            by endpoint, in these metrics.  Defaults to C{None}.
+        @type metrics: L{klein.Metrics}
+
+        @param timeout: If not C{None}, how long handlers may take by default,
+            in seconds, like the C{timeout} of L{route}.  Defaults to
+            C{None}.
+        @type timeout: L{float}
+
+        @param etags: If C{True}, give the responses written in one piece an
+            C{ETag} made of the hash of their body, unless their handler gave
+            them one, and answer the C{GET} and C{HEAD} requests whose
+            C{If-None-Match} or C{If-Modified-Since} show the client has the
+            body already with 304 and no body.  If C{"weak"}, do the same
+            with weak entity tags.  Defaults to C{False}.
+        @type etags: L{bool} or L{str}
+
+        @param compression: If not C{None}, compress responses with the
+            content codings clients accept, as this says, or with the
+            defaults of L{klein.Compression} if C{True}.  Defaults to C{None}.
+        @type compression: L{klein.Compression} or L{bool}
+
+        @param max_body_size: If not C{None}, the size in bytes of the largest
+            request bodies accepted by default, like the C{max_body_size} of
+            L{route}.  Defaults to C{None}.
+        @type max_body_size: L{int}
+        """
         self._url_map = Map()
         self._endpoints = {}
         self._error_handlers = []
+        self._error_dispatch = {}
         self._instance = None
+        self._route_cache = None
+        if route_cache_size is not None:
+            self._route_cache = RouteCache(route_cache_size)
+        self._route_index = None
+        if indexed_routing:
+            self._route_index = RouteIndex(self._url_map)
+        self._indexed_routing = indexed_routing
+        self._hosts = {}
+        self._endpoint_prefix = u""
+        self._routing = _RoutingState()
+        self._automatic_options = automatic_options
+        self._url_builder = URLBuilder()
+        self._timing_sinks = []
+        self._metrics = metrics
+        self._thread_pools = {}
+        self._process_pools = {}
+        self._concurrency_limits = {}
+        self._response_cache = ResponseCache(clock=reactor)
+        self._etags = etags
+        if compression is True:
+            compression = Compression()
+        self._compression = compression
+        self._timeout = timeout
+        self._max_body_size = max_body_size
+        self._clock = reactor
 
 
     def __eq__(self, other):
@@ -83,6 +338,17 @@ class Klein(object):
 
 
 
+    @property
+    def response_cache(self):
+        """
+        The L{ResponseCache} of the routes added with a C{cache}, to bound
+        the memory it takes with its C{max_bytes} and to remove responses
+        from it with its C{invalidate}.  Like the routes, it is shared by the
+        instances the app is bound to.
+        """
+        return self._response_cache
+
+
     @property
     def url_map(self):
         """
@@ -99,6 +365,172 @@ class Klein(object):
         return self._endpoints
 
 
+    @property
+    def route_cache(self):
+        """
+        Read only property exposing L{Klein._route_cache}, whose C{hits},
+        C{misses} and C{evictions} counters describe how effective it is.
+        """
+        return self._route_cache
+
+
+    @property
+    def frozen(self):
+        """
+        Whether the routing table has been frozen with L{Klein.freeze}.
+        """
+        return self._routing.frozen
+
+
+    def freeze(self):
+        """
+        Compile the routing table and prevent any further routes from being
+        added to it.
+
+        Every rule is checked to have a handler, the rules are sorted and
+        compiled by C{werkzeug}, the route index is built if routing is
+        indexed, and the number of path segments consumed by each endpoint is
+        resolved.  This is work which would otherwise be done while handling
+        the first requests.  L{Klein.route} and L{Klein.subroute} raise
+        L{RuntimeError} afterwards.
+
+        Freezing applies to every L{Klein} bound from the same instance, and
+        freezing a frozen L{Klein} does nothing.
+
+        @raise ValueError: If a rule's endpoint has no handler.
+        """
+        if self._routing.frozen:
+            return
+
+        tables = [(self._url_map, self._route_index)]
+        tables.extend((host.url_map, host.route_index)
+                      for host in self._hosts.values())
+
+        for url_map, route_index in tables:
+            for rule in url_map.iter_rules():
+                if rule.build_only or rule.redirect_to is not None:
+                    continue
+                if rule.endpoint not in self._endpoints:
+                    raise ValueError(
+                        "No handler for endpoint {0!r} of rule {1!r}."
+                        .format(rule.endpoint, rule.rule))
+
+        for url_map, route_index in tables:
+            if route_index is not None:
+                route_index.build()
+
+        self._routing.segment_counts = dict(
+            (endpoint, f.segment_count)
+            for (endpoint, f) in self._endpoints.items())
+        self._routing.frozen = True
+
+
+    def _check_not_frozen(self):
+        """
+        Refuse to change the routing table once it is frozen.
+
+        @raise RuntimeError: If the routing table is frozen.
+        """
+        if self._routing.frozen:
+            raise RuntimeError(
+                "Routes cannot be added after Klein.freeze() was called.")
+
+
+    def _segment_count(self, endpoint):
+        """
+        Get the number of path segments consumed by the route of
+        C{endpoint}.
+        """
+        segment_counts = self._routing.segment_counts
+        if segment_counts is None:
+            return self._endpoints[endpoint].segment_count
+        return segment_counts[endpoint]
+
+
+    def _routes_changed(self):
+        """
+        Discard everything derived from the routing table after a rule has
+        been added to it.
+        """
+        if self._route_cache is not None:
+            self._route_cache.clear()
+        if self._route_index is not None:
+            self._route_index.invalidate()
+        self._url_builder.invalidate()
+
+
+    def _routes_for_host(self, server_name):
+        """
+        Find the routing table serving C{server_name}.
+
+        @param server_name: The server name of a request, as extracted by
+            L{klein.resource._extractURLparts}.
+        @type server_name: L{unicode}
+
+        @return: A L{tuple} of the C{werkzeug.routing.Map} to route with, and
+            the L{RouteIndex} to match with or C{None}; those of the host
+            added with L{Klein.host} for C{server_name}, or else those of the
+            routes added outside of any host.
+        """
+        if self._hosts:
+            host = self._hosts.get(_hostname(server_name))
+            if host is not None:
+                return host.url_map, host.route_index
+        return self._url_map, self._route_index
+
+
+    def _match(self, mapper, key, route_index):
+        """
+        Match the URL C{mapper} is bound to, through the route index and
+        route cache if they are enabled.
+
+        @param mapper: An adapter bound to the URL to match.
+        @type mapper: C{werkzeug.routing.MapAdapter}
+
+        @param key: A hashable value uniquely identifying the URL and method
+            C{mapper} is bound to, as a key for the route cache.
+
+        @param route_index: The L{RouteIndex} of the map C{mapper} is bound
+            from, or C{None} to match with C{mapper} itself.
+
+        @raise werkzeug.exceptions.HTTPException: If the URL does not resolve
+            for a reason other than the method of the request.
+
+        @return: A L{tuple} of the matched C{werkzeug.routing.Rule} and a
+            L{dict} of the converted arguments, or of C{None} and a
+            L{frozenset} of the allowed methods if there are routes for the
+            URL, but none for the method of the request.
+        """
+        match = werkzeugMatch
+        if route_index is not None:
+            match = route_index.match
+        if self._route_cache is not None:
+            return self._route_cache.match(mapper, key, match)
+        return match(mapper)
+
+
+    def _error_handlers_for(self, exception_type):
+        """
+        Find the error handlers registered for exceptions of
+        C{exception_type}, once for every exception type.
+
+        @type exception_type: L{type}
+
+        @return: A L{tuple} of the positions in C{_error_handlers} and the
+            handlers of the registrations which handle C{exception_type}, in
+            the order they were registered.
+        """
+        handlers = self._error_dispatch.get(exception_type)
+        if handlers is None:
+            handlers = tuple(
+                (position, handler)
+                for position, (exception_types, handler)
+                in enumerate(self._error_handlers)
+                if issubclass(exception_type, tuple(exception_types)))
+            self._error_dispatch[exception_type] = handlers
+        return handlers
+
+
     def execute_endpoint(self, endpoint, *args, **kwargs):
         """
         Execute the named endpoint with all arguments and possibly a bound
@@ -115,12 +547,17 @@ class Klein(object):
         return handler(self._instance, request, failure)
 
 
-    def resource(self):
+    def resource(self, freeze=False):
         """
         Return an L{IResource} which suitably wraps this app.
 
+        @param freeze: If C{True}, L{freeze} the routing table first.
+        @type freeze: L{bool}
+
         @returns: An L{IResource}
         """
+        if freeze:
+            self.freeze()
 
         return KleinResource(self)
 
@@ -139,6 +576,25 @@ class Klein(object):
             k._url_map = self._url_map
             k._endpoints = self._endpoints
             k._error_handlers = self._error_handlers
+            k._error_dispatch = self._error_dispatch
+            k._route_cache = self._route_cache
+            k._route_index = self._route_index
+            k._indexed_routing = self._indexed_routing
+            k._hosts = self._hosts
+            k._routing = self._routing
+            k._automatic_options = self._automatic_options
+            k._url_builder = self._url_builder
+            k._timing_sinks = self._timing_sinks
+            k._metrics = self._metrics
+            k._thread_pools = self._thread_pools
+            k._process_pools = self._process_pools
+            k._concurrency_limits = self._concurrency_limits
+            k._response_cache = self._response_cache
+            k._etags = self._etags
+            k._compression = self._compression
+            k._timeout = self._timeout
+            k._max_body_size = self._max_body_size
+            k._clock = self._clock
             k._instance = instance
             self._bound_klein_instances[instance] = k
 
@@ -165,15 +621,105 @@ class Klein(object):
             match some other route to be consumed.  Default C{False}.
         @type branch: bool
 
+        @param threaded: If C{True}, call the handler in a thread of the
+            C{"default"} pool of L{thread_pool}; if the name of a pool, in a
+            thread of that pool.  Requests are answered with 503 when too
+            many calls are waiting for a thread.  Threaded handlers must not
+            write to the request.  Default C{False}.
+        @type threaded: L{bool} or L{unicode}
+
+        @param processes: If C{True}, call the handler in a worker process of
+            the C{"default"} pool of L{process_pool}; if the name of a pool,
+            in a worker of that pool.  Requests can't be sent to other
+            processes, so the handler is called with the keyword arguments
+            taken from the C{url} pattern only, and must be a function defined
+            at the top level of a module.  Requests are answered with 503
+            when too many calls are waiting for a worker.  Can't be combined
+            with C{threaded}.  Default C{False}.
+        @type processes: L{bool} or L{unicode}
+
+        @param concurrency: If the name of a limit of L{concurrency_limit},
+            run the handler under that limit, which may be shared with other
+            routes.  If a number, run it under a limit of that many handlers
+            named after the endpoint.  Requests over the limit are answered
+            with 503 before the handler runs.  Default C{None}.
+        @type concurrency: L{unicode} or L{int}
+
+        @param timeout: How long the handler may take, in seconds, before the
+            L{Deferred} it returned is cancelled and the request is answered
+            with 504, by raising L{klein.DeadlineExceeded} through the error
+            handlers.  The deadline is the C{deadline} of the
+            L{IKleinRequest} of the request.  Defaults to the C{timeout} of
+            the app.
+        @type timeout: L{float}
+
+        @param cache: How to cache the responses of the handler in
+            L{response_cache}, or for how many seconds.  Responses served from
+            the cache are written without matching the URL, calling the
+            handler or rendering its result.  Default C{None}.
+        @type cache: L{klein.CachePolicy} or L{float}
+
+        @param max_body_size: The size in bytes of the largest request body
+            the handler accepts.  Requests whose C{Content-Length} is larger
+            are answered with 413 before the handler runs, by raising
+            L{klein.RequestBodyTooLarge} through the error handlers, and
+            reading the C{body} of the L{IKleinRequest} of other requests
+            fails with it once they turn out to be larger.  Defaults to the
+            C{max_body_size} of the app.
+        @type max_body_size: L{int}
+
+        @raise RuntimeError: If the routing table is frozen.
+
+        @raise ValueError: If both C{threaded} and C{processes} are given.
 
         @returns: decorated handler function.
         """
+        self._check_not_frozen()
+
         segment_count = url.count('/')
         if url.endswith('/'):
             segment_count -= 1
 
+        call = _call
+        threaded = kwargs.pop('threaded', False)
+        processes = kwargs.pop('processes', False)
+        if threaded and processes:
+            raise ValueError(
+                "A handler can't be called both in a thread and in a worker "
+                "process.")
+        if threaded:
+            call = self._thread_caller(
+                u"default" if threaded is True else threaded)
+        if processes:
+            call = self._process_caller(
+                u"default" if processes is True else processes)
+        concurrency = kwargs.pop('concurrency', None)
+        timeout = kwargs.pop('timeout', None)
+        if timeout is None:
+            timeout = self._timeout
+        cache = kwargs.pop('cache', None)
+        if cache is not None and not isinstance(cache, CachePolicy):
+            cache = CachePolicy(ttl=cache)
+        max_body_size = kwargs.pop('max_body_size', None)
+        if max_body_size is None:
+            max_body_size = self._max_body_size
+
         def deco(f):
-            kwargs.setdefault('endpoint', f.__name__)
+            self._check_not_frozen()
+            kwargs.setdefault('endpoint', self._endpoint_prefix + f.__name__)
+            if concurrency is not None:
+                limited = self._limited_caller(concurrency,
+                                               kwargs['endpoint'], call)
+            else:
+                limited = call
+            if timeout is not None:
+                limited = partial(self._deadline_caller, timeout, limited)
+            if cache is not None:
+                self._response_cache.active = True
+                limited = partial(_cachingCall, self._response_cache,
+                                  kwargs['endpoint'], cache, limited)
+            if max_body_size is not None:
+                limited = partial(_limitBody, max_body_size, limited)
             if kwargs.pop('branch', False):
                 branchKwargs = kwargs.copy()
                 branchKwargs['endpoint'] = branchKwargs['endpoint'] + '_branch'
@@ -181,26 +727,207 @@ class Klein(object):
                 @wraps(f)
                 def branch_f(instance, request, *a, **kw):
                     IKleinRequest(request).branch_segments = kw.pop('__rest__', '').split('/')
-                    return _call(instance, f, request, *a, **kw)
+                    return limited(instance, f, request, *a, **kw)
 
                 branch_f.segment_count = segment_count
 
                 self._endpoints[branchKwargs['endpoint']] = branch_f
                 self._url_map.add(Rule(url.rstrip('/') + '/' + '<path:__rest__>', *args, **branchKwargs))
+                self._routes_changed()
 
             @wraps(f)
             def _f(instance, request, *a, **kw):
-                return _call(instance, f, request, *a, **kw)
+                return limited(instance, f, request, *a, **kw)
 
             _f.segment_count = segment_count
 
             self._endpoints[kwargs['endpoint']] = _f
             self._url_map.add(Rule(url, *args, **kwargs))
+            self._routes_changed()
             return f
 
         return deco
 
 
+    def thread_pool(self, name=u"default", max_threads=None, max_queue=None):
+        """
+        Get the pool of threads called C{name}, which handlers of routes
+        added with C{threaded=name} are called in, creating it the first
+        time.
+
+        ::
+            app.thread_pool("reports", max_threads=4, max_queue=20)
+
+            @app.route("/report", threaded="reports")
+            def report(request):
+                return blocking_database_query()
+
+        @param name: The name of the pool, and of its threads.
+        @type name: L{unicode}
+
+        @param max_threads: The maximum number of threads.  Defaults to 10
+            for new pools, and leaves existing pools alone.
+        @type max_threads: L{int}
+
+        @param max_queue: The maximum number of calls waiting for a thread,
+            beyond which requests are answered with 503.  Defaults to 100 for
+            new pools, and leaves existing pools alone.
+        @type max_queue: L{int}
+
+        @return: The pool, whose C{queue_depth} and C{wait_time} tell how
+            busy it is.
+        @rtype: L{HandlerThreadPool}
+        """
+        pool = self._thread_pools.get(name)
+        if pool is None:
+            pool = self._thread_pools[name] = HandlerThreadPool(name)
+        pool.resize(max_threads, max_queue)
+        return pool
+
+
+    def _thread_caller(self, name):
+        """
+        Make a replacement for L{_call} calling handlers in the thread pool
+        called C{name}.
+        """
+        def call(instance, f, *args, **kwargs):
+            if instance is not None:
+                args = (instance,) + args
+            return self.thread_pool(name).submit(f, *args, **kwargs)
+        return call
+
+
+    def process_pool(self, name=u"default", size=None, max_tasks=None,
+                     timeout=None, max_queue=None):
+        """
+        Get the pool of worker processes called C{name}, which handlers of
+        routes added with C{processes=name} are called in, creating it the
+        first time.  Handlers can also submit picklable functions to it
+        themselves::
+
+            app.process_pool("images", size=4, max_tasks=100, timeout=5)
+
+            @app.route("/thumbnail/<name>", processes="images")
+            def thumbnail(name):
+                return make_thumbnail(name)
+
+            @app.route("/report")
+            def report(request):
+                return app.process_pool("images").submit(render_report)
+
+        Failures of the calls, including L{klein.ProcessTimeout} when they
+        take too long, are handled by the error handlers of the app.
+
+        @param name: The name of the pool.
+        @type name: L{unicode}
+
+        @param size: The maximum number of worker processes.  Defaults to the
+            number of CPUs for new pools, and leaves existing pools alone.
+        @type size: L{int}
+
+        @param max_tasks: The number of calls after which a worker process is
+            replaced by a new one.  Defaults to never replacing them for new
+            pools, and leaves existing pools alone.
+        @type max_tasks: L{int}
+
+        @param timeout: How long calls may take, in seconds, before their
+            worker process is killed and requests are answered with 504.
+            Defaults to no limit for new pools, and leaves existing pools
+            alone.
+        @type timeout: L{float}
+
+        @param max_queue: The maximum number of calls waiting for a worker
+            process, beyond which calls fail with L{klein.ProcessPoolFull}
+            and requests are answered with 503.  Defaults to 100 for new
+            pools, and leaves existing pools alone.
+        @type max_queue: L{int}
+
+        @return: The pool, whose C{queue_depth} tells how busy it is.
+        @rtype: L{ProcessPool}
+        """
+        pool = self._process_pools.get(name)
+        if pool is None:
+            pool = self._process_pools[name] = ProcessPool(name)
+        pool.configure(size, max_tasks, timeout, max_queue)
+        return pool
+
+
+    def _process_caller(self, name):
+        """
+        Make a replacement for L{_call} calling handlers in the process pool
+        called C{name}, without the instance and the request.
+        """
+        def call(instance, f, request, *args, **kwargs):
+            return self.process_pool(name).submit(f, *args, **kwargs)
+        return call
+
+
+    def concurrency_limit(self, name, max_concurrent=None, max_queue=None,
+                          retry_after=None):
+        """
+        Get the concurrency limit called C{name}, which handlers of routes
+        added with C{concurrency=name} run under, creating it the first
+        time.
+
+        ::
+            app.concurrency_limit("search", max_concurrent=20, max_queue=50)
+
+            @app.route("/search", concurrency="search")
+            def search(request):
+                return slow_search(request.args)
+
+        @param name: The name of the limit.
+        @type name: L{unicode}
+
+        @param max_concurrent: The maximum number of handlers running at
+            once.  Defaults to 10 for new limits, and leaves existing limits
+            alone.
+        @type max_concurrent: L{int}
+
+        @param max_queue: The maximum number of handlers waiting for their
+            turn, beyond which requests are answered with 503.  Defaults to
+            0 for new limits, and leaves existing limits alone.
+        @type max_queue: L{int}
+
+        @param retry_after: The C{Retry-After} of the 503 responses, in
+            seconds.  Defaults to 1 for new limits, and leaves existing
+            limits alone.
+        @type retry_after: L{int}
+
+        @return: The limit, whose C{in_flight} and C{queue_depth} tell how
+            busy it is.
+        @rtype: L{ConcurrencyLimit}
+        """
+        limit = self._concurrency_limits.get(name)
+        if limit is None:
+            limit = self._concurrency_limits[name] = ConcurrencyLimit(name)
+        limit.configure(max_concurrent, max_queue, retry_after)
+        return limit
+
+
+    def _deadline_caller(self, timeout, call, *args, **kwargs):
+        """
+        Call a handler with C{call}, cancelling it after C{timeout} seconds.
+        """
+        return _callWithDeadline(self._clock, timeout, call, *args, **kwargs)
+
+
+    def _limited_caller(self, concurrency, endpoint, call):
+        """
+        Make a replacement for C{call} running handlers under a concurrency
+        limit: the one called C{concurrency} if it is a name, or one of
+        C{concurrency} handlers called C{endpoint} if it is a number.
+        """
+        if isinstance(concurrency, int):
+            self.concurrency_limit(endpoint, max_concurrent=concurrency)
+            concurrency = endpoint
+
+        def limited(*args, **kwargs):
+            return self.concurrency_limit(concurrency).run(
+                call, *args, **kwargs)
+        return limited
+
+
     @contextmanager
     def subroute(self, prefix):
         """
@@ -225,8 +952,10 @@ class Klein(object):
         @type prefix: string
         @param prefix: The string that will be prepended to the paths of all
                        routes established during the with-block.
+        @raise RuntimeError: If the routing table is frozen.
         @return: Returns None.
         """
+        self._check_not_frozen()
 
         _map_before_submount = self._url_map
 
@@ -239,10 +968,66 @@ class Klein(object):
             yield self
             _map_before_submount.add(
                 Submount(prefix, submount_map.rules))
+            self._routes_changed()
         finally:
             self._url_map = _map_before_submount
 
 
+    @contextmanager
+    def host(self, hostname):
+        """
+        Within this block, C{@route} adds rules which only apply to requests
+        for C{hostname}.
+
+        Each host has a routing table of its own, and a request is routed
+        with that of the host it is for, which is found with a dictionary
+        lookup by the host name of the request, without its port and
+        regardless of case.  Requests for hosts without routes of their own
+        are routed with the rules added outside of any C{host} block.  As
+        URLs are built with the routing table of the request, C{url_for} only
+        builds URLs for the endpoints of the same host.
+
+        Unless they are given one, the routes of a host are named after their
+        handler qualified with the host name, like C{"api.example.com:root"},
+        so that handlers of the same name can serve several hosts.
+        C{url_for} finds them by the name of their handler too.
+
+        Usage:
+        ::
+            with app.host("api.example.com") as app:
+                @app.route("/")
+                def api_root(request):
+                    return 'I respond to http://api.example.com/'
+
+        C{subroute} can be used within a C{host} block.
+
+        @type hostname: string
+        @param hostname: The host name the routes established during the
+                         with-block apply to.
+        @raise RuntimeError: If the routing table is frozen.
+        @return: Returns None.
+        """
+        self._check_not_frozen()
+
+        key = _hostname(hostname)
+        host = self._hosts.get(key)
+        if host is None:
+            host = self._hosts[key] = _VirtualHost(key, self._indexed_routing)
+
+        _map_before_host = self._url_map
+        _index_before_host = self._route_index
+        _prefix_before_host = self._endpoint_prefix
+        try:
+            self._url_map = host.url_map
+            self._route_index = host.route_index
+            self._endpoint_prefix = host.url_map.klein_endpoint_prefix
+            yield self
+        finally:
+            self._url_map = _map_before_host
+            self._route_index = _index_before_host
+            self._endpoint_prefix = _prefix_before_host
+
+
     def handle_errors(self, f_or_exception, *additional_exceptions):
         """
         Register an error handler. This decorator supports two syntaxes. The
@@ -305,13 +1090,39 @@ class Klein(object):
                 return _call(instance, f, request, failure)
 
             self._error_handlers.append(([f_or_exception] + list(additional_exceptions), _f))
+            self._error_dispatch.clear()
             return _f
 
         return deco
 
 
+    def add_timing_sink(self, sink):
+        """
+        Time the phases of handling every request, and record them with
+        C{sink} once the request has been answered.
+
+        Requests are only timed while there are sinks, so that they cost
+        nothing otherwise.
+
+        @param sink: The sink recording the timings, such as a
+            L{klein.HistogramTimingSink} or a L{klein.LogTimingSink}.
+        @type sink: L{klein.interfaces.ITimingSink}
+        """
+        self._timing_sinks.append(sink)
+
+
+    def remove_timing_sink(self, sink):
+        """
+        Stop recording timings with C{sink}.
+
+        @param sink: A sink added with L{add_timing_sink}.
+        @type sink: L{klein.interfaces.ITimingSink}
+        """
+        self._timing_sinks.remove(sink)
+
+
     def run(self, host=None, port=None, logFile=None,
-            endpoint_description=None):
+            endpoint_description=None, freeze=False, stream_bodies=False):
         """
         Run a minimal twisted.web server on the specified C{port}, bound to the
         interface specified by C{host} and logging to C{logFile}.
@@ -335,6 +1146,16 @@ class Klein(object):
             protocol, port and interface. May contain other optional arguments,
              e.g. to use SSL: "ssl:443:privateKey=key.pem:certKey=crt.pem"
         @type endpoint_description: str
+
+        @param freeze: If C{True}, L{freeze} the routing table before starting
+            to serve.
+        @type freeze: L{bool}
+
+        @param stream_bodies: If C{True}, route requests as soon as their
+            headers are received, and stream their bodies to the handlers
+            through the C{body} of their L{IKleinRequest}, with
+            L{klein.StreamingRequest}.
+        @type stream_bodies: L{bool}
         """
         if logFile is None:
             logFile = sys.stdout
@@ -346,7 +1167,10 @@ class Klein(object):
                                                                        host)
 
         endpoint = endpoints.serverFromString(reactor, endpoint_description)
-        endpoint.listen(Site(self.resource()))
+        site = Site(self.resource(freeze=freeze))
+        if stream_bodies:
+            site.requestFactory = StreamingRequest
+        endpoint.listen(site)
         reactor.run()
 
 
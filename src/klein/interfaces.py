@@ -5,9 +5,139 @@ from zope.interface import Interface, Attribute
 
 class IKleinRequest(Interface):
     branch_segments = Attribute("Segments consumed by a branch route.")
-    mapper = Attribute("L{werkzeug.routing.MapAdapter}")
+    mapper = Attribute(
+        "L{werkzeug.routing.MapAdapter} bound to the host, script name, URL "
+        "scheme and method of the request, and to its path.  It is a copy of "
+        "the adapter kept for requests for the same, so it is this request's "
+        "own for as long as it is handled.")
+    url_builder = Attribute(
+        "L{klein._urlbuilder.URLBuilder} used by L{url_for} and "
+        "L{url_for_many}, or C{None} to build with C{mapper} directly.")
+    deadline = Attribute(
+        "When the handler must have answered the request by, in seconds of "
+        "C{clock}, or C{None} if its route has no timeout.")
+    clock = Attribute(
+        "The L{twisted.internet.interfaces.IReactorTime} C{deadline} is "
+        "measured with, or C{None} if its route has no timeout.")
+    body = Attribute(
+        "The L{klein.RequestBody} of the request, to read its body in chunks "
+        "as it is received, or whole.")
 
     def url_for(self, endpoint, values=None, method=None, force_external=False, append_unknown=True):
         """
         L{werkzeug.routing.MapAdapter.build}
         """
+
+    def url_for_many(self, endpoint, many_values, method=None, force_external=False, append_unknown=True):
+        """
+        Build a URL for C{endpoint} with each of C{many_values}, like
+        L{url_for}, and return them as a L{list}.
+        """
+
+    def remaining_time(self):
+        """
+        How many seconds are left before C{deadline}, which handlers can pass
+        on as the timeout of the calls they make, or C{None} if there is no
+        deadline.
+        """
+
+    def form(self, spool_size=2 ** 20):
+        """
+        Parse the form sent as the body of the request, as it is received,
+        the first time this is called.  Handlers which don't call it don't
+        pay for parsing the body.
+
+        C{multipart/form-data} forms are parsed incrementally, keeping the
+        contents of their parts in memory up to C{spool_size} bytes each,
+        and in temporary files beyond, which are removed once the request is
+        answered.  C{application/x-www-form-urlencoded} forms are parsed
+        whole.
+
+        @param spool_size: The size in bytes above which the contents of a
+            part are written to a temporary file.
+        @type spool_size: L{int}
+
+        @return: A L{Deferred} firing with a L{klein.Form}, or failing with
+            L{werkzeug.exceptions.BadRequest} if the form is malformed, or
+            L{werkzeug.exceptions.UnsupportedMediaType} if the body isn't a
+            form, which answer the request with 400 or 415 unless an error
+            handler deals with them.
+        """
+
+    def json(self, max_size=None, decoder=None):
+        """
+        Decode the JSON sent as the body of the request, the first time this
+        is called, and give the same value to later calls::
+
+            data = yield IKleinRequest(request).json(max_size=2 ** 16)
+
+        @param max_size: If not C{None}, the size in bytes of the largest
+            body accepted.
+        @type max_size: L{int}
+
+        @param decoder: What decodes the body, given as L{bytes}, raising
+            L{ValueError} if it is malformed.  Defaults to L{json.loads} of
+            the body decoded as UTF-8.
+
+        @return: A L{Deferred} firing with the decoded value, or failing with
+            L{werkzeug.exceptions.UnsupportedMediaType} if the C{Content-Type}
+            of the request isn't JSON, L{klein.RequestBodyTooLarge} if the
+            body is larger than C{max_size}, or
+            L{werkzeug.exceptions.BadRequest} if it is malformed, which answer
+            the request with 415, 413 or 400 unless an error handler deals
+            with them.
+        """
+
+    def not_modified(self, version=None, last_modified=None, weak=False):
+        """
+        Tell the version of the content of the response, and answer the
+        request with 304 if the client has that version already.  Handlers
+        which can tell the version of their content cheaply can call this
+        before doing the work of producing it::
+
+            if IKleinRequest(request).not_modified(version=article.revision):
+                return b""
+
+        @param version: The version of the content, sent as its C{ETag}, and
+            compared with C{If-None-Match}.
+        @type version: L{bytes} or L{unicode}
+
+        @param last_modified: When the content was last modified, in seconds
+            since the epoch, sent as its C{Last-Modified}, and compared with
+            C{If-Modified-Since} when there is no C{If-None-Match}.
+        @type last_modified: L{float}
+
+        @param weak: Whether C{version} is a weak entity tag, which says the
+            content is equivalent rather than identical.
+        @type weak: L{bool}
+
+        @return: Whether the request is answered with 304, in which case the
+            handler should return an empty body.
+        @rtype: L{bool}
+        """
+
+
+class ITimingSink(Interface):
+    """
+    Receives the durations of the phases of handling each request.  Sinks
+    are added with L{klein.Klein.add_timing_sink}.
+    """
+
+    def record(endpoint, timings):
+        """
+        Record the timings of a request which has been answered.
+
+        @param endpoint: The name of the endpoint the request was routed to,
+            or C{None} if it wasn't routed to any.
+        @type endpoint: L{str}
+
+        @param timings: The phases of handling the request, in the order
+            they happened, with their durations in seconds.  The phases are
+            C{"extract"}, extracting the URL from the request, C{"bind"},
+            binding the routing table to it, C{"match"}, C{"handler"},
+            C{"process"}, rendering the result of the handler, C{"error"},
+            running the error handlers, and C{"write"}, writing the response
+            and finishing the request.  Phases which didn't happen are left
+            out.
+        @type timings: L{list} of L{tuple} of L{str} and L{float}
+        """
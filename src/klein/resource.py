@@ -2,8 +2,13 @@
 
 from __future__ import absolute_import, division
 
-from twisted.internet import defer
+import copy
+
+from collections import OrderedDict
+
+from twisted.internet import defer, task
 from twisted.python import log, failure
+from twisted.python.failure import Failure
 from twisted.python.compat import unicode, intToBytes
 from twisted.web import server
 from twisted.web.iweb import IRenderable
@@ -11,9 +16,16 @@ from twisted.web.resource import Resource, IResource, getChildForRequest
 from twisted.web.server import NOT_DONE_YET
 from twisted.web.template import renderElement
 
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import HTTPException, MethodNotAllowed
 
 from klein.interfaces import IKleinRequest
+from klein._compression import _compressWhole
+from klein._conditional import _conditionalBody
+from klein._fileresponse import FileResponse
+from klein._stream import IterableProducer, isStreamable
+from klein._timing import (
+    BIND, ERROR, EXTRACT, HANDLER, MATCH, PROCESS, WRITE, _RequestTimer,
+    _timed, _timedCallback)
 
 
 
@@ -32,6 +44,33 @@ def ensure_utf8_bytes(v):
 
 
 
+_methodNotAllowedResponses = {}
+
+def _methodNotAllowedResponse(allowed):
+    """
+    Compute the parts of the responses for requests with a method other than
+    C{allowed}, once for every distinct set of methods.
+
+    @param allowed: The methods which are allowed.
+    @type allowed: L{frozenset} of L{unicode}
+
+    @return: A L{tuple} of the value of the C{Allow} header for an C{OPTIONS}
+        request, the headers of a 405 response and its body.
+    @rtype: L{tuple} of L{bytes}, L{list} of L{tuple} of L{bytes}, L{bytes}
+    """
+    response = _methodNotAllowedResponses.get(allowed)
+    if response is None:
+        e = MethodNotAllowed(valid_methods=sorted(allowed))
+        headers = [(ensure_utf8_bytes(header), ensure_utf8_bytes(value))
+                   for header, value in e.get_response({}).headers]
+        allow = u", ".join(sorted(allowed | set([u"OPTIONS"])))
+        response = (ensure_utf8_bytes(allow), headers,
+                    ensure_utf8_bytes(e.get_body({})))
+        _methodNotAllowedResponses[allowed] = response
+    return response
+
+
+
 class _StandInResource(object):
     """
     A standin for a Resource.
@@ -42,6 +81,18 @@ class _StandInResource(object):
 
 
 
+def _isFinished(request):
+    """
+    Is C{request} finished, or is its connection gone?
+
+    This is what firing the L{Deferred} returned by C{request.notifyFinish}
+    tells, without allocating it.
+    """
+    return bool(getattr(request, "finished", False) or
+                getattr(request, "_disconnected", False))
+
+
+
 class _URLDecodeError(Exception):
     """
     Raised if one or more string parts of the URL could not be decoded.
@@ -122,21 +173,77 @@ def _extractURLparts(request):
 
 
 
+class _AdapterPool(object):
+    """
+    A bounded collection of C{werkzeug.routing.MapAdapter}s, so that requests
+    for the same host, script name, URL scheme and method don't bind the map
+    anew.
+
+    Only C{path_info} differs between such requests, so each request gets a
+    shallow copy of the adapter bound for them with its own path, which
+    stays put while its handler waits.  The least recently used adapters are
+    forgotten first.
+    """
+
+    def __init__(self, maxsize=64):
+        """
+        @param maxsize: The maximum number of adapters to keep.
+        @type maxsize: L{int}
+        """
+        self.maxsize = maxsize
+        self._adapters = OrderedDict()
+
+
+    def bind(self, url_map, server_name, script_name, path_info, method,
+             url_scheme):
+        """
+        Get an adapter for C{url_map} bound to the given URL parts.
+
+        @return: A new adapter whose C{path_info} is C{path_info}.
+        @rtype: C{werkzeug.routing.MapAdapter}
+        """
+        key = (url_map, server_name, script_name, method, url_scheme)
+        adapters = self._adapters
+        bound = adapters.pop(key, None)
+        if bound is None:
+            bound = url_map.bind(
+                server_name,
+                script_name,
+                default_method=method,
+                url_scheme=url_scheme,
+            )
+            # The host header is under the control of clients, so make sure
+            # this doesn't grow without bound.
+            if len(adapters) >= self.maxsize:
+                adapters.popitem(last=False)
+        adapters[key] = bound
+        adapter = copy.copy(bound)
+        adapter.path_info = path_info
+        return adapter
+
+
+
 class KleinResource(Resource):
     """
     A ``Resource`` that can do URL routing.
     """
     isLeaf = True
 
+    # Schedules the iteration of streamed responses.
+    _cooperate = staticmethod(task.cooperate)
+
 
     def __init__(self, app):
         Resource.__init__(self)
         self._app = app
+        self._adapters = _AdapterPool()
 
 
     def __eq__(self, other):
         if isinstance(other, KleinResource):
-            return vars(self) == vars(other)
+            # The adapter pool is merely a cache.
+            return (dict(vars(self), _adapters=None) ==
+                    dict(vars(other), _adapters=None))
         return NotImplemented
 
 
@@ -147,7 +254,43 @@ class KleinResource(Resource):
         return not result
 
 
+    def _method_not_allowed(self, request, allowed):
+        """
+        Answer a request for a routed path with a method which isn't allowed.
+
+        Unless an error handler is registered for C{MethodNotAllowed}, this is
+        done without raising it.
+
+        @param allowed: The methods which are allowed.
+        @type allowed: L{frozenset} of L{unicode}
+
+        @raise MethodNotAllowed: If an error handler should handle it.
+
+        @return: The body of the response.
+        @rtype: L{bytes}
+        """
+        allow, headers, body = _methodNotAllowedResponse(allowed)
+        if request.method == b"OPTIONS" and self._app._automatic_options:
+            request.setHeader(b"Allow", allow)
+            return b""
+
+        if self._app._error_handlers_for(MethodNotAllowed):
+            raise MethodNotAllowed(valid_methods=sorted(allowed))
+
+        request.setResponseCode(405)
+        for header, value in headers:
+            request.setHeader(header, value)
+        return body
+
+
     def render(self, request):
+        # Only time requests if anything records the timings.
+        timer = None
+        if self._app._timing_sinks or self._app._metrics is not None:
+            timer = _RequestTimer(self._app._timing_sinks, self._app._metrics,
+                                  request)
+            timer.start(EXTRACT)
+
         # Stuff we need to know for the mapper.
         try:
             url_scheme, server_name, server_port, path_info, script_name = \
@@ -156,98 +299,289 @@ class KleinResource(Resource):
             for what, fail in e.errors:
                 log.err(fail, "Invalid encoding in {what}.".format(what=what))
             request.setResponseCode(400)
+            if timer is not None:
+                timer.report()
             return b"Non-UTF-8 encoding in URL."
 
-        # Bind our mapper.
-        mapper = self._app.url_map.bind(
+        if timer is not None:
+            timer.start(BIND)
+
+        # Bind our mapper, to the routes of the host the request is for.
+        url_map, route_index = self._app._routes_for_host(server_name)
+        mapper = self._adapters.bind(
+            url_map,
             server_name,
             script_name,
-            path_info=path_info,
-            default_method=request.method,
-            url_scheme=url_scheme,
+            path_info,
+            request.method,
+            url_scheme,
         )
         # Make the mapper available to the view.
         kleinRequest = IKleinRequest(request)
         kleinRequest.mapper = mapper
+        kleinRequest.url_builder = self._app._url_builder
+
+        if self._app._compression is not None:
+            encoder = self._app._compression._encoderFor(request)
+            if encoder is not None:
+                request._encoder = encoder
+
+        cache = self._app._response_cache
+        if cache.active:
+            entry = cache._lookup(
+                request,
+                (request.method, mapper.url_scheme, mapper.server_name,
+                 mapper.script_name, path_info))
+            if entry is not None:
+                if timer is not None:
+                    timer.routed(entry.endpoint)
+                    timer.start(WRITE)
+                body = cache._restore(entry, request)
+                if self._app._etags:
+                    body = _conditionalBody(request, body,
+                                            self._app._etags == "weak")
+                if self._app._compression is not None:
+                    body = _compressWhole(request, body, True)
+                request.write(body)
+                request.finish()
+                if timer is not None:
+                    timer.report()
+                return server.NOT_DONE_YET
+
+        # Handlers which return something other than a Deferred are
+        # answered right away, without setting up any Deferreds, and so are
+        # exceptions the error handlers deal with synchronously.
+        try:
+            r = self._execute(
+                request,
+                mapper,
+                (server_name, script_name, path_info, request.method,
+                 url_scheme),
+                route_index,
+                timer)
+        except Exception:
+            return self._render_failure(request, Failure(), timer)
+
+        if isinstance(r, defer.Deferred):
+            return self._render_async(request, r, timer)
+
+        try:
+            r = _timed(timer, PROCESS, self._process, r, request)
+        except Exception:
+            return self._render_failure(request, Failure(), timer)
+
+        if isinstance(r, defer.Deferred):
+            # The result is being streamed.
+            return self._render_async(request, r, timer, processed=True)
+
+        try:
+            _timed(timer, WRITE, self._write_response, r, request)
+        except Exception:
+            log.err(Failure(), "Unhandled Error writing response")
+        if timer is not None:
+            timer.report()
+        return server.NOT_DONE_YET
+
+
+    def _execute(self, request, mapper, key, route_index, timer=None):
+        """
+        Match the URL of C{request} and call its handler.
+
+        Exceptions raised while doing this percolate up, to be handled by
+        L{_processing_failed}; either by a user-registered error handler or
+        one of our defaults.
+
+        @param timer: The L{_RequestTimer} timing C{request}, if any.
+
+        @return: The result of the handler.
+        """
+        if timer is not None:
+            timer.start(MATCH)
+        (rule, kwargs) = self._app._match(mapper, key, route_index)
+        if timer is not None:
+            timer.stop()
+        if rule is None:
+            return self._method_not_allowed(request, kwargs)
+        endpoint = rule.endpoint
+
+        # Try pretty hard to fix up prepath and postpath.
+        segment_count = self._app._segment_count(endpoint)
+        request.prepath.extend(request.postpath[:segment_count])
+        request.postpath = request.postpath[segment_count:]
+
+        if timer is None:
+            return self._app.execute_endpoint(endpoint, request, **kwargs)
+        timer.routed(endpoint)
+        return timer.timed(
+            HANDLER,
+            lambda: self._app.execute_endpoint(endpoint, request, **kwargs))
+
+
+    def _render_async(self, request, d, timer=None, processed=False):
+        """
+        Answer C{request} once C{d}, the result of its handler, fires.
+
+        C{d} is cancelled if the connection goes away before C{request} is
+        finished.
+
+        @param timer: The L{_RequestTimer} timing C{request}, if any.
+
+        @param processed: Whether the result of C{d} has been processed
+            already, rather than being the result of the handler.
+        @type processed: L{bool}
+
+        @return: C{NOT_DONE_YET}
+        """
+        request.notifyFinish().addErrback(lambda _: d.cancel())
+
+        # Standard Twisted Web stuff. Defer the method action, giving us
+        # something renderable or printable.
+        if not processed:
+            d.addCallback(_timedCallback, timer, PROCESS, self._process,
+                          request)
+        d.addErrback(_timedCallback, timer, ERROR, self._processing_failed,
+                     request)
+        d.addCallback(_timedCallback, timer, WRITE, self._write_response,
+                      request)
+        d.addErrback(log.err, _why="Unhandled Error writing response")
+        if timer is not None:
+            d.addCallback(timer.report)
+        return server.NOT_DONE_YET
 
-        # Make sure we'll notice when the connection goes away unambiguously.
-        request_finished = [False]
 
-        def _finish(result):
-            request_finished[0] = True
+    def _render_failure(self, request, failure, timer=None):
+        """
+        Answer C{request} with the response of the error handlers to
+        C{failure}, right away unless they return a L{Deferred}.
 
-        def _execute():
-            # Actually doing the match right here. This can cause an exception
-            # to percolate up. If that happens it will be handled below in
-            # processing_failed, either by a user-registered error handler or
-            # one of our defaults.
-            (rule, kwargs) = mapper.match(return_rule=True)
-            endpoint = rule.endpoint
+        @param timer: The L{_RequestTimer} timing C{request}, if any.
 
-            # Try pretty hard to fix up prepath and postpath.
-            segment_count = self._app.endpoints[endpoint].segment_count
-            request.prepath.extend(request.postpath[:segment_count])
-            request.postpath = request.postpath[segment_count:]
+        @return: C{NOT_DONE_YET}
+        """
+        d = None
+        try:
+            r = _timed(timer, ERROR, self._processing_failed, failure,
+                       request)
+            if isinstance(r, defer.Deferred):
+                d = r
+            else:
+                _timed(timer, WRITE, self._write_response, r, request)
+        except Exception:
+            log.err(Failure(), "Unhandled Error writing response")
+        if d is not None:
+            d.addCallback(_timedCallback, timer, WRITE, self._write_response,
+                          request)
+            d.addErrback(log.err, _why="Unhandled Error writing response")
+            if timer is not None:
+                d.addCallback(timer.report)
+        elif timer is not None:
+            timer.report()
+        return server.NOT_DONE_YET
 
-            request.notifyFinish().addBoth(_finish)
 
-            # Standard Twisted Web stuff. Defer the method action, giving us
-            # something renderable or printable. Return NOT_DONE_YET and set up
-            # the incremental renderer.
-            d = defer.maybeDeferred(self._app.execute_endpoint,
-                                    endpoint,
-                                    request,
-                                    **kwargs)
+    def _write_response(self, r, request):
+        """
+        Write C{r}, the processed result of a handler, and finish C{request}
+        unless it already is.
+        """
+        if r is not _StandInResource:
+            if isinstance(r, unicode):
+                r = r.encode('utf-8')
+
+            if (r is not None) and (r != NOT_DONE_YET):
+                if self._app._etags and isinstance(r, bytes):
+                    r = _conditionalBody(request, r,
+                                         self._app._etags == "weak")
+                cached = False
+                if self._app._response_cache.active:
+                    cached = self._app._response_cache._written(request, r)
+                if self._app._compression is not None and isinstance(
+                        r, bytes):
+                    r = _compressWhole(request, r, cached)
+                request.write(r)
+
+            if not _isFinished(request):
+                request.finish()
+
+
+    def _process(self, r, request):
+        """
+        Recursively go through r and any child Resources until something
+        returns an IRenderable, then render it and let the result of that
+        bubble back up.
+        """
+        if IResource.providedBy(r):
+            request.render(getChildForRequest(r, request))
+            return _StandInResource
 
-            request.notifyFinish().addErrback(lambda _: d.cancel())
+        if IRenderable.providedBy(r):
+            renderElement(request, r)
+            return _StandInResource
 
-            return d
+        if isinstance(r, FileResponse):
+            r = r.render(request)
 
-        d = defer.maybeDeferred(_execute)
+        if isStreamable(r):
+            return self._stream(r, request)
 
-        def write_response(r):
-            if r is not _StandInResource:
-                if isinstance(r, unicode):
-                    r = r.encode('utf-8')
+        return r
 
-                if (r is not None) and (r != NOT_DONE_YET):
-                    request.write(r)
 
-                if not request_finished[0]:
-                    request.finish()
+    def _stream(self, r, request):
+        """
+        Stream the chunks of C{r}, an iterator or asynchronous iterable, to
+        C{request}, with an L{IterableProducer}.
 
-        def process(r):
-            """
-            Recursively go through r and any child Resources until something
-            returns an IRenderable, then render it and let the result of that
-            bubble back up.
-            """
+        If C{r} fails before any chunk was written, the failure is handled
+        like any other.  Once chunks have been written, the failure is logged
+        and the connection is closed, so that the client can tell the
+        response is incomplete.
 
-            if IResource.providedBy(r):
-                request.render(getChildForRequest(r, request))
-                return _StandInResource
+        @return: A L{Deferred} firing when every chunk was written.
+        """
+        producer = IterableProducer(request, r, self._cooperate)
 
-            if IRenderable.providedBy(r):
-                renderElement(request, r)
-                return _StandInResource
+        def failed(f):
+            if not producer.written or f.check(defer.CancelledError):
+                return f
+            log.err(f, "Unhandled Error streaming response")
+            if not _isFinished(request):
+                request.loseConnection()
+            return _StandInResource
 
-            return r
+        return producer.start().addErrback(failed)
 
-        d.addCallback(process)
 
-        def processing_failed(failure, error_handlers):
+    def _processing_failed(self, failure, request, after=-1):
+        """
+        Handle C{failure} with the first error handler handling it, or with a
+        default response.
+
+        If an error handler fails, its failure is handled in turn by the
+        error handlers registered after it, and so on.
+
+        @param after: Only use the error handlers registered after the one at
+            this position in C{self._app._error_handlers}.
+        @type after: L{int}
+        """
+        while True:
             # The failure processor writes to the request.  If the
             # request is already finished we should suppress failure
             # processing.  We don't return failure here because there
             # is no way to surface this failure to the user if the
             # request is finished.
-            if request_finished[0]:
+            if _isFinished(request):
                 if not failure.check(defer.CancelledError):
                     log.err(failure, "Unhandled Error Processing Request.")
                 return
 
-            # If there are no more registered handlers, apply some defaults
-            if len(error_handlers) == 0:
+            for position, handler in self._app._error_handlers_for(
+                    failure.type):
+                if position > after:
+                    break
+            else:
+                # If there are no more registered handlers, apply some
+                # defaults.
                 if failure.check(HTTPException):
                     he = failure.value
                     request.setResponseCode(he.code)
@@ -261,20 +595,19 @@ class KleinResource(Resource):
                     request.processingFailed(failure)
                     return
 
-            error_handler = error_handlers[0]
-
-            # Each error handler is a tuple of (list_of_exception_types, handler_fn)
-            if failure.check(*error_handler[0]):
-                d = defer.maybeDeferred(self._app.execute_error_handler,
-                                        error_handler[1],
-                                        request,
-                                        failure)
-
-                return d.addErrback(processing_failed, error_handlers[1:])
-
-            return processing_failed(failure, error_handlers[1:])
-
-
-        d.addErrback(processing_failed, self._app._error_handlers)
-        d.addCallback(write_response).addErrback(log.err, _why="Unhandled Error writing response")
-        return server.NOT_DONE_YET
+            try:
+                result = self._app.execute_error_handler(handler, request,
+                                                         failure)
+            except Exception:
+                failure = Failure()
+                after = position
+                continue
+
+            if isinstance(result, defer.Deferred):
+                return result.addErrback(self._processing_failed, request,
+                                         position)
+            if isinstance(result, Failure):
+                failure = result
+                after = position
+                continue
+            return result
@@ -8,8 +8,10 @@ from mock import Mock, patch
 
 from twisted.python.components import registerAdapter
 
+from werkzeug.routing import Rule
+
 from klein import Klein
-from klein.app import KleinRequest
+from klein.app import KleinRequest, _hostname
 from klein.interfaces import IKleinRequest
 from klein.test.util import EqualityTestsMixin
 
@@ -341,3 +343,162 @@ class KleinTestCase(unittest.TestCase):
 
         mock_kr.assert_called_with(app)
         self.assertEqual(mock_kr.return_value, resource)
+
+
+    def test_freeze(self):
+        """
+        L{Klein.freeze} resolves the segment counts of the endpoints and
+        makes further calls to L{Klein.route} and L{Klein.subroute} raise.
+        """
+        app = Klein()
+
+        @app.route("/foo/bar", branch=True)
+        def foo(request):
+            return "foo"
+
+        self.assertFalse(app.frozen)
+        app.freeze()
+        self.assertTrue(app.frozen)
+        self.assertEqual(app._routing.segment_counts,
+                         {"foo": 2, "foo_branch": 2})
+
+        self.assertRaises(RuntimeError, app.route, "/bar")
+        self.assertRaises(RuntimeError, app.subroute("/sub").__enter__)
+
+        c = app.url_map.bind("foo")
+        self.assertEqual(c.match("/foo/bar"), ("foo", {}))
+
+
+    def test_freezeHosts(self):
+        """
+        L{Klein.freeze} also freezes the routes of hosts added with
+        L{Klein.host}, and prevents more from being added.
+        """
+        app = Klein(indexed_routing=True)
+
+        with app.host("example.com") as host:
+            @host.route("/")
+            def root(request):
+                pass
+
+        app.freeze()
+        self.assertIsNot(app._hosts[u"example.com"].route_index._root, None)
+        self.assertRaises(RuntimeError, app.host("example.com").__enter__)
+
+
+    def test_hostname(self):
+        """
+        L{_hostname} strips the port from a server name and lower cases it.
+        """
+        self.assertEqual(_hostname(u"Example.COM"), u"example.com")
+        self.assertEqual(_hostname(u"example.com:8080"), u"example.com")
+        self.assertEqual(_hostname(u"[::1]:8080"), u"[::1]")
+        self.assertEqual(_hostname(u"[::1]"), u"[::1]")
+
+
+    def test_errorHandlersFor(self):
+        """
+        L{Klein._error_handlers_for} finds the error handlers of an exception
+        type in the order they were registered, remembering them until more
+        are registered, also through bound instances.
+        """
+        app = Klein()
+
+        @app.handle_errors(LookupError)
+        def lookupError(request, failure):
+            pass
+
+        @app.handle_errors(ValueError, KeyError)
+        def valueOrKeyError(request, failure):
+            pass
+
+        self.assertEqual(app._error_handlers_for(KeyError),
+                         ((0, lookupError), (1, valueOrKeyError)))
+        self.assertEqual(app._error_handlers_for(TypeError), ())
+        self.assertIn(KeyError, app._error_dispatch)
+
+        class Thing(object):
+            bound = app
+
+        bound = Thing().bound
+
+        @bound.handle_errors
+        def anything(request, failure):
+            pass
+
+        self.assertEqual(app._error_dispatch, {})
+        self.assertEqual(app._error_handlers_for(TypeError),
+                         ((2, anything),))
+
+
+    def test_freezeLateDecorator(self):
+        """
+        A route decorator created before L{Klein.freeze} was called raises
+        when it is applied afterwards.
+        """
+        app = Klein()
+        deco = app.route("/foo")
+        app.freeze()
+
+        def foo(request):
+            return "foo"
+
+        self.assertRaises(RuntimeError, deco, foo)
+        self.assertEqual(app.endpoints, {})
+
+
+    def test_freezeValidates(self):
+        """
+        L{Klein.freeze} raises L{ValueError} if a rule has no handler.
+        """
+        app = Klein()
+        app.url_map.add(Rule("/foo", endpoint="foo"))
+        self.assertRaises(ValueError, app.freeze)
+        self.assertFalse(app.frozen)
+
+
+    def test_freezeSharedWithBoundInstances(self):
+        """
+        Freezing a L{Klein} also freezes the instances bound from it, even
+        those bound beforehand.
+        """
+        class Foo(object):
+            app = Klein(indexed_routing=True)
+
+            @app.route("/foo")
+            def foo(self, request):
+                return "foo"
+
+        foo = Foo()
+        bound = foo.app
+        Foo.app.freeze()
+
+        self.assertTrue(bound.frozen)
+        self.assertTrue(Foo().app.frozen)
+        self.assertIsNot(bound._route_index._root, None)
+
+
+    @patch('klein.app.KleinResource')
+    def test_resourceFreeze(self, mock_kr):
+        """
+        L{Klein.resource} freezes the app when asked to.
+        """
+        app = Klein()
+        app.resource()
+        self.assertFalse(app.frozen)
+        app.resource(freeze=True)
+        self.assertTrue(app.frozen)
+
+
+    @patch('klein.app.KleinResource')
+    @patch('klein.app.Site')
+    @patch('klein.app.log')
+    @patch('klein.app.reactor')
+    def test_runFreeze(self, reactor, mock_log, mock_site, mock_kr):
+        """
+        L{Klein.run} freezes the app when asked to.
+        """
+        app = Klein()
+        app.run("localhost", 8080, freeze=True)
+        self.assertTrue(app.frozen)
+        mock_kr.assert_called_with(app)
@@ -0,0 +1,433 @@
+"""
+Tests for L{klein._body}.
+"""
+
+from __future__ import absolute_import, division
+
+import hashlib
+import sys
+
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import SkipTest
+from twisted.web.server import Site
+
+from klein import Klein, RequestBodyTooLarge, StreamingRequest
+from klein import _body
+from klein._coroutines import ensureDeferred
+from klein._stream import _StopAsyncIteration
+from klein.interfaces import IKleinRequest
+from klein.test.test_compression import _parse
+from klein.test.test_coroutines import _define
+from klein.test.test_resource import _AppTestMixin
+from klein.test.util import TestCase
+
+
+
+class BufferedBodyTests(_AppTestMixin, TestCase):
+    """
+    Tests for the bodies of requests buffered by C{twisted.web}.
+    """
+
+    def test_read(self):
+        """
+        The buffered body is read whole, or in chunks.
+        """
+        @self.app.route("/", methods=["POST"])
+        def root(request):
+            return IKleinRequest(request).body.read()
+
+        @self.app.route("/chunks", methods=["POST"])
+        def chunks(request):
+            body = IKleinRequest(request).body
+            body.chunk_size = 3
+            chunks = []
+            while True:
+                chunk = self.successResultOf(body.next_chunk())
+                chunks.append(chunk)
+                if not chunk:
+                    return b"|".join(chunks)
+
+        request = self.get(b"/", method=b"POST", body=b"the body")
+        self.assertEqual(request.getWrittenData(), b"the body")
+
+        request = self.get(b"/chunks", method=b"POST", body=b"the body")
+        self.assertEqual(request.getWrittenData(), b"the| bo|dy|")
+
+
+    def test_maxBodySize(self):
+        """
+        Requests whose body is larger than the C{max_body_size} of their
+        route are answered with 413 without calling its handler.
+        """
+        calls = []
+
+        @self.app.route("/", methods=["POST"], max_body_size=4)
+        def root(request):
+            calls.append(request)
+            return b"ok"
+
+        request = self.get(b"/", method=b"POST", body=b"12345")
+        self.assertEqual(request.code, 413)
+        self.assertEqual(calls, [])
+
+        request = self.get(b"/", method=b"POST", body=b"1234")
+        self.assertEqual(request.getWrittenData(), b"ok")
+
+
+    def test_appMaxBodySize(self):
+        """
+        The C{max_body_size} of the app is the default of its routes.
+        """
+        self.app = Klein(max_body_size=2)
+        self.kr = self.app.resource()
+
+        @self.app.route("/", methods=["POST"])
+        def root(request):
+            return b"ok"
+
+        request = self.get(b"/", method=b"POST", body=b"123")
+        self.assertEqual(request.code, 413)
+
+
+    def test_errorHandler(self):
+        """
+        Error handlers can deal with L{RequestBodyTooLarge}.
+        """
+        @self.app.route("/", methods=["POST"], max_body_size=1)
+        def root(request):
+            return b"ok"
+
+        @self.app.handle_errors(RequestBodyTooLarge)
+        def tooLarge(request, failure):
+            request.setResponseCode(413)
+            return u"at most {0} bytes".format(
+                failure.value.max_size).encode("ascii")
+
+        request = self.get(b"/", method=b"POST", body=b"12")
+        self.assertEqual(request.getWrittenData(), b"at most 1 bytes")
+
+
+
+class StreamingRequestTests(TestCase):
+    """
+    Tests for L{StreamingRequest}.
+    """
+
+    def setUp(self):
+        self.app = Klein()
+        self.bodies = []
+
+        @self.app.route("/", methods=["POST"], max_body_size=100)
+        def root(request):
+            body = IKleinRequest(request).body
+            self.bodies.append(body)
+            return body.read()
+
+        site = Site(self.app.resource(), timeout=None)
+        site.requestFactory = StreamingRequest
+        self.channel = site.buildProtocol(None)
+        self.transport = StringTransport()
+        self.channel.makeConnection(self.transport)
+        self.addCleanup(self.channel.connectionLost, Failure(Exception()))
+
+
+    def body(self):
+        """
+        The body of the response written so far.
+        """
+        return _parse(self.transport.value())[2]
+
+
+    def send(self, path=b"/", headers=b"", body=b""):
+        self.channel.dataReceived(b"POST " + path + b" HTTP/1.1\r\n"
+                                  b"Host: localhost\r\n" + headers +
+                                  b"\r\n" + body)
+
+
+    def test_streamed(self):
+        """
+        Requests are routed before their body has been received, and their
+        handlers get the chunks of the body as they are received.
+        """
+        self.send(headers=b"Content-Length: 10\r\n", body=b"01234")
+        [body] = self.bodies
+        self.assertEqual((body.length, body.received, body.complete),
+                         (10, 5, False))
+        self.assertEqual(self.transport.value(), b"")
+
+        self.channel.dataReceived(b"56789")
+        self.assertTrue(body.complete)
+        self.assertIn(b"200 OK", self.transport.value())
+        self.assertEqual(self.body(), b"0123456789")
+
+
+    def test_nextChunk(self):
+        """
+        L{RequestBody.next_chunk} fires with each chunk once it is received,
+        and with C{b""} at the end.
+        """
+        chunks = []
+
+        @self.app.route("/chunks", methods=["POST"])
+        def chunked(request):
+            body = IKleinRequest(request).body
+            self.bodies.append(body)
+            body.next_chunk().addCallback(chunks.append)
+            return Deferred()
+
+        self.send(b"/chunks", headers=b"Content-Length: 4\r\n")
+        self.assertEqual(chunks, [])
+        self.channel.dataReceived(b"ab")
+        self.assertEqual(chunks, [b"ab"])
+
+        [body] = self.bodies
+        body.next_chunk().addCallback(chunks.append)
+        self.channel.dataReceived(b"cd")
+        body.next_chunk().addCallback(chunks.append)
+        self.assertEqual(chunks, [b"ab", b"cd", b""])
+
+
+    def test_consume(self):
+        """
+        L{RequestBody.consume} gives each chunk to a function as it is
+        received, so that the body can be hashed without keeping it.
+        """
+        digest = hashlib.sha256()
+        done = []
+
+        @self.app.route("/hash", methods=["POST"])
+        def hashed(request):
+            d = IKleinRequest(request).body.consume(digest.update)
+            d.addCallback(done.append)
+            return d.addCallback(lambda _: digest.hexdigest())
+
+        self.send(b"/hash", headers=b"Content-Length: 6\r\n", body=b"abc")
+        self.assertEqual(done, [])
+        self.channel.dataReceived(b"def")
+        self.assertEqual(done, [None])
+        self.assertEqual(
+            self.body(), hashlib.sha256(b"abcdef").hexdigest().encode("ascii"))
+
+
+    def test_asyncFor(self):
+        """
+        Handlers can read the body with C{async for}.
+        """
+        if (sys.version_info < (3, 5) or ensureDeferred is None or
+                _StopAsyncIteration is None):
+            raise SkipTest("async for requires Python 3.5 or later.")
+        ns = _define("async def handler(request):\n"
+                     "    chunks = []\n"
+                     "    async for chunk in IKleinRequest(request).body:\n"
+                     "        chunks.append(chunk)\n"
+                     "    return b'|'.join(chunks)\n",
+                     IKleinRequest=IKleinRequest)
+        self.app.route("/async", methods=["POST"])(ns["handler"])
+
+        self.send(b"/async", headers=b"Content-Length: 4\r\n", body=b"ab")
+        self.channel.dataReceived(b"cd")
+        self.assertEqual(self.body(), b"ab|cd")
+
+
+    def test_tooLargeLength(self):
+        """
+        Requests whose C{Content-Length} is larger than the route accepts
+        are answered with 413 before their body is sent, and without telling
+        the client to continue, and the connection is closed.
+        """
+        self.send(headers=b"Content-Length: 1000\r\n"
+                          b"Expect: 100-continue\r\n")
+        response = self.transport.value()
+        self.assertTrue(response.startswith(b"HTTP/1.1 413 "))
+        self.assertNotIn(b"100 Continue", response)
+        self.assertEqual(self.bodies, [])
+        self.assertTrue(self.transport.disconnecting)
+
+
+    def test_tooLargeStreamed(self):
+        """
+        Reading bodies which turn out to be larger than the route accepts
+        fails with L{RequestBodyTooLarge}, and the request is answered with
+        413.
+        """
+        self.send(headers=b"Transfer-Encoding: chunked\r\n",
+                  body=b"32\r\n" + b"x" * 50 + b"\r\n")
+        [body] = self.bodies
+        self.assertEqual(self.transport.value(), b"")
+        self.channel.dataReceived(b"40\r\n" + b"x" * 64 + b"\r\n")
+        self.assertTrue(self.transport.value().startswith(b"HTTP/1.1 413 "))
+        self.assertTrue(self.transport.disconnecting)
+        self.failureResultOf(body.next_chunk(), RequestBodyTooLarge)
+
+
+    def test_pause(self):
+        """
+        The client is paused while more than C{buffer_size} bytes of the
+        body haven't been read, and resumed once they have.
+        """
+        @self.app.route("/slow", methods=["POST"])
+        def slow(request):
+            body = IKleinRequest(request).body
+            body.buffer_size = 4
+            self.bodies.append(body)
+            return Deferred()
+
+        self.send(b"/slow", headers=b"Content-Length: 10\r\n", body=b"abc")
+        self.assertEqual(self.transport.producerState, "producing")
+        self.channel.dataReceived(b"de")
+        self.assertEqual(self.transport.producerState, "paused")
+
+        [body] = self.bodies
+        self.assertEqual(self.successResultOf(body.next_chunk()), b"abc")
+        self.assertEqual(self.transport.producerState, "producing")
+
+
+    def test_answeredEarly(self):
+        """
+        The rest of the body of requests answered before it was received is
+        thrown away, and the connection then takes the next request.
+        """
+        @self.app.route("/early", methods=["POST"])
+        def early(request):
+            return b"early"
+
+        self.send(b"/early", headers=b"Content-Length: 6\r\n", body=b"abc")
+        self.assertEqual(self.body(), b"early")
+        self.channel.dataReceived(b"def")
+        self.assertFalse(self.transport.disconnecting)
+
+        self.transport.clear()
+        self.send(headers=b"Content-Length: 2\r\n", body=b"ok")
+        self.assertEqual(self.body(), b"ok")
+
+
+    def test_buffered(self):
+        """
+        Requests are buffered as usual on channels without the state
+        streaming them relies on.
+        """
+        self.patch(_body, "_channelAttributes",
+                   _body._channelAttributes + ["_missing"])
+        self.send(headers=b"Content-Length: 10\r\n", body=b"01234")
+        self.assertEqual(self.bodies, [])
+
+        self.channel.dataReceived(b"56789")
+        [body] = self.bodies
+        self.assertEqual((body.length, body.received, body.complete),
+                         (10, 10, True))
+        self.assertEqual(self.body(), b"0123456789")
+
+
+
+class JSONTests(_AppTestMixin, TestCase):
+    """
+    Tests for L{IKleinRequest.json}.
+    """
+
+    def setUp(self):
+        _AppTestMixin.setUp(self)
+        self.decoded = []
+
+        @self.app.route("/", methods=["POST"])
+        def root(request):
+            d = IKleinRequest(request).json(max_size=100)
+            d.addCallback(self.decoded.append)
+            return d.addCallback(lambda _: b"ok")
+
+
+    def post(self, body, contentType=b"application/json", path=b"/"):
+        headers = {}
+        if contentType is not None:
+            headers[b"content-type"] = [contentType]
+        return self.get(path, headers, b"POST", body)
+
+
+    def test_json(self):
+        """
+        The body is decoded as JSON, whether its type is C{application/json}
+        or one of its kind.
+        """
+        self.post(b'{"a": [1, 2]}')
+        self.post(b'"text"', b"application/problem+json; charset=utf-8")
+        self.post(u'"\u00e9"'.encode("utf-8"))
+        self.assertEqual(self.decoded, [{u"a": [1, 2]}, u"text", u"\u00e9"])
+
+
+    def test_once(self):
+        """
+        The body is decoded once, however many times it is asked for.
+        """
+        calls = []
+
+        def decoder(data):
+            calls.append(data)
+            return [data]
+
+        @self.app.route("/twice", methods=["POST"])
+        def twice(request):
+            kleinRequest = IKleinRequest(request)
+            first = kleinRequest.json(decoder=decoder)
+            second = kleinRequest.json(decoder=decoder)
+            return first.addCallback(
+                lambda value: second.addCallback(
+                    lambda other: b"same" if value is other else b"other"))
+
+        request = self.post(b"[]", path=b"/twice")
+        self.assertEqual(request.getWrittenData(), b"same")
+        self.assertEqual(calls, [b"[]"])
+
+
+    def test_malformed(self):
+        """
+        Requests whose body is malformed JSON are answered with 400.
+        """
+        for body in b"{", b"", b"\xff":
+            self.assertEqual(self.post(body).code, 400)
+        self.assertEqual(self.decoded, [])
+
+
+    def test_notJSON(self):
+        """
+        Requests whose C{Content-Type} isn't JSON are answered with 415.
+        """
+        for contentType in None, b"text/plain", b"application/jsonp":
+            self.assertEqual(self.post(b"{}", contentType).code, 415)
+
+
+    def test_tooLarge(self):
+        """
+        Requests whose body is larger than C{max_size} are answered with 413.
+        """
+        self.assertEqual(self.post(b"[" + b"1," * 100 + b"1]").code, 413)
+        self.assertEqual(self.decoded, [])
+
+
+    def test_routeLimit(self):
+        """
+        A larger C{max_size} doesn't loosen the C{max_body_size} of the
+        route, even once its handler is called before the body is received.
+        """
+        @self.app.route("/small", methods=["POST"], max_body_size=10)
+        def small(request):
+            d = IKleinRequest(request).json(max_size=1000)
+            d.addCallback(self.decoded.append)
+            return d.addCallback(lambda _: b"ok")
+
+        site = Site(self.kr, timeout=None)
+        site.requestFactory = StreamingRequest
+        channel = site.buildProtocol(None)
+        transport = StringTransport()
+        channel.makeConnection(transport)
+        self.addCleanup(channel.connectionLost, Failure(Exception()))
+
+        body = b"[" + b"1," * 20 + b"1]"
+        channel.dataReceived(
+            b"POST /small HTTP/1.1\r\nHost: localhost\r\n"
+            b"Content-Type: application/json\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n" +
+            u"{0:x}\r\n".format(len(body)).encode("ascii") + body +
+            b"\r\n")
+        self.assertTrue(transport.value().startswith(b"HTTP/1.1 413 "))
+        self.assertEqual(self.decoded, [])
@@ -0,0 +1,259 @@
+"""
+Tests for L{klein._cache}.
+"""
+
+from __future__ import absolute_import, division
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from klein import CachePolicy, Klein
+from klein.test.test_resource import _AppTestMixin, requestMock, _render
+from klein.test.util import TestCase
+
+
+
+class ResponseCacheTests(_AppTestMixin, TestCase):
+    """
+    Tests for routes added with a C{cache}, and L{ResponseCache}.
+    """
+
+    def setUp(self):
+        _AppTestMixin.setUp(self)
+        self.clock = Clock()
+        self.app.response_cache._clock = self.clock
+        self.calls = []
+
+
+    def counting(self, path, **kwargs):
+        """
+        Add a route for C{path}, counting the calls of its handler, and
+        answering with their number.
+        """
+        @self.app.route(path, **kwargs)
+        def counted(request, **kwargs):
+            self.calls.append(request)
+            request.setHeader(b"x-call", str(len(self.calls)).encode("ascii"))
+            return u"call {0}".format(len(self.calls)).encode("ascii")
+
+
+    def test_hit(self):
+        """
+        Responses are served from the cache, with their code and headers,
+        without calling the handler or matching the URL.
+        """
+        self.counting("/", cache=10)
+        first = self.get(b"/")
+        self.app._match = None
+        second = self.get(b"/")
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(second.getWrittenData(), b"call 1")
+        self.assertEqual(second.code, 200)
+        self.assertEqual(second.responseHeaders.getRawHeaders(b"x-call"),
+                         [b"1"])
+        self.assertEqual(first.getWrittenData(), b"call 1")
+
+
+    def test_ttl(self):
+        """
+        Responses are served from the cache for C{ttl} seconds.
+        """
+        self.counting("/", cache=10)
+        self.get(b"/")
+        self.clock.advance(9)
+        self.assertEqual(self.get(b"/").getWrittenData(), b"call 1")
+        self.clock.advance(1)
+        self.assertEqual(self.get(b"/").getWrittenData(), b"call 2")
+
+
+    def test_key(self):
+        """
+        Responses are told apart by the selected query arguments and headers,
+        and not by the others.
+        """
+        self.counting("/", cache=CachePolicy(
+            ttl=10, query_args=["page"], vary=["Accept-Language"]))
+
+        self.assertEqual(self.get(b"/?page=1&x=1").getWrittenData(),
+                         b"call 1")
+        self.assertEqual(self.get(b"/?page=1&x=2").getWrittenData(),
+                         b"call 1")
+        self.assertEqual(self.get(b"/?page=2").getWrittenData(), b"call 2")
+        french = self.get(b"/?page=1", headers={b"accept-language": [b"fr"]})
+        self.assertEqual(french.getWrittenData(), b"call 3")
+        self.assertEqual(french.responseHeaders.getRawHeaders(b"vary"),
+                         [b"accept-language"])
+
+
+    def test_scheme(self):
+        """
+        Responses to C{http} and C{https} requests are told apart.
+        """
+        self.counting("/", cache=10)
+        for isSecure, expected in [(False, b"call 1"), (True, b"call 2"),
+                                   (False, b"call 1"), (True, b"call 2")]:
+            request = requestMock(b"/", isSecure=isSecure)
+            self.successResultOf(_render(self.kr, request))
+            self.assertEqual(request.getWrittenData(), expected)
+
+
+    def test_date(self):
+        """
+        The C{Date} of a cached response isn't served with it again.
+        """
+        self.counting("/", cache=10)
+        first = requestMock(b"/")
+        first.setHeader(b"date", b"Thu, 01 Jan 1970 00:00:00 GMT")
+        self.successResultOf(_render(self.kr, first))
+        second = self.get(b"/")
+        self.assertEqual(second.getWrittenData(), b"call 1")
+        self.assertEqual(second.responseHeaders.getRawHeaders(b"date"), None)
+
+
+    def test_varyMerged(self):
+        """
+        The headers in C{vary} are added to the C{Vary} header the handler
+        set, rather than replacing it, on cached responses too.
+        """
+        @self.app.route("/", cache=CachePolicy(ttl=10,
+                                               vary=["Accept-Language"]))
+        def root(request):
+            request.setHeader(b"vary", b"Cookie, Accept-Language")
+            return b"root"
+
+        @self.app.route("/replaced", cache=CachePolicy(
+            ttl=10, vary=["Accept-Language"]))
+        def replaced(request):
+            request.setHeader(b"vary", b"Cookie")
+            return b"replaced"
+
+        for i in range(2):
+            self.assertEqual(
+                self.get(b"/").responseHeaders.getRawHeaders(b"vary"),
+                [b"Cookie, Accept-Language"])
+            self.assertEqual(
+                self.get(b"/replaced").responseHeaders.getRawHeaders(b"vary"),
+                [b"Cookie", b"accept-language"])
+
+
+    def test_uncacheable(self):
+        """
+        Failed responses, responses setting cookies and responses to methods
+        other than C{GET} aren't cached.
+        """
+        failing = []
+
+        @self.app.route("/fail", cache=10)
+        def fail(request):
+            failing.append(True)
+            request.setResponseCode(500)
+            return b"nope"
+
+        @self.app.route("/cookie", cache=10)
+        def cookie(request):
+            request.addCookie(b"session", str(len(self.calls)))
+            self.calls.append(request)
+            return b"cookie"
+
+        self.counting("/post", cache=10, methods=["POST"])
+
+        self.get(b"/fail")
+        self.get(b"/fail")
+        self.get(b"/cookie")
+        self.get(b"/cookie")
+        self.get(b"/post", method=b"POST")
+        self.get(b"/post", method=b"POST")
+        self.assertEqual((len(failing), len(self.calls)), (2, 4))
+        self.assertEqual(len(self.app.response_cache), 0)
+
+
+    def test_exception(self):
+        """
+        Responses of error handlers to the failures of handlers aren't
+        cached.
+        """
+        later = Deferred()
+
+        @self.app.route("/", cache=10)
+        def root(request):
+            self.calls.append(request)
+            return later
+
+        @self.app.handle_errors(KeyError)
+        def keyError(request, failure):
+            return b"handled"
+
+        request = requestMock(b"/")
+        d = _render(self.kr, request)
+        later.errback(KeyError())
+        self.successResultOf(d)
+        self.assertEqual(request.getWrittenData(), b"handled")
+        self.assertEqual(len(self.app.response_cache), 0)
+
+
+    def test_eviction(self):
+        """
+        The least recently used responses are evicted to keep the cache
+        within C{max_bytes}.
+        """
+        self.counting("/<name>", cache=10)
+        self.get(b"/a")
+        self.app.response_cache.max_bytes = self.app.response_cache.size * 2
+        self.get(b"/b")
+        # Use a, so that b is evicted rather than a.
+        self.get(b"/a")
+        self.get(b"/c")
+
+        self.assertEqual(len(self.app.response_cache), 2)
+        self.assertEqual(self.get(b"/a").getWrittenData(), b"call 1")
+        self.assertEqual(self.get(b"/b").getWrittenData(), b"call 4")
+        self.assertTrue(
+            self.app.response_cache.size <=
+            self.app.response_cache.max_bytes)
+
+
+    def test_invalidate(self):
+        """
+        L{ResponseCache.invalidate} removes the responses of an endpoint,
+        or for a path.
+        """
+        self.counting("/<name>", cache=10)
+
+        @self.app.route("/other/", cache=10)
+        def other(request):
+            return b"other"
+
+        self.get(b"/a")
+        self.get(b"/b")
+        self.get(b"/other/")
+        cache = self.app.response_cache
+
+        self.assertEqual(cache.invalidate(path=u"/a"), 1)
+        self.assertEqual(self.get(b"/a").getWrittenData(), b"call 3")
+        self.assertEqual(self.get(b"/b").getWrittenData(), b"call 2")
+
+        self.assertEqual(cache.invalidate(endpoint=u"counted"), 2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.invalidate(), 1)
+        self.assertEqual(cache.size, 0)
+
+
+    def test_bound(self):
+        """
+        The cache is shared by the instances bound from an app.
+        """
+        class Application(object):
+            app = Klein()
+
+            @app.route("/", cache=10)
+            def root(self, request):
+                return self.name
+
+        first, second = Application(), Application()
+        first.name, second.name = b"first", b"second"
+        for instance in first, second:
+            request = requestMock(b"/")
+            self.successResultOf(_render(instance.app.resource(), request))
+            self.assertEqual(request.getWrittenData(), b"first")
+        self.assertEqual(len(Application.app.response_cache), 1)
@@ -0,0 +1,297 @@
+"""
+Tests for L{klein._compression}.
+"""
+
+from __future__ import absolute_import, division
+
+import zlib
+
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.web.server import Site
+
+from klein import Compression, FileResponse, Klein
+from klein._compression import _negotiate
+from klein.test.util import TestCase
+
+
+
+def _parse(response):
+    """
+    Parse the C{response} written to a transport: its code, its headers,
+    and the chunks of its body received so far.
+    """
+    head, _, body = response.partition(b"\r\n\r\n")
+    lines = head.split(b"\r\n")
+    code = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        headers.setdefault(name.strip().lower(), []).append(value.strip())
+    if headers.get(b"transfer-encoding") == [b"chunked"]:
+        chunks = []
+        while body:
+            size, _, rest = body.partition(b"\r\n")
+            size = int(size, 16)
+            if not size:
+                break
+            chunks.append(rest[:size])
+            body = rest[size + 2:]
+        body = b"".join(chunks)
+    return code, headers, body
+
+
+
+class NegotiateTests(TestCase):
+    """
+    Tests for L{_negotiate}.
+    """
+
+    def test_negotiate(self):
+        """
+        The accepted coding with the highest quality is chosen, preferring
+        gzip to deflate.
+        """
+        self.assertEqual(_negotiate(b"gzip, deflate, br"), b"gzip")
+        self.assertEqual(_negotiate(b"deflate"), b"deflate")
+        self.assertEqual(_negotiate(b"gzip;q=0.5, deflate"), b"deflate")
+        self.assertEqual(_negotiate(b"*"), b"gzip")
+        self.assertEqual(_negotiate(b"*, gzip;q=0"), b"deflate")
+        self.assertIdentical(_negotiate(b"identity"), None)
+        self.assertIdentical(_negotiate(b"gzip;q=0"), None)
+
+
+
+class CompressionTests(TestCase):
+    """
+    Tests for apps made with C{compression}.
+    """
+
+    def setUp(self):
+        self.compression = Compression(min_size=100)
+        self.app = Klein(compression=self.compression)
+        self.body = b"compress me! " * 100
+
+        @self.app.route("/")
+        def root(request):
+            return self.body
+
+
+    def request(self, path=b"/", acceptEncoding=b"gzip", method=b"GET"):
+        """
+        Make a request to the app through an HTTP channel.
+
+        @return: The transport the response is written to.
+        """
+        site = Site(self.app.resource(), timeout=None)
+        channel = site.buildProtocol(None)
+        transport = StringTransport()
+        channel.makeConnection(transport)
+        headers = b""
+        if acceptEncoding is not None:
+            headers = b"Accept-Encoding: " + acceptEncoding + b"\r\n"
+        channel.dataReceived(method + b" " + path + b" HTTP/1.1\r\n"
+                             b"Host: localhost\r\n" + headers + b"\r\n")
+        self.addCleanup(channel.connectionLost, Failure(Exception()))
+        return transport
+
+
+    def get(self, path=b"/", acceptEncoding=b"gzip"):
+        return _parse(self.request(path, acceptEncoding).value())
+
+
+    def test_gzip(self):
+        """
+        Bodies are compressed with the negotiated coding.
+        """
+        code, headers, body = self.get()
+        self.assertEqual(code, 200)
+        self.assertEqual(headers[b"content-encoding"], [b"gzip"])
+        self.assertIn(b"accept-encoding", headers[b"vary"])
+        self.assertTrue(len(body) < len(self.body))
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+                         self.body)
+
+
+    def test_contentLength(self):
+        """
+        Whole bodies are written with the length of their compressed body,
+        rather than chunked.
+        """
+        code, headers, body = self.get()
+        self.assertNotIn(b"transfer-encoding", headers)
+        self.assertEqual(headers[b"content-length"],
+                         [u"{0}".format(len(body)).encode("ascii")])
+
+
+    def test_deflate(self):
+        """
+        Bodies are compressed with deflate if the client prefers it.
+        """
+        code, headers, body = self.get(acceptEncoding=b"deflate")
+        self.assertEqual(headers[b"content-encoding"], [b"deflate"])
+        self.assertEqual(zlib.decompress(body), self.body)
+
+
+    def test_notAccepted(self):
+        """
+        Bodies aren't compressed for clients which don't accept a coding
+        offered.
+        """
+        for acceptEncoding in None, b"br":
+            code, headers, body = self.get(acceptEncoding=acceptEncoding)
+            self.assertNotIn(b"content-encoding", headers)
+            self.assertEqual(body, self.body)
+
+
+    def test_small(self):
+        """
+        Bodies smaller than C{min_size} aren't compressed.
+        """
+        self.body = b"small"
+        code, headers, body = self.get()
+        self.assertNotIn(b"content-encoding", headers)
+        self.assertEqual(body, b"small")
+
+
+    def test_skipTypes(self):
+        """
+        Bodies of types in C{skip_types} aren't compressed, but SVG images
+        are.
+        """
+        @self.app.route("/png")
+        def png(request):
+            request.setHeader(b"content-type", b"image/png")
+            return self.body
+
+        @self.app.route("/svg")
+        def svg(request):
+            request.setHeader(b"content-type", b"image/svg+xml")
+            return self.body
+
+        code, headers, body = self.get(b"/png")
+        self.assertNotIn(b"content-encoding", headers)
+        self.assertEqual(body, self.body)
+        code, headers, body = self.get(b"/svg")
+        self.assertEqual(headers[b"content-encoding"], [b"gzip"])
+
+
+    def test_streamed(self):
+        """
+        Chunks written by handlers are compressed as they are written, so
+        that clients can decompress them right away.
+        """
+        later = Deferred()
+
+        @self.app.route("/stream")
+        def stream(request):
+            request.write(b"first " * 50)
+            return later
+
+        transport = self.request(b"/stream")
+        code, headers, body = _parse(transport.value())
+        self.assertEqual(headers[b"content-encoding"], [b"gzip"])
+        self.assertNotIn(b"content-length", headers)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(body), b"first " * 50)
+
+        later.callback(b"second " * 50)
+        code, headers, body = _parse(transport.value())
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+                         b"first " * 50 + b"second " * 50)
+
+
+    def test_etag(self):
+        """
+        The strong entity tags of compressed responses are made weak.
+        """
+        @self.app.route("/tagged")
+        def tagged(request):
+            request.setHeader(b"etag", b'"v1"')
+            return self.body
+
+        code, headers, body = self.get(b"/tagged")
+        self.assertEqual(headers[b"etag"], [b'W/"v1"'])
+
+
+    def test_cache(self):
+        """
+        The compressed bodies of responses with an C{ETag} written in one
+        piece are cached, within C{cache_bytes} of compressed bodies,
+        evicting the least recently used first.
+        """
+        @self.app.route("/tagged")
+        def tagged(request):
+            request.setHeader(b"etag", b'"tag"')
+            return self.body
+
+        first = self.get(b"/tagged")[2]
+        self.assertEqual(len(self.compression._cached), 1)
+        self.assertEqual(self.get(b"/tagged")[2], first)
+        self.assertEqual(len(self.compression._cached), 1)
+
+        body = self.body
+        self.body = b"something else " * 100
+        second = self.get(b"/tagged")[2]
+        cached = self.compression._cached
+        self.assertEqual(list(cached.values()), [first, second])
+        self.assertEqual(self.compression._cachedBytes,
+                         len(first) + len(second))
+
+        # The least recently used body is evicted first.
+        self.compression.cache_bytes = len(first) + len(second) - 1
+        self.body = body
+        self.get(b"/tagged")
+        self.body = b"something else " * 50
+        third = self.get(b"/tagged")[2]
+        self.assertEqual(list(cached.values()), [first, third])
+        self.assertEqual(self.compression._cachedBytes,
+                         len(first) + len(third))
+
+
+    def test_notCached(self):
+        """
+        The compressed bodies of responses without an C{ETag}, which aren't
+        cached by the app either, aren't cached, since they are unlikely to
+        be written again.
+        """
+        body = self.get()[2]
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+                         self.body)
+        self.assertEqual(len(self.compression._cached), 0)
+
+
+    def test_responseCache(self):
+        """
+        The compressed bodies of responses cached by the app are cached.
+        """
+        @self.app.route("/cached", cache=10)
+        def cached(request):
+            return self.body
+
+        first = self.get(b"/cached")[2]
+        self.assertEqual(list(self.compression._cached.values()), [first])
+        self.assertEqual(self.get(b"/cached")[2], first)
+        self.assertEqual(len(self.compression._cached), 1)
+
+
+    def test_head(self):
+        """
+        Responses to C{HEAD} requests have the headers the responses to
+        C{GET} requests have, also when their body is left out.
+        """
+        path = self.mktemp() + ".txt"
+        with open(path, "wb") as f:
+            f.write(self.body)
+
+        @self.app.route("/file")
+        def file(request):
+            return FileResponse(path)
+
+        for route in [b"/", b"/file"]:
+            code, headers, body = _parse(self.request(
+                route, method=b"HEAD").value())
+            self.assertEqual(body, b"")
+            self.assertEqual(headers[b"content-encoding"], [b"gzip"])
+            self.assertIn(b"accept-encoding", headers[b"vary"])
@@ -0,0 +1,174 @@
+"""
+Tests for L{klein._conditional}.
+"""
+
+from __future__ import absolute_import, division
+
+from twisted.web.http import datetimeToString
+
+from klein import Klein
+from klein.interfaces import IKleinRequest
+from klein.test.test_resource import _AppTestMixin
+from klein.test.util import TestCase
+
+
+
+class ETagTests(_AppTestMixin, TestCase):
+    """
+    Tests for apps made with C{etags}.
+    """
+
+    def setUp(self):
+        _AppTestMixin.setUp(self)
+        self.calls = 0
+
+        @self.app.route("/")
+        def root(request):
+            self.calls += 1
+            return b"content"
+
+
+    def makeApp(self):
+        return Klein(etags=True)
+
+
+    def etag(self, request):
+        return request.responseHeaders.getRawHeaders(b"etag")[0]
+
+
+    def test_etag(self):
+        """
+        Responses get an entity tag made of the hash of their body, which is
+        the same for the same body.
+        """
+        first, second = self.get(), self.get()
+        self.assertEqual(first.getWrittenData(), b"content")
+        self.assertTrue(self.etag(first).startswith(b'"'))
+        self.assertEqual(self.etag(first), self.etag(second))
+
+
+    def test_ifNoneMatch(self):
+        """
+        Requests whose C{If-None-Match} includes the entity tag of the
+        response are answered with 304 and no body.
+        """
+        tag = self.etag(self.get())
+        request = self.get(
+            headers={b"if-none-match": [b'"other", ' + tag]})
+        self.assertEqual(request.code, 304)
+        self.assertEqual(request.getWrittenData(), b"")
+        self.assertEqual(self.etag(request), tag)
+
+        request = self.get(headers={b"if-none-match": [b'"other"']})
+        self.assertEqual(request.code, 200)
+        self.assertEqual(request.getWrittenData(), b"content")
+
+
+    def test_weak(self):
+        """
+        Apps made with C{etags="weak"} give responses weak entity tags, which
+        match C{If-None-Match} with or without the weak indicator.
+        """
+        self.app._etags = "weak"
+        tag = self.etag(self.get())
+        self.assertTrue(tag.startswith(b'W/"'))
+        request = self.get(headers={b"if-none-match": [tag[2:]]})
+        self.assertEqual(request.code, 304)
+
+
+    def test_otherMethods(self):
+        """
+        Requests with methods other than C{GET} and C{HEAD} are answered as
+        usual.
+        """
+        @self.app.route("/post", methods=["POST"])
+        def post(request):
+            return b"posted"
+
+        request = self.get(b"/post", method=b"POST",
+                           headers={b"if-none-match": [b"*"]})
+        self.assertEqual((request.code, request.getWrittenData()),
+                         (200, b"posted"))
+
+
+    def test_disabled(self):
+        """
+        Apps made without C{etags} don't tag responses.
+        """
+        app = Klein()
+
+        @app.route("/")
+        def root(request):
+            return b"content"
+
+        self.kr = app.resource()
+        request = self.get()
+        self.assertIdentical(
+            request.responseHeaders.getRawHeaders(b"etag"), None)
+
+
+    def test_cached(self):
+        """
+        Responses served from the response cache are tagged, and answered
+        with 304 if the client has them.
+        """
+        @self.app.route("/cached", cache=10)
+        def cached(request):
+            return b"cached"
+
+        tag = self.etag(self.get(b"/cached"))
+        request = self.get(b"/cached", headers={b"if-none-match": [tag]})
+        self.assertEqual(request.code, 304)
+        self.assertEqual(request.getWrittenData(), b"")
+
+
+
+class NotModifiedTests(_AppTestMixin, TestCase):
+    """
+    Tests for L{IKleinRequest.not_modified}.
+    """
+
+    def setUp(self):
+        _AppTestMixin.setUp(self)
+        self.work = []
+
+        @self.app.route("/")
+        def root(request):
+            if IKleinRequest(request).not_modified(
+                    version=u"v2", last_modified=1000000000):
+                return b""
+            self.work.append(True)
+            return b"expensive"
+
+
+    def test_version(self):
+        """
+        Handlers giving the version the client has answer with 304 before
+        doing their work.
+        """
+        request = self.get(headers={b"if-none-match": [b'"v2"']})
+        self.assertEqual(request.code, 304)
+        self.assertEqual(self.work, [])
+        self.assertEqual(request.responseHeaders.getRawHeaders(b"etag"),
+                         [b'"v2"'])
+
+        request = self.get(headers={b"if-none-match": [b'"v1"']})
+        self.assertEqual(request.code, 200)
+        self.assertEqual(request.getWrittenData(), b"expensive")
+
+
+    def test_lastModified(self):
+        """
+        Without C{If-None-Match}, C{If-Modified-Since} is compared with the
+        last modification time.
+        """
+        request = self.get(
+            headers={b"if-modified-since": [datetimeToString(1000000000)]})
+        self.assertEqual(request.code, 304)
+
+        request = self.get(
+            headers={b"if-modified-since": [datetimeToString(999999999)]})
+        self.assertEqual(request.code, 200)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b"last-modified"),
+            [datetimeToString(1000000000)])
@@ -0,0 +1,157 @@
+"""
+Tests for handlers defined with C{async def}.
+"""
+
+from __future__ import absolute_import, division
+
+import sys
+
+from twisted.internet.defer import CancelledError, Deferred, succeed
+from twisted.internet.error import ConnectionLost
+from twisted.web.template import slot, tags
+
+from klein import Klein, Plating
+from klein._coroutines import ensureDeferred, maybeEnsureDeferred
+from klein.test.test_resource import requestMock, _render
+from klein.test.util import TestCase
+
+
+if sys.version_info < (3, 5):
+    skip = "async def requires Python 3.5 or later."
+elif ensureDeferred is None:
+    skip = "async def handlers require ensureDeferred."
+
+
+
+def _define(source, **namespace):
+    """
+    Define the functions of C{source}, which Python 2 can't compile.
+
+    @return: A L{dict} of the names defined by C{source}.
+    """
+    exec(source, namespace)
+    return namespace
+
+
+
+class MaybeEnsureDeferredTests(TestCase):
+    """
+    Tests for L{maybeEnsureDeferred}.
+    """
+
+    def test_coroutine(self):
+        """
+        A coroutine is driven by a L{Deferred} firing with its result.
+        """
+        ns = _define("async def f(d):\n"
+                     "    return (await d) + 1\n")
+        d = maybeEnsureDeferred(ns["f"](succeed(1)))
+        self.assertIsInstance(d, Deferred)
+        self.assertEqual(self.successResultOf(d), 2)
+
+
+    def test_notCoroutine(self):
+        """
+        Anything but a coroutine is returned unchanged.
+        """
+        d = Deferred()
+        self.assertIdentical(maybeEnsureDeferred(d), d)
+        self.assertEqual(maybeEnsureDeferred(b"ok"), b"ok")
+
+
+
+class AsyncHandlerTests(TestCase):
+    """
+    Tests for routes and error handlers defined with C{async def}.
+    """
+
+    def setUp(self):
+        self.app = Klein()
+        self.kr = self.app.resource()
+
+
+    def test_route(self):
+        """
+        The result of an C{async def} route is awaited and written.
+        """
+        waiting = Deferred()
+        ns = _define("async def root(request):\n"
+                     "    return b'hello ' + (await waiting)\n",
+                     waiting=waiting)
+        self.app.route("/")(ns["root"])
+
+        request = requestMock(b"/")
+        d = _render(self.kr, request)
+        self.assertNoResult(d)
+        waiting.callback(b"world")
+        self.successResultOf(d)
+        self.assertEqual(request.getWrittenData(), b"hello world")
+
+
+    def test_handleErrors(self):
+        """
+        An C{async def} error handler is awaited, and may raise to be handled
+        by the next error handler.
+        """
+        ns = _define(
+            "async def root(request):\n"
+            "    raise KeyError()\n"
+            "async def keyError(request, failure):\n"
+            "    raise ValueError()\n"
+            "async def valueError(request, failure):\n"
+            "    request.setResponseCode(400)\n"
+            "    return b'bad value'\n")
+        self.app.route("/")(ns["root"])
+        self.app.handle_errors(KeyError)(ns["keyError"])
+        self.app.handle_errors(ValueError)(ns["valueError"])
+
+        request = requestMock(b"/")
+        self.successResultOf(_render(self.kr, request))
+        request.setResponseCode.assert_called_with(400)
+        self.assertEqual(request.getWrittenData(), b"bad value")
+
+
+    def test_cancelsOnConnectionLost(self):
+        """
+        When the connection is lost, the L{Deferred} an C{async def} route is
+        awaiting is cancelled.
+        """
+        cancelled = []
+        ns = _define("async def root(request):\n"
+                     "    try:\n"
+                     "        return await Deferred()\n"
+                     "    except CancelledError:\n"
+                     "        cancelled.append(True)\n"
+                     "        raise\n",
+                     Deferred=Deferred, CancelledError=CancelledError,
+                     cancelled=cancelled)
+        self.app.route("/")(ns["root"])
+
+        request = requestMock(b"/")
+        d = _render(self.kr, request)
+        self.assertNoResult(d)
+
+        request.connectionLost(ConnectionLost())
+        d.addErrback(lambda f: f.trap(ConnectionLost))
+        self.successResultOf(d)
+        self.assertEqual(cancelled, [True])
+
+
+    def test_plating(self):
+        """
+        An C{async def} function decorated with L{Plating.routed} is awaited
+        before its result is rendered.
+        """
+        page = Plating(tags=tags.html(tags.body(slot(Plating.CONTENT))))
+        ns = _define("async def root(request):\n"
+                     "    return {'ok': await waiting}\n",
+                     waiting=succeed(u"yes"))
+        page.routed(self.app.route("/"), tags.span(slot("ok")))(ns["root"])
+
+        request = requestMock(b"/")
+        self.successResultOf(_render(self.kr, request))
+        self.assertIn(b"<span>yes</span>", request.getWrittenData())
+
+        request = requestMock(b"/?json=1")
+        self.successResultOf(_render(self.kr, request))
+        self.assertEqual(request.getWrittenData(), b'{"ok": "yes"}')
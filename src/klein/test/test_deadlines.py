@@ -0,0 +1,143 @@
+"""
+Tests for L{klein._deadlines}.
+"""
+
+from __future__ import absolute_import, division
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from klein import DeadlineExceeded, Klein
+from klein.interfaces import IKleinRequest
+from klein.test.test_resource import _AppTestMixin, requestMock, _render
+from klein.test.util import TestCase
+
+
+
+class DeadlineTests(_AppTestMixin, TestCase):
+    """
+    Tests for the C{timeout} of routes and apps.
+    """
+
+    def setUp(self):
+        _AppTestMixin.setUp(self)
+        self.clock = Clock()
+        self.app._clock = self.clock
+        self.cancelled = []
+        self.later = Deferred(self.cancelled.append)
+
+
+    def test_timeout(self):
+        """
+        The L{Deferred} of handlers which don't answer before their timeout
+        is cancelled, and the request is answered with 504.
+        """
+        @self.app.route("/", timeout=5)
+        def root(request):
+            return self.later
+
+        request = requestMock(b"/")
+        d = _render(self.kr, request)
+        self.clock.advance(4)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.successResultOf(d)
+        self.assertEqual(self.cancelled, [self.later])
+        self.assertEqual(request.code, 504)
+
+
+    def test_inTime(self):
+        """
+        Handlers answering before their timeout are answered as usual, and
+        aren't cancelled later.
+        """
+        @self.app.route("/", timeout=5)
+        def root(request):
+            return self.later
+
+        request = requestMock(b"/")
+        d = _render(self.kr, request)
+        self.later.callback(b"ok")
+        self.successResultOf(d)
+        self.assertEqual(request.getWrittenData(), b"ok")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_errorHandler(self):
+        """
+        L{DeadlineExceeded} goes through the error handlers.
+        """
+        @self.app.route("/", timeout=5)
+        def root(request):
+            return self.later
+
+        @self.app.handle_errors(DeadlineExceeded)
+        def timedOut(request, failure):
+            return u"too slow: {0}".format(
+                failure.value.timeout).encode("ascii")
+
+        request = requestMock(b"/")
+        d = _render(self.kr, request)
+        self.clock.advance(5)
+        self.successResultOf(d)
+        self.assertEqual(request.getWrittenData(), b"too slow: 5")
+
+
+    def test_appTimeout(self):
+        """
+        Routes without a timeout have the timeout of the app.
+        """
+        app = Klein(timeout=2)
+        app._clock = self.clock
+
+        @app.route("/")
+        def root(request):
+            return self.later
+
+        request = requestMock(b"/")
+        d = _render(app.resource(), request)
+        self.clock.advance(2)
+        self.successResultOf(d)
+        self.assertEqual(request.code, 504)
+
+
+    def test_remainingTime(self):
+        """
+        Handlers can tell how much time they have left from the
+        L{IKleinRequest} of their request.
+        """
+        remaining = []
+
+        @self.app.route("/", timeout=5)
+        def root(request):
+            def check(result):
+                remaining.append(IKleinRequest(request).remaining_time())
+                return result
+            return self.later.addCallback(check)
+
+        @self.app.route("/none")
+        def none(request):
+            return str(IKleinRequest(request).remaining_time()).encode(
+                "ascii")
+
+        d = _render(self.kr, requestMock(b"/"))
+        self.clock.advance(3)
+        self.later.callback(b"ok")
+        self.successResultOf(d)
+        self.assertEqual(remaining, [2])
+
+        request = self.get(b"/none")
+        self.assertEqual(request.getWrittenData(), b"None")
+
+
+    def test_synchronous(self):
+        """
+        Handlers answering right away don't schedule a timeout.
+        """
+        @self.app.route("/", timeout=5)
+        def root(request):
+            return b"ok"
+
+        request = self.get()
+        self.assertEqual(request.getWrittenData(), b"ok")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,198 @@
+"""
+Tests for L{klein._dispatch}.
+"""
+
+from __future__ import absolute_import, division
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, Rule
+
+from klein import Klein
+from klein.interfaces import IKleinRequest
+from klein._dispatch import RouteIndex, _literalSegments
+from klein.test.test_resource import requestMock, _render
+from klein.test.util import TestCase
+
+
+
+def _outcome(match, mapper):
+    """
+    Describe the result of matching with C{mapper} in a comparable way.
+    """
+    try:
+        rule, kwargs = match(mapper)
+    except HTTPException as e:
+        return (e.code, sorted(getattr(e, "valid_methods", None) or []),
+                getattr(e, "new_url", None))
+    if rule is None:
+        return (405, sorted(kwargs), None)
+    return rule.endpoint, kwargs
+
+
+
+class RouteIndexTests(TestCase):
+    """
+    Tests for L{RouteIndex}.
+    """
+
+    def setUp(self):
+        self.app = app = Klein()
+
+        def handler(request, **kw):
+            pass
+
+        app.route("/")(handler)
+        app.route("/static/", branch=True, endpoint="static")(handler)
+        app.route("/users/", endpoint="users")(handler)
+        app.route("/users/<int:uid>", endpoint="user")(handler)
+        app.route("/users/<int:uid>", methods=["DELETE"],
+                  endpoint="deleteUser")(handler)
+        app.route("/users/<int:uid>/posts/<slug>", endpoint="post")(handler)
+        app.route("/users/new", endpoint="newUser")(handler)
+        app.route("/loose/", strict_slashes=False, endpoint="loose")(handler)
+        app.route("/files/<path:rest>", endpoint="files")(handler)
+        app.route("/v<int:version>/thing", endpoint="versioned")(handler)
+        app.route("/<name>", endpoint="catchAll", methods=["POST"])(handler)
+        app.route("/defaults/", defaults={"page": 1},
+                  endpoint="paged")(handler)
+        app.route("/defaults/<int:page>", endpoint="paged")(handler)
+        app.route("/old", redirect_to="/users/", endpoint="old")(handler)
+
+        with app.subroute("/sub") as sub:
+            sub.route("/", endpoint="subRoot")(handler)
+            sub.route("/<int:x>", endpoint="subInt")(handler)
+            sub.route("/tree/", branch=True, endpoint="subTree")(handler)
+
+        self.index = RouteIndex(app.url_map)
+
+
+    def assertSameAsWerkzeug(self, path, method=u"GET"):
+        """
+        Matching C{path} with C{method} through the index has the same
+        outcome as matching it with werkzeug.
+        """
+        mapper = self.app.url_map.bind(u"localhost", u"", path_info=path,
+                                       default_method=method)
+        self.assertEqual(
+            _outcome(self.index.match, mapper),
+            _outcome(lambda m: m.match(return_rule=True), mapper))
+
+
+    def test_sameAsWerkzeug(self):
+        """
+        Matching through the index always has the same outcome as matching
+        with werkzeug.
+        """
+        paths = [u"", u"/", u"/static", u"/static/", u"/static/a/b.css",
+                 u"/users", u"/users/", u"/users/1", u"/users/x",
+                 u"/users/new", u"/users/1/posts/hello", u"/users/1/posts/",
+                 u"/loose", u"/loose/", u"/files/a/b/c", u"/files/",
+                 u"/v2/thing", u"/vx/thing", u"/whatever", u"/whatever/",
+                 u"/defaults/", u"/defaults/1", u"/defaults/2", u"/old",
+                 u"/sub", u"/sub/", u"/sub/3", u"/sub/tree/x/y", u"/sub/tree",
+                 u"/nope/nope", u"//users//1"]
+        for path in paths:
+            for method in [u"GET", u"POST", u"DELETE", u"HEAD"]:
+                self.assertSameAsWerkzeug(path, method)
+
+
+    def test_candidates(self):
+        """
+        Only rules whose literal segments prefix the path are candidates.
+        """
+        endpoints = [rule.endpoint for rule, regular
+                     in self.index.candidates(u"/users/1")]
+        self.assertIn("user", endpoints)
+        self.assertNotIn("files", endpoints)
+        self.assertNotIn("subInt", endpoints)
+
+
+    def test_methodIndexed(self):
+        """
+        Only rules allowing the method of the request are matched in order,
+        and a path which only matches rules for other methods resolves to the
+        methods those allow.
+        """
+        node = self.index._node(u"/users/1")
+        matching, others = node.forMethod(u"DELETE",
+                                          self.index._knownMethods)
+        self.assertIn("deleteUser", [rule.endpoint for rule, r in matching])
+        self.assertIn("user", [rule.endpoint for rule, r in matching])
+        self.assertIn("catchAll", [rule.endpoint for rule, r in others])
+
+        mapper = self.app.url_map.bind(u"localhost", u"",
+                                       path_info=u"/whatever",
+                                       default_method=u"PUT")
+        self.assertEqual(self.index.match(mapper),
+                         (None, frozenset([u"POST"])))
+
+
+    def test_unknownMethodsShareEntry(self):
+        """
+        Methods no rule mentions share the same candidates, so arbitrary
+        methods don't make the index grow.
+        """
+        node = self.index._node(u"/users/1")
+        first = node.forMethod(u"FOO", self.index._knownMethods)
+        second = node.forMethod(u"BAR", self.index._knownMethods)
+        self.assertIdentical(first, second)
+        self.assertEqual(list(node.byMethod), [None])
+
+
+    def test_invalidate(self):
+        """
+        L{RouteIndex.invalidate} makes the index pick up new rules.
+        """
+        url_map = Map([Rule("/a", endpoint="a")])
+        index = RouteIndex(url_map)
+        mapper = url_map.bind(u"localhost", path_info=u"/b")
+        self.assertEqual(_outcome(index.match, mapper)[0], 404)
+
+        url_map.add(Rule("/b", endpoint="b"))
+        index.invalidate()
+        self.assertEqual(_outcome(index.match, mapper), ("b", {}))
+
+
+    def test_literalSegments(self):
+        """
+        L{_literalSegments} returns the non-empty segments preceding the first
+        converter.
+        """
+        def segments(url):
+            return _literalSegments(Rule(url))
+
+        self.assertEqual(segments("/"), [])
+        self.assertEqual(segments("/a/b/"), ["a", "b"])
+        self.assertEqual(segments("/a/<x>/b"), ["a"])
+        self.assertEqual(segments("/a/b<int:x>"), ["a"])
+
+
+
+class KleinIndexedRoutingTests(TestCase):
+    """
+    Tests for L{Klein}'s C{indexed_routing} option.
+    """
+
+    def test_render(self):
+        """
+        Requests are dispatched through the index, which follows routes added
+        after it was first used.
+        """
+        app = Klein(indexed_routing=True)
+        resource = app.resource()
+
+        @app.route("/foo/<int:bar>")
+        def foo(request, bar):
+            return b"foo"
+
+        request = requestMock(b"/foo/1")
+        self.successResultOf(_render(resource, request))
+        self.assertEqual(request.getWrittenData(), b"foo")
+
+        @app.route("/bar", branch=True)
+        def bar(request):
+            return u"/".join(IKleinRequest(request).branch_segments)
+
+        request = requestMock(b"/bar/baz/quux")
+        self.successResultOf(_render(resource, request))
+        self.assertEqual(request.getWrittenData(), b"baz/quux")
@@ -0,0 +1,529 @@
+"""
+Tests for L{klein._fileresponse}.
+"""
+
+from __future__ import absolute_import, division
+
+import array
+import mmap
+import os
+import shutil
+import socket
+import tempfile
+
+from io import BytesIO
+
+from twisted.internet import reactor, tcp
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import deferLater
+from twisted.python.compat import _PY3
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.server import Site
+
+from klein import FileResponse, Klein
+from klein import _fileresponse
+from klein.test.test_resource import requestMock, _render
+from klein.test.test_stream import _StreamTestMixin
+from klein.test.util import TestCase
+
+
+
+def _temporaryDirectory(testCase):
+    """
+    Make a temporary directory, outside of the working directory of the
+    tests, removed once C{testCase} is done.
+    """
+    directory = tempfile.mkdtemp()
+    testCase.addCleanup(shutil.rmtree, directory)
+    return directory
+
+
+
+class FileResponseTests(_StreamTestMixin, TestCase):
+    """
+    Tests for handlers returning a L{FileResponse}.
+    """
+
+    def setUp(self):
+        _StreamTestMixin.setUp(self)
+        self.body = b"".join(
+            u"{0}".format(i).encode("ascii") for i in range(10)) * 3
+        self.directory = _temporaryDirectory(self)
+
+
+    def serve(self, response, path=b"/", method=b"GET", headers=None):
+        """
+        Serve C{response} from a handler, or the response returned by
+        calling it with the request.
+
+        @return: The request, once its response has been written.
+        """
+        app = Klein()
+        kr = app.resource()
+        kr._cooperate = self.cooperator.cooperate
+
+        @app.route("/", methods=["GET", "HEAD"])
+        def root(request):
+            if callable(response):
+                return response(request)
+            return response
+
+        request = requestMock(path, method=method, headers=headers)
+        d = _render(kr, request)
+        self.pump()
+        self.successResultOf(d)
+        return request
+
+
+    def path(self, name=u"body.txt"):
+        """
+        Write C{self.body} to a file.
+
+        @return: Its path.
+        """
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(self.body)
+        return path
+
+
+    def assertHeader(self, request, name, value):
+        self.assertEqual(request.responseHeaders.getRawHeaders(name),
+                         [value])
+
+
+    def test_buffer(self):
+        """
+        The contents of a buffer are written, in chunks, with their length.
+        """
+        request = self.serve(FileResponse(memoryview(self.body),
+                                          chunk_size=7))
+        self.assertEqual(request.getWrittenData(), self.body)
+        self.assertTrue(request.writeCount > 1)
+        self.assertEqual(request.code, 200)
+        self.assertHeader(request, b"content-length", b"30")
+        self.assertHeader(request, b"content-type",
+                          b"application/octet-stream")
+        self.assertHeader(request, b"accept-ranges", b"bytes")
+
+
+    def test_bufferOfWords(self):
+        """
+        Buffers of items larger than a byte are written as their bytes.
+        """
+        words = array.array("H", range(10))
+        request = self.serve(FileResponse(memoryview(words), chunk_size=7))
+        self.assertEqual(request.getWrittenData(), words.tobytes())
+        self.assertHeader(request, b"content-length", b"20")
+
+    if not _PY3:
+        test_bufferOfWords.skip = "Arrays are not buffers on Py2"
+
+
+    def test_path(self):
+        """
+        The file at a path is written, with a content type guessed from its
+        name.
+        """
+        request = self.serve(FileResponse(self.path()))
+        self.assertEqual(request.getWrittenData(), self.body)
+        self.assertHeader(request, b"content-type", b"text/plain")
+        self.assertHeader(request, b"content-length", b"30")
+
+
+    def test_contentType(self):
+        """
+        The content type given, or set by the handler, is used.
+        """
+        request = self.serve(FileResponse(self.path(),
+                                          content_type=u"text/x-digits"))
+        self.assertHeader(request, b"content-type", b"text/x-digits")
+
+        def setContentType(request):
+            request.setHeader(b"content-type", b"text/csv")
+            return FileResponse(memoryview(self.body))
+
+        request = self.serve(setContentType)
+        self.assertHeader(request, b"content-type", b"text/csv")
+
+
+    def test_fileClosed(self):
+        """
+        A file object is written, and closed afterwards.
+        """
+        f = open(self.path(), "rb")
+        request = self.serve(FileResponse(f))
+        self.assertEqual(request.getWrittenData(), self.body)
+        self.assertTrue(f.closed)
+
+
+    def test_fileWithoutDescriptor(self):
+        """
+        File objects without a descriptor are read.
+        """
+        f = BytesIO(self.body)
+        request = self.serve(FileResponse(f, chunk_size=8))
+        self.assertEqual(request.getWrittenData(), self.body)
+        self.assertHeader(request, b"content-length", b"30")
+        self.assertTrue(f.closed)
+
+
+    def test_mmap(self):
+        """
+        The contents of a memory map are written, and it is left open.
+        """
+        with open(self.path(), "rb") as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.addCleanup(m.close)
+        request = self.serve(FileResponse(m))
+        self.assertEqual(request.getWrittenData(), self.body)
+        # Reading a closed memory map raises ValueError.
+        self.assertEqual(m[:], self.body)
+
+
+    def test_views(self):
+        """
+        The chunks of buffers and memory-mapped files are views of them,
+        written without copying them.
+        """
+        for body in [memoryview(self.body), self.path()]:
+            chunks = list(FileResponse(body, chunk_size=7).render(
+                requestMock(b"/")))
+            self.assertEqual(b"".join(chunks), self.body)
+            for chunk in chunks:
+                self.assertIsInstance(chunk, memoryview)
+
+    if not _PY3:
+        test_views.skip = "Views are copied on Py2"
+
+
+    def test_empty(self):
+        """
+        Empty bodies write nothing.
+        """
+        self.body = b""
+        request = self.serve(FileResponse(self.path()))
+        self.assertEqual(request.getWrittenData(), b"")
+        self.assertHeader(request, b"content-length", b"0")
+
+
+    def test_head(self):
+        """
+        Responses to C{HEAD} requests have the length of the body, but no
+        body.
+        """
+        request = self.serve(FileResponse(self.path()), method=b"HEAD")
+        self.assertEqual(request.getWrittenData(), b"")
+        self.assertHeader(request, b"content-length", b"30")
+
+
+    def test_range(self):
+        """
+        A single range of the body is served with 206.
+        """
+        for range, expected, contentRange in [
+                (b"bytes=2-4", b"234", b"bytes 2-4/30"),
+                (b"bytes=25-", b"56789", b"bytes 25-29/30"),
+                (b"bytes=-3", b"789", b"bytes 27-29/30"),
+                (b"bytes=28-100", b"89", b"bytes 28-29/30"),
+                (b"bytes=-100", self.body, b"bytes 0-29/30")]:
+            request = self.serve(FileResponse(self.path()),
+                                 headers={b"range": [range]})
+            self.assertEqual(request.getWrittenData(), expected)
+            self.assertEqual(request.code, 206)
+            self.assertHeader(request, b"content-range", contentRange)
+            self.assertHeader(request, b"content-length",
+                              u"{0}".format(len(expected)).encode("ascii"))
+
+
+    def test_rangeIgnored(self):
+        """
+        Several ranges, malformed ranges and conditional ranges are ignored.
+        """
+        for headers in [{b"range": [b"bytes=0-1,4-5"]},
+                        {b"range": [b"bytes=4-2"]},
+                        {b"range": [b"lines=1-2"]},
+                        {b"range": [b"bytes=1-2"],
+                         b"if-range": [b'"etag"']}]:
+            request = self.serve(FileResponse(self.path()), headers=headers)
+            self.assertEqual(request.getWrittenData(), self.body)
+            self.assertEqual(request.code, 200)
+            self.assertEqual(
+                request.responseHeaders.getRawHeaders(b"content-range"),
+                None)
+
+
+    def test_rangeNotSatisfiable(self):
+        """
+        A range starting after the end of the body is answered with 416.
+        """
+        f = open(self.path(), "rb")
+        request = self.serve(FileResponse(f),
+                             headers={b"range": [b"bytes=30-"]})
+        self.assertEqual(request.code, 416)
+        self.assertHeader(request, b"content-range", b"bytes */30")
+        self.assertTrue(f.closed)
+
+
+
+class SendfileTests(TestCase):
+    """
+    Tests for writing files with C{os.sendfile}.
+    """
+
+    if getattr(os, "sendfile", None) is None:
+        skip = "os.sendfile is not available."
+
+    def setUp(self):
+        self.sent = []
+        sendfile = os.sendfile
+
+        def recordingSendfile(*args):
+            sent = sendfile(*args)
+            self.sent.append(sent)
+            return sent
+
+        self.patch(os, "sendfile", recordingSendfile)
+
+        app = Klein()
+        self.path = os.path.join(_temporaryDirectory(self), u"body")
+        # Large enough not to fit into the buffer of a socket at once.
+        self.body = os.urandom(2 ** 23)
+        with open(self.path, "wb") as f:
+            f.write(self.body)
+
+        self.use_sendfile = True
+
+        @app.route("/")
+        def root(request):
+            self.request = request
+            return FileResponse(self.path, use_sendfile=self.use_sendfile)
+
+        port = reactor.listenTCP(0, Site(app.resource()),
+                                 interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.url = u"http://127.0.0.1:{0}/".format(
+            port.getHost().port).encode("ascii")
+
+
+    @inlineCallbacks
+    def get(self, headers=None):
+        """
+        Get the file from the server.
+
+        @return: A L{Deferred} firing with the response and its body.
+        """
+        response = yield Agent(reactor).request(
+            b"GET", self.url, Headers(headers or {}))
+        body = yield readBody(response)
+        # Let the server see the connection go.
+        yield deferLater(reactor, 0, lambda: None)
+        returnValue((response, body))
+
+
+    @inlineCallbacks
+    def test_sendfile(self):
+        """
+        Files are written to plain TCP connections with C{os.sendfile} when
+        asked to.
+        """
+        response, body = yield self.get()
+        self.assertEqual(response.code, 200)
+        self.assertEqual(body, self.body)
+        self.assertEqual(sum(self.sent), len(self.body))
+
+
+    @inlineCallbacks
+    def test_sentLength(self):
+        """
+        What is written with C{os.sendfile} is counted in the C{sentLength}
+        of the request, as what is written to it is.
+        """
+        yield self.get()
+        self.assertEqual(self.request.sentLength, len(self.body))
+
+
+    @inlineCallbacks
+    def test_notByDefault(self):
+        """
+        Files are only written with C{os.sendfile} when asked to.
+        """
+        self.use_sendfile = FileResponse(self.path).use_sendfile
+        response, body = yield self.get()
+        self.assertEqual(response.code, 200)
+        self.assertEqual(body, self.body)
+        self.assertEqual(self.sent, [])
+
+
+    @inlineCallbacks
+    def test_sendfileRange(self):
+        """
+        Ranges of files are written with C{os.sendfile} too.
+        """
+        response, body = yield self.get({b"range": [b"bytes=10-1000009"]})
+        self.assertEqual(response.code, 206)
+        self.assertEqual(body, self.body[10:1000010])
+        self.assertEqual(sum(self.sent), 1000000)
+
+
+    @inlineCallbacks
+    def test_unknownTransport(self):
+        """
+        Files are written as usual to transports without the private state
+        of L{twisted.internet.tcp.Connection} that writing to their socket
+        relies on.
+        """
+        self.patch(_fileresponse, "_transportAttributes",
+                   _fileresponse._transportAttributes + ["_missing"])
+        response, body = yield self.get()
+        self.assertEqual(response.code, 200)
+        self.assertEqual(body, self.body)
+        self.assertEqual(self.sent, [])
+
+
+
+class _Producer(object):
+    """
+    A push producer recording whether it is paused.
+    """
+
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+    def stopProducing(self):
+        pass
+
+
+
+class TransportStateTests(TestCase):
+    """
+    Tests for the private state of L{twisted.internet.tcp.Connection} which
+    writing files with C{os.sendfile} reads and changes, run against the
+    installed version of Twisted.
+    """
+
+    def setUp(self):
+        self.peer, skt = socket.socketpair()
+        self.addCleanup(self.peer.close)
+        self.transport = tcp.Connection(skt, Protocol(), reactor)
+        self.transport.connected = True
+        self.addCleanup(skt.close)
+        self.addCleanup(self.transport.stopWriting)
+        self.request = requestMock(b"/")
+        self.request.channel.transport = self.transport
+
+
+    def receive(self):
+        """
+        Write what the transport has buffered to its socket, and receive it
+        on the other end.
+
+        @return: What was received.
+        """
+        received = []
+        self.peer.setblocking(False)
+        while True:
+            buffered = _fileresponse._buffered(self.transport)
+            if buffered:
+                self.transport.doWrite()
+            try:
+                received.append(self.peer.recv(2 ** 16))
+            except socket.error:
+                if not buffered:
+                    return b"".join(received)
+
+
+    def test_transport(self):
+        """
+        L{_fileresponse._sendfileTransport} finds the TCP connection of a
+        request.
+        """
+        self.assertIs(_fileresponse._sendfileTransport(self.request),
+                      self.transport)
+
+    if getattr(os, "sendfile", None) is None:
+        test_transport.skip = "os.sendfile is not available."
+
+
+    def test_tls(self):
+        """
+        L{_fileresponse._sendfileTransport} finds no transport for TCP
+        connections using TLS.
+        """
+        self.transport.TLS = True
+        self.assertIsNone(_fileresponse._sendfileTransport(self.request))
+
+
+    def test_chunked(self):
+        """
+        L{_fileresponse._sendfileTransport} finds no transport for chunked
+        responses.
+        """
+        self.request.chunked = True
+        self.assertIsNone(_fileresponse._sendfileTransport(self.request))
+
+
+    def test_tempDataBuffer(self):
+        """
+        What is written to the transport is buffered in its
+        C{_tempDataBuffer} until its socket is writable.
+        """
+        self.transport.write(b"headers")
+        self.assertTrue(self.transport._tempDataBuffer)
+        self.assertTrue(_fileresponse._buffered(self.transport))
+        self.assertEqual(self.receive(), b"headers")
+        self.assertFalse(_fileresponse._buffered(self.transport))
+
+
+    def test_dataBuffer(self):
+        """
+        What the socket of the transport didn't take at once is left in its
+        C{dataBuffer}, from its C{offset} on.
+        """
+        data = os.urandom(2 ** 23)
+        self.transport.write(data)
+        self.transport.doWrite()
+        self.assertEqual(self.transport._tempDataBuffer, [])
+        self.assertGreater(len(self.transport.dataBuffer),
+                           self.transport.offset)
+        self.assertTrue(_fileresponse._buffered(self.transport))
+        self.assertEqual(self.receive(), data)
+        self.assertEqual(len(self.transport.dataBuffer),
+                         self.transport.offset)
+
+
+    def test_waitUntilWritable(self):
+        """
+        L{_fileresponse._waitUntilWritable} pauses the C{producer} of the
+        transport, and the transport resumes it once it could write to its
+        socket, since C{producerPaused} is set.
+        """
+        producer = _Producer()
+        self.transport.registerProducer(producer, True)
+        _fileresponse._waitUntilWritable(self.transport)
+        self.assertTrue(producer.paused)
+        self.assertTrue(self.transport.producerPaused)
+        self.assertIn(self.transport, reactor.getWriters())
+
+        self.transport.doWrite()
+        self.assertFalse(producer.paused)
+        self.assertFalse(self.transport.producerPaused)
+        self.assertNotIn(self.transport, reactor.getWriters())
+
+
+    def test_waitUntilWritableWithoutProducer(self):
+        """
+        L{_fileresponse._waitUntilWritable} only waits for the socket to be
+        writable when the transport has no C{producer}.
+        """
+        _fileresponse._waitUntilWritable(self.transport)
+        self.assertIn(self.transport, reactor.getWriters())
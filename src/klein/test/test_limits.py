@@ -0,0 +1,226 @@
+"""
+Tests for L{klein._limits}.
+"""
+
+from __future__ import absolute_import, division
+
+from twisted.internet.defer import CancelledError, Deferred, succeed
+
+from klein import ConcurrencyLimitExceeded
+from klein._limits import ConcurrencyLimit
+from klein.test.test_resource import _AppTestMixin, requestMock, _render
+from klein.test.util import TestCase
+
+
+
+class ConcurrencyLimitTests(TestCase):
+    """
+    Tests for L{ConcurrencyLimit}.
+    """
+
+    def setUp(self):
+        self.limit = ConcurrencyLimit(u"test", max_concurrent=1, max_queue=1)
+
+
+    def test_synchronous(self):
+        """
+        Handlers returning a result right away are counted while they run.
+        """
+        seen = []
+
+        def handler():
+            seen.append(self.limit.in_flight)
+            return u"result"
+
+        self.assertEqual(self.limit.run(handler), u"result")
+        self.assertEqual(self.limit.run(handler), u"result")
+        self.assertEqual((seen, self.limit.in_flight), ([1, 1], 0))
+
+
+    def test_exception(self):
+        """
+        Handlers raising an exception stop being counted.
+        """
+        def handler():
+            raise KeyError()
+
+        self.assertRaises(KeyError, self.limit.run, handler)
+        self.assertEqual(self.limit.in_flight, 0)
+
+
+    def test_queue(self):
+        """
+        Handlers wait for their turn while C{max_concurrent} handlers run, and
+        are refused with L{ConcurrencyLimitExceeded} when C{max_queue} are
+        waiting already.
+        """
+        first = Deferred()
+        self.assertIdentical(self.limit.run(lambda: first), first)
+        waiting = self.limit.run(lambda: succeed(u"second"))
+        self.assertNoResult(waiting)
+        self.assertEqual((self.limit.in_flight, self.limit.queue_depth),
+                         (1, 1))
+
+        e = self.assertRaises(ConcurrencyLimitExceeded, self.limit.run,
+                              lambda: None)
+        self.assertEqual((e.limit, e.in_flight, e.queue_depth, e.code),
+                         (u"test", 1, 1, 503))
+
+        first.callback(u"first")
+        self.assertEqual(self.successResultOf(waiting), u"second")
+        self.assertEqual((self.limit.in_flight, self.limit.queue_depth),
+                         (0, 0))
+
+
+    def test_cancelWaiting(self):
+        """
+        Cancelling a handler waiting for its turn means it isn't called.
+        """
+        called = []
+        first = Deferred()
+        self.limit.run(lambda: first)
+        waiting = self.limit.run(called.append, True)
+        waiting.cancel()
+        self.failureResultOf(waiting, CancelledError)
+        self.assertEqual(self.limit.queue_depth, 0)
+        first.callback(None)
+        self.assertEqual((called, self.limit.in_flight), ([], 0))
+
+
+    def test_cancelRunning(self):
+        """
+        Cancelling a handler which waited for its turn cancels its result.
+        """
+        first = Deferred()
+        second = Deferred()
+        self.limit.run(lambda: first)
+        waiting = self.limit.run(lambda: second)
+        first.callback(None)
+        self.assertEqual(self.limit.in_flight, 1)
+        waiting.cancel()
+        self.failureResultOf(waiting, CancelledError)
+        self.assertTrue(second.called)
+        self.assertEqual(self.limit.in_flight, 0)
+
+
+    def test_configure(self):
+        """
+        Raising C{max_concurrent} lets waiting handlers run.
+        """
+        first = Deferred()
+        self.limit.run(lambda: first)
+        waiting = self.limit.run(lambda: u"second")
+        self.limit.configure(max_concurrent=2)
+        self.assertEqual(self.successResultOf(waiting), u"second")
+        self.assertEqual(self.limit.max_queue, 1)
+
+
+
+class ConcurrencyLimitExceededTests(TestCase):
+    """
+    Tests for L{ConcurrencyLimitExceeded}.
+    """
+
+    def test_response(self):
+        """
+        The response to a refused request is a 503 with C{Retry-After}, with
+        every version of werkzeug.
+        """
+        response = ConcurrencyLimitExceeded(u"test", 1, 1, 30).get_response({})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get("Retry-After"), "30")
+
+
+    def test_noRetryAfter(self):
+        """
+        Without C{retry_after}, the 503 has no C{Retry-After}.
+        """
+        response = ConcurrencyLimitExceeded(u"test", 1, 1, None).get_response(
+            {})
+        self.assertEqual(response.status_code, 503)
+        self.assertNotIn("Retry-After", response.headers)
+
+
+
+class LimitedRouteTests(_AppTestMixin, TestCase):
+    """
+    Tests for routes added with C{concurrency}.
+    """
+
+    def setUp(self):
+        _AppTestMixin.setUp(self)
+        self.later = Deferred()
+
+
+    def test_endpoint(self):
+        """
+        Routes added with a number of handlers are limited on their own, and
+        requests over the limit are answered with 503 and C{Retry-After}.
+        """
+        @self.app.route("/", concurrency=1)
+        def root(request):
+            return self.later
+
+        first = requestMock(b"/")
+        d = _render(self.kr, first)
+        limit = self.app.concurrency_limit(u"root")
+        self.assertEqual(limit.in_flight, 1)
+
+        refused = self.get()
+        self.assertEqual(refused.code, 503)
+        self.assertEqual(
+            refused.responseHeaders.getRawHeaders(b"retry-after"), [b"1"])
+
+        self.later.callback(b"ok")
+        self.successResultOf(d)
+        self.assertEqual(first.getWrittenData(), b"ok")
+        self.assertEqual(limit.in_flight, 0)
+
+
+    def test_group(self):
+        """
+        Routes added with the name of a limit share it, and wait for their
+        turn in its queue.
+        """
+        limit = self.app.concurrency_limit(u"group", max_concurrent=1,
+                                           max_queue=1, retry_after=30)
+
+        @self.app.route("/a", concurrency=u"group")
+        def a(request):
+            return self.later
+
+        @self.app.route("/b", concurrency=u"group")
+        def b(request):
+            return b"b"
+
+        self.assertNoResult(_render(self.kr, requestMock(b"/a")))
+        waiting = requestMock(b"/b")
+        d = _render(self.kr, waiting)
+        self.assertEqual((limit.in_flight, limit.queue_depth), (1, 1))
+
+        refused = self.get(b"/b")
+        self.assertEqual(
+            refused.responseHeaders.getRawHeaders(b"retry-after"), [b"30"])
+
+        self.later.callback(b"a")
+        self.successResultOf(d)
+        self.assertEqual(waiting.getWrittenData(), b"b")
+
+
+    def test_errorHandler(self):
+        """
+        Requests over the limit can be answered by error handlers.
+        """
+        @self.app.route("/", concurrency=1)
+        def root(request):
+            return self.later
+
+        @self.app.handle_errors(ConcurrencyLimitExceeded)
+        def busy(request, failure):
+            request.setResponseCode(429)
+            return u"busy: {0}".format(failure.value.in_flight).encode("ascii")
+
+        _render(self.kr, requestMock(b"/"))
+        request = self.get()
+        self.assertEqual((request.code, request.getWrittenData()),
+                         (429, b"busy: 1"))
@@ -0,0 +1,166 @@
+"""
+Tests for L{klein._metrics}.
+"""
+
+from __future__ import absolute_import, division
+
+from functools import partial
+from itertools import count
+
+from twisted.internet.defer import Deferred
+
+from klein import Klein, Metrics
+from klein import _timing
+from klein.test.test_resource import _AppTestMixin, requestMock, _render
+from klein.test.util import TestCase
+
+
+
+class MetricsTests(_AppTestMixin, TestCase):
+    """
+    Tests for counting requests with L{Metrics}.
+    """
+
+    def setUp(self):
+        # Every reading of the clock is a second later.
+        self.patch(_timing, "_clock", partial(next, count()))
+        self.metrics = Metrics(buckets=[1, 5])
+        _AppTestMixin.setUp(self)
+
+
+    def makeApp(self):
+        return Klein(metrics=self.metrics)
+
+
+    def test_counts(self):
+        """
+        Requests are counted by endpoint and response code.
+        """
+        @self.app.route("/")
+        def root(request):
+            return b"ok"
+
+        @self.app.route("/teapot")
+        def teapot(request):
+            request.setResponseCode(418)
+            return b"short and stout"
+
+        self.get(b"/")
+        self.get(b"/")
+        self.get(b"/teapot")
+        self.get(b"/nope")
+
+        stats = self.metrics._endpoints["root"]
+        self.assertEqual(stats.requests, 2)
+        self.assertEqual(stats.codes[200 - 100], 2)
+        self.assertEqual(stats.in_flight, 0)
+        self.assertEqual(stats.latency.count, 2)
+        self.assertEqual(self.metrics._endpoints["teapot"].codes[418 - 100],
+                         1)
+        self.assertEqual(self.metrics._endpoints[None].codes[404 - 100], 1)
+
+
+    def test_inFlight(self):
+        """
+        Requests are in flight from being routed until they are answered.
+        """
+        later = Deferred()
+
+        @self.app.route("/")
+        def root(request):
+            return later
+
+        d = _render(self.kr, requestMock(b"/"))
+        stats = self.metrics._endpoints["root"]
+        self.assertEqual((stats.in_flight, stats.requests), (1, 0))
+
+        later.callback(b"ok")
+        self.successResultOf(d)
+        self.assertEqual((stats.in_flight, stats.requests), (0, 1))
+
+
+    def test_noAllocation(self):
+        """
+        Counting requests to an endpoint which was counted before doesn't
+        create any counts.
+        """
+        @self.app.route("/")
+        def root(request):
+            return b"ok"
+
+        self.get(b"/")
+        stats = self.metrics._endpoints["root"]
+        codes = stats.codes
+        self.get(b"/")
+        self.assertIdentical(self.metrics._endpoints["root"], stats)
+        self.assertIdentical(stats.codes, codes)
+
+
+    def test_mount(self):
+        """
+        L{Metrics.mount} adds a route rendering the counts in the Prometheus
+        text exposition format.
+        """
+        @self.app.route("/")
+        def root(request):
+            return b"ok"
+
+        self.metrics.mount(self.app)
+        self.get(b"/")
+        request = self.get(b"/metrics")
+
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b"content-type"),
+            [b"text/plain; version=0.0.4; charset=utf-8"])
+        self.assertEqual(request.getWrittenData().decode("utf-8"), u"""\
+# HELP klein_requests_total Requests answered, by endpoint.
+# TYPE klein_requests_total counter
+klein_requests_total{endpoint="metrics"} 0
+klein_requests_total{endpoint="root"} 1
+# HELP klein_responses_total Responses, by endpoint and response code.
+# TYPE klein_responses_total counter
+klein_responses_total{endpoint="root",code="200"} 1
+# HELP klein_requests_in_flight Requests being handled, by endpoint.
+# TYPE klein_requests_in_flight gauge
+klein_requests_in_flight{endpoint="metrics"} 1
+klein_requests_in_flight{endpoint="root"} 0
+# HELP klein_request_duration_seconds Time taken to answer requests, by \
+endpoint.
+# TYPE klein_request_duration_seconds histogram
+klein_request_duration_seconds_bucket{endpoint="metrics",le="1"} 0
+klein_request_duration_seconds_bucket{endpoint="metrics",le="5"} 0
+klein_request_duration_seconds_bucket{endpoint="metrics",le="+Inf"} 0
+klein_request_duration_seconds_sum{endpoint="metrics"} 0.0
+klein_request_duration_seconds_count{endpoint="metrics"} 0
+klein_request_duration_seconds_bucket{endpoint="root",le="1"} 1
+klein_request_duration_seconds_bucket{endpoint="root",le="5"} 1
+klein_request_duration_seconds_bucket{endpoint="root",le="+Inf"} 1
+klein_request_duration_seconds_sum{endpoint="root"} 1.0
+klein_request_duration_seconds_count{endpoint="root"} 1
+""")
+
+
+    def test_mountBound(self):
+        """
+        The route added by L{Metrics.mount} to an app of a class serves
+        instances of the class too.
+        """
+        metrics = self.metrics
+
+        class Application(object):
+            app = Klein(metrics=metrics)
+            metrics.mount(app)
+
+        request = requestMock(b"/metrics")
+        self.successResultOf(_render(Application().app.resource(), request))
+        self.assertIn(b"klein_requests_in_flight{endpoint=\"metrics\"} 1",
+                      request.getWrittenData())
+
+
+    def test_labels(self):
+        """
+        Label values are escaped.
+        """
+        self.metrics._routed(u'a"b\\c\nd')
+        self.assertIn(b'{endpoint="a\\"b\\\\c\\nd"} 1',
+                      self.metrics.exposition())
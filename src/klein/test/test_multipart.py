@@ -0,0 +1,289 @@
+"""
+Tests for L{klein._multipart}.
+"""
+
+from __future__ import absolute_import, division
+
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.web.server import Site
+
+from werkzeug.exceptions import BadRequest
+
+from klein import Klein, MultipartParser, StreamingRequest
+from klein.interfaces import IKleinRequest
+from klein.test.test_compression import _parse
+from klein.test.test_resource import requestMock, _render
+from klein.test.util import TestCase
+
+
+
+_BOUNDARY = b"----boundary"
+
+_CONTENT_TYPE = b"multipart/form-data; boundary=" + _BOUNDARY
+
+_BODY = (
+    b"preamble\r\n"
+    b"------boundary\r\n"
+    b'Content-Disposition: form-data; name="title"\r\n'
+    b"\r\n"
+    b"A title\r\n"
+    b"------boundary\r\n"
+    b'Content-Disposition: form-data; name="upload"; filename="a.txt"\r\n'
+    b"Content-Type: text/plain\r\n"
+    b"\r\n"
+    b"line one\r\n--not the boundary\r\n\r\n"
+    b"------boundary\r\n"
+    b'Content-Disposition: form-data; name="title"\r\n'
+    b"\r\n"
+    b"\r\n"
+    b"------boundary--\r\n"
+    b"epilogue"
+)
+
+
+
+class MultipartParserTests(TestCase):
+    """
+    Tests for L{MultipartParser}.
+    """
+
+    def parse(self, body, chunkSize=None, **kwargs):
+        parser = MultipartParser(_BOUNDARY, **kwargs)
+        chunkSize = chunkSize or len(body)
+        for start in range(0, len(body), chunkSize):
+            parser.feed(body[start:start + chunkSize])
+        return parser.finish()
+
+
+    def test_parse(self):
+        """
+        The parts of the body are parsed with their names, file names, types
+        and contents.
+        """
+        form = self.parse(_BODY)
+        self.assertEqual([(part.name, part.filename, part.value)
+                          for part in form.parts],
+                         [(u"title", None, b"A title"),
+                          (u"upload", u"a.txt",
+                           b"line one\r\n--not the boundary\r\n"),
+                          (u"title", None, b"")])
+        self.assertEqual(form[u"upload"].content_type, b"text/plain")
+        self.assertEqual(form[u"upload"].size, 30)
+        self.assertEqual(form[u"title"].value, b"A title")
+        self.assertEqual(len(form.getall(u"title")), 2)
+        self.assertIn(u"upload", form)
+        self.assertIdentical(form.get(u"missing"), None)
+
+
+    def test_incremental(self):
+        """
+        Bodies are parsed the same however they are split into chunks.
+        """
+        whole = [(part.name, part.value) for part in self.parse(_BODY).parts]
+        for chunkSize in 1, 2, 7, 16:
+            form = self.parse(_BODY, chunkSize)
+            self.assertEqual([(part.name, part.value) for part in form.parts],
+                             whole)
+
+
+    def test_spool(self):
+        """
+        The contents of parts larger than C{spool_size} are written to
+        temporary files, and smaller ones kept in memory.
+        """
+        form = self.parse(_BODY, spool_size=10)
+        self.assertFalse(form[u"title"].file._rolled)
+        self.assertTrue(form[u"upload"].file._rolled)
+        form.close()
+        self.assertTrue(form[u"upload"].file.closed)
+
+
+    def test_truncated(self):
+        """
+        Bodies ending before their last part did are malformed.
+        """
+        self.assertRaises(BadRequest, self.parse, _BODY[:-30])
+
+
+    def test_malformed(self):
+        """
+        Parts without a name, with malformed headers, with too large headers
+        or too many parts are malformed.
+        """
+        for part in [b"Content-Disposition: form-data\r\n\r\n",
+                     b"Content-Disposition form-data\r\n\r\n",
+                     b"\r\n"]:
+            self.assertRaises(BadRequest, self.parse,
+                              b"------boundary\r\n" + part +
+                              b"x\r\n------boundary--")
+        self.assertRaises(BadRequest, self.parse, _BODY, max_header_size=10)
+        self.assertRaises(BadRequest, self.parse, _BODY, max_parts=2)
+
+
+
+class FormTests(TestCase):
+    """
+    Tests for L{IKleinRequest.form}.
+    """
+
+    def setUp(self):
+        self.app = Klein()
+        self.kr = self.app.resource()
+        self.forms = []
+
+        @self.app.route("/", methods=["POST"])
+        def root(request):
+            d = IKleinRequest(request).form(spool_size=10)
+
+            @d.addCallback
+            def parsed(form):
+                self.forms.append(form)
+                return form[u"title"].value
+            return d
+
+
+    def post(self, body=_BODY, contentType=_CONTENT_TYPE):
+        request = requestMock(b"/", method=b"POST", body=body,
+                              headers={b"content-type": [contentType]})
+        self.successResultOf(_render(self.kr, request))
+        return request
+
+
+    def connect(self):
+        """
+        Connect to the app with L{StreamingRequest}.
+
+        @return: The channel and its transport.
+        """
+        site = Site(self.app.resource(), timeout=None)
+        site.requestFactory = StreamingRequest
+        channel = site.buildProtocol(None)
+        transport = StringTransport()
+        channel.makeConnection(transport)
+        self.addCleanup(channel.connectionLost, Failure(Exception()))
+        return channel, transport
+
+
+    def send(self, channel, path=b"/", body=_BODY):
+        channel.dataReceived(
+            b"POST " + path + b" HTTP/1.1\r\nHost: localhost\r\n"
+            b"Content-Type: " + _CONTENT_TYPE + b"\r\n"
+            b"Content-Length: " + str(len(_BODY)).encode("ascii") +
+            b"\r\n\r\n" + body)
+
+
+    def test_form(self):
+        """
+        Handlers get the parsed form, whose temporary files are removed once
+        the request is answered.
+        """
+        request = self.post()
+        self.assertEqual(request.getWrittenData(), b"A title")
+        [form] = self.forms
+        self.assertTrue(form[u"upload"].file.closed)
+
+
+    def test_once(self):
+        """
+        The form is parsed once, however many times it is asked for.
+        """
+        @self.app.route("/twice", methods=["POST"])
+        def twice(request):
+            kleinRequest = IKleinRequest(request)
+            first, second = kleinRequest.form(), kleinRequest.form()
+            return first.addCallback(
+                lambda form: second.addCallback(
+                    lambda other: b"same" if form is other else b"other"))
+
+        request = requestMock(b"/twice", method=b"POST", body=_BODY,
+                              headers={b"content-type": [_CONTENT_TYPE]})
+        self.successResultOf(_render(self.kr, request))
+        self.assertEqual(request.getWrittenData(), b"same")
+
+
+    def test_urlencoded(self):
+        """
+        URL-encoded forms are parsed too.
+        """
+        request = self.post(b"title=An+%C3%A9&title=2",
+                            b"application/x-www-form-urlencoded")
+        self.assertEqual(request.getWrittenData(), b"An \xc3\xa9")
+
+
+    def test_malformed(self):
+        """
+        Requests whose form is malformed are answered with 400.
+        """
+        request = self.post(_BODY[:-30])
+        self.assertEqual(request.code, 400)
+
+
+    def test_notForm(self):
+        """
+        Requests whose body isn't a form are answered with 415, and those
+        whose form has no boundary with 400.
+        """
+        self.assertEqual(self.post(contentType=b"text/plain").code, 415)
+        self.assertEqual(self.post(contentType=b"multipart/form-data").code,
+                         400)
+
+
+    def test_streamed(self):
+        """
+        Forms streamed with L{StreamingRequest} are parsed as they are
+        received.
+        """
+        channel, transport = self.connect()
+        self.send(channel, body=_BODY[:100])
+        self.assertEqual(self.forms, [])
+        channel.dataReceived(_BODY[100:])
+        self.assertEqual(_parse(transport.value())[2], b"A title")
+
+
+    def test_spooledFilesClosed(self):
+        """
+        The temporary files of the form are kept until the request is
+        answered, and closed then.
+        """
+        answer = Deferred()
+
+        @self.app.route("/slow", methods=["POST"])
+        def slow(request):
+            d = IKleinRequest(request).form(spool_size=10)
+            d.addCallback(self.forms.append)
+            return d.addCallback(lambda ignored: answer)
+
+        channel, transport = self.connect()
+        self.send(channel, b"/slow")
+        [form] = self.forms
+        self.assertTrue(form[u"upload"].file._rolled)
+        self.assertFalse(form[u"upload"].file.closed)
+
+        answer.callback(b"done")
+        self.assertEqual(_parse(transport.value())[2], b"done")
+        self.assertTrue(form[u"upload"].file.closed)
+
+
+    def test_parsedAfterDisconnection(self):
+        """
+        The temporary files of forms parsed once the client went away are
+        closed right away.
+        """
+        kleinRequests = []
+
+        @self.app.route("/later", methods=["POST"])
+        def later(request):
+            kleinRequests.append(IKleinRequest(request))
+            return Deferred()
+
+        channel, transport = self.connect()
+        self.send(channel, b"/later")
+        channel.connectionLost(Failure(ConnectionDone()))
+
+        [kleinRequest] = kleinRequests
+        form = self.successResultOf(kleinRequest.form(spool_size=10))
+        self.assertTrue(form[u"upload"].file._rolled)
+        self.assertTrue(form[u"upload"].file.closed)
@@ -0,0 +1,310 @@
+"""
+Tests for L{klein._processes}.
+"""
+
+from __future__ import absolute_import, division
+
+import io
+import os
+import pickle
+import time
+
+from twisted.internet.defer import (
+    CancelledError, DeferredList, inlineCallbacks)
+from twisted.internet.error import ProcessTerminated
+
+from klein import Klein, ProcessPoolFull, ProcessTimeout
+from klein._processes import ProcessPool, _frame, _header, _serve
+from klein.test.test_resource import requestMock, _render
+from klein.test.util import TestCase
+
+
+
+def add(a, b):
+    return a + b
+
+
+
+def pid():
+    return os.getpid()
+
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+
+def fail(message):
+    raise KeyError(message)
+
+
+
+def unpicklable():
+    return lambda: None
+
+
+
+def die():
+    os._exit(3)
+
+
+
+def double(value):
+    return value * 2
+
+
+
+class ServeTests(TestCase):
+    """
+    Tests for L{_serve}, the loop of the worker processes.
+    """
+
+    def serve(self, *calls):
+        payloads = b"".join(
+            _frame(pickle.dumps(call, pickle.HIGHEST_PROTOCOL))
+            for call in calls)
+        outcomes = io.BytesIO()
+        _serve(io.BytesIO(payloads), outcomes)
+        data = outcomes.getvalue()
+        results = []
+        while data:
+            (length,) = _header.unpack(data[:_header.size])
+            data = data[_header.size:]
+            results.append(pickle.loads(data[:length]))
+            data = data[length:]
+        return results
+
+
+    def test_outcomes(self):
+        """
+        L{_serve} writes the result or the exception of every call.
+        """
+        [success, failure] = self.serve((add, (1, 2), {}),
+                                        (fail, (u"nope",), {}))
+        self.assertEqual(success, (True, 3))
+        self.assertEqual(failure[0], False)
+        self.assertIsInstance(failure[1], KeyError)
+        self.assertIn(u"nope", failure[2])
+
+
+    def test_unpicklableResult(self):
+        """
+        Results which can't be pickled are replaced by a L{RuntimeError}.
+        """
+        [(success, error, traceback)] = self.serve((unpicklable, (), {}))
+        self.assertEqual(success, False)
+        self.assertIsInstance(error, RuntimeError)
+
+
+
+class ProcessPoolTests(TestCase):
+    """
+    Tests for L{ProcessPool}.
+    """
+
+    def setUp(self):
+        self.pool = ProcessPool(u"test", size=1)
+        self.addCleanup(self.pool.stop)
+
+
+    @inlineCallbacks
+    def test_submit(self):
+        """
+        L{ProcessPool.submit} calls a function in a worker process, and
+        delivers its result.
+        """
+        self.assertEqual((yield self.pool.submit(add, 1, b=2)), 3)
+        worker = yield self.pool.submit(pid)
+        self.assertNotEqual(worker, os.getpid())
+        self.assertEqual((yield self.pool.submit(pid)), worker)
+
+
+    @inlineCallbacks
+    def test_failure(self):
+        """
+        Exceptions are delivered as failures, with the traceback of the
+        worker.
+        """
+        e = yield self.assertFailure(self.pool.submit(fail, u"nope"),
+                                     KeyError)
+        self.assertIn(u"fail", e.remote_traceback)
+
+
+    def test_unpicklable(self):
+        """
+        Calls which can't be pickled are refused right away.
+        """
+        self.assertRaises(Exception, self.pool.submit, lambda: None)
+
+
+    @inlineCallbacks
+    def test_queue(self):
+        """
+        Calls wait for a worker when every worker is busy.
+        """
+        busy = self.pool.submit(sleep, 0.2)
+        waiting = self.pool.submit(pid)
+        self.assertEqual(len(self.pool._queue), 1)
+        self.assertEqual((yield busy), 0.2)
+        self.assertNotEqual((yield waiting), os.getpid())
+        self.assertEqual(len(self.pool._workers), 1)
+
+
+    @inlineCallbacks
+    def test_full(self):
+        """
+        Calls are refused with L{ProcessPoolFull} while every worker is busy
+        and C{max_queue} calls are waiting for one.
+        """
+        self.pool.configure(max_queue=1)
+        busy = self.pool.submit(sleep, 0.2)
+        waiting = self.pool.submit(pid)
+        self.assertEqual(self.pool.queue_depth, 1)
+
+        e = self.assertRaises(ProcessPoolFull, self.pool.submit, pid)
+        self.assertEqual((e.pool, e.queue_depth), (u"test", 1))
+        self.assertEqual(e.code, 503)
+
+        yield busy
+        yield waiting
+        self.assertEqual(self.pool.queue_depth, 0)
+        self.assertEqual((yield self.pool.submit(add, 1, 1)), 2)
+
+
+    @inlineCallbacks
+    def test_timeout(self):
+        """
+        Calls taking longer than their timeout fail with L{ProcessTimeout},
+        and their worker is replaced.
+        """
+        worker = yield self.pool.submit(pid)
+        e = yield self.assertFailure(
+            self.pool.submit_with_timeout(0.1, sleep, 10), ProcessTimeout)
+        self.assertEqual((e.pool, e.timeout, e.code), (u"test", 0.1, 504))
+        self.assertNotEqual((yield self.pool.submit(pid)), worker)
+
+
+    @inlineCallbacks
+    def test_maxTasks(self):
+        """
+        Workers are replaced after C{max_tasks} calls.
+        """
+        self.pool.configure(max_tasks=2)
+        first = yield self.pool.submit(pid)
+        self.assertEqual((yield self.pool.submit(pid)), first)
+        self.assertNotEqual((yield self.pool.submit(pid)), first)
+
+
+    @inlineCallbacks
+    def test_died(self):
+        """
+        Calls whose worker dies fail with the reason it ended.
+        """
+        yield self.assertFailure(self.pool.submit(die), ProcessTerminated)
+        self.assertEqual((yield self.pool.submit(add, 1, 1)), 2)
+
+
+    @inlineCallbacks
+    def test_cancel(self):
+        """
+        Cancelling a call kills its worker, and cancelling a waiting call
+        means it isn't made.
+        """
+        running = self.pool.submit(sleep, 10)
+        waiting = self.pool.submit(pid)
+        waiting.cancel()
+        running.cancel()
+        yield self.assertFailure(waiting, CancelledError)
+        yield self.assertFailure(running, CancelledError)
+        self.assertEqual((yield self.pool.submit(add, 1, 1)), 2)
+
+
+
+class ProcessRouteTests(TestCase):
+    """
+    Tests for routes added with C{processes}.
+    """
+
+    def setUp(self):
+        self.app = Klein()
+        self.kr = self.app.resource()
+
+
+    def tearDown(self):
+        return DeferredList([pool.stop()
+                             for pool in self.app._process_pools.values()])
+
+
+    @inlineCallbacks
+    def test_processes(self):
+        """
+        The handlers of routes added with C{processes=True} are called in the
+        default pool with the values of the URL, and their result is written.
+        """
+        self.app.process_pool(size=1)
+        self.app.route("/double/<value>", processes=True)(double)
+
+        request = requestMock(b"/double/ab")
+        yield _render(self.kr, request)
+        self.assertEqual(request.getWrittenData(), b"abab")
+
+
+    @inlineCallbacks
+    def test_errorHandlers(self):
+        """
+        The failures of handlers called in worker processes are handled by
+        the error handlers.
+        """
+        pool = self.app.process_pool(u"failing", size=1)
+        self.app.route("/<message>", processes=u"failing")(fail)
+
+        @self.app.handle_errors(KeyError)
+        def keyError(request, failure):
+            return failure.value.args[0].encode("ascii")
+
+        request = requestMock(b"/oops")
+        yield _render(self.kr, request)
+        self.assertEqual(request.getWrittenData(), b"oops")
+        self.assertIdentical(self.app.process_pool(u"failing"), pool)
+
+
+    @inlineCallbacks
+    def test_timeout(self):
+        """
+        Requests whose handler takes longer than the timeout of its pool are
+        answered with 504.
+        """
+        self.app.process_pool(size=1, timeout=0.1)
+        self.app.route("/<int:seconds>", processes=True)(sleep)
+
+        request = requestMock(b"/10")
+        yield _render(self.kr, request)
+        self.assertEqual(request.code, 504)
+
+
+    @inlineCallbacks
+    def test_full(self):
+        """
+        Requests whose handler would wait for a worker of a pool whose queue
+        is full are answered with 503.
+        """
+        self.app.process_pool(size=1, max_queue=0)
+        self.app.route("/double/<value>", processes=True)(double)
+
+        busy = requestMock(b"/double/ab")
+        d = _render(self.kr, busy)
+        request = requestMock(b"/double/cd")
+        yield _render(self.kr, request)
+        self.assertEqual(request.code, 503)
+        yield d
+        self.assertEqual(busy.getWrittenData(), b"abab")
+
+
+    def test_threaded(self):
+        """
+        Routes can't be added with both C{processes} and C{threaded}.
+        """
+        self.assertRaises(ValueError, self.app.route, "/", processes=True,
+                          threaded=True)
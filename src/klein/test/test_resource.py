@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division
 
 import os
+import sys
 
 from io import BytesIO
 
@@ -17,7 +18,8 @@ from twisted.web.static import File
 from twisted.web.template import Element, XMLString, renderer
 from twisted.web.test.test_web import DummyChannel
 from twisted.python.compat import unicode, _PY3
-from werkzeug.exceptions import NotFound
+from twisted.python.failure import Failure
+from werkzeug.exceptions import MethodNotAllowed, NotFound
 
 from klein import Klein
 from klein.interfaces import IKleinRequest
@@ -122,6 +124,31 @@ def _render(resource, request, notifyFinish=True):
         raise ValueError("Unexpected return value: %r" % (result,))
 
 
+class _AppTestMixin(object):
+    """
+    Make requests to C{self.app}, the app made by L{makeApp}, through
+    C{self.kr}, its resource.
+    """
+
+    def setUp(self):
+        self.app = self.makeApp()
+        self.kr = self.app.resource()
+
+    def makeApp(self):
+        return Klein()
+
+    def get(self, path=b"/", headers=None, method=b"GET", body=None):
+        """
+        Render a request for C{path}, whose response must be written right
+        away.
+
+        @return: The request.
+        """
+        request = requestMock(path, method=method, headers=headers, body=body)
+        self.successResultOf(_render(self.kr, request))
+        return request
+
+
 class SimpleElement(Element):
     loader = XMLString("""
     <h1 xmlns:t="http://twistedmatrix.com/ns/twisted.web.template/0.1" t:render="name" />
@@ -636,6 +663,96 @@ class KleinResourceTests(TestCase):
         self.assertFired(d)
         self.assertEqual(request.code, 405)
 
+    def test_methodNotAllowedAnswer(self):
+        """
+        A 405 lists the allowed methods in its C{Allow} header.
+        """
+        app = self.app
+        request = requestMock(b"/foo", method=b'DELETE')
+
+        @app.route("/foo", methods=['GET', 'POST'])
+        def foo(request):
+            return b"foo"
+
+        d = _render(self.kr, request)
+
+        self.assertFired(d)
+        self.assertEqual(request.code, 405)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b'allow'),
+                         [b'GET, HEAD, POST'])
+        self.assertIn(b'405 Method Not Allowed', request.getWrittenData())
+
+    def test_methodNotAllowedErrorHandler(self):
+        """
+        If an error handler is registered for C{MethodNotAllowed}, it handles
+        requests with a method which is not allowed.
+        """
+        app = self.app
+        request = requestMock(b"/foo", method=b'DELETE')
+        failures = []
+
+        @app.route("/foo", methods=['GET'])
+        def foo(request):
+            return b"foo"
+
+        @app.handle_errors(MethodNotAllowed)
+        def notAllowed(request, failure):
+            failures.append(failure)
+            request.setResponseCode(405)
+            return b'Custom Not Allowed'
+
+        d = _render(self.kr, request)
+
+        self.assertFired(d)
+        self.assertEqual(request.getWrittenData(), b'Custom Not Allowed')
+        [failure] = failures
+        self.assertEqual(sorted(failure.value.valid_methods), ['GET', 'HEAD'])
+
+    def test_automaticOptions(self):
+        """
+        With C{automatic_options}, an C{OPTIONS} request for a routed path is
+        answered with the allowed methods, unless it is routed explicitly.
+        """
+        app = Klein(indexed_routing=True, automatic_options=True)
+        kr = KleinResource(app)
+
+        @app.route("/foo", methods=['GET'])
+        def foo(request):
+            return b"foo"
+
+        @app.route("/bar", methods=['OPTIONS'])
+        def bar(request):
+            return b"bar"
+
+        request = requestMock(b"/foo", method=b'OPTIONS')
+        self.assertFired(_render(kr, request))
+        self.assertEqual(request.code, 200)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b'allow'),
+                         [b'GET, HEAD, OPTIONS'])
+        self.assertEqual(request.getWrittenData(), b'')
+
+        request = requestMock(b"/bar", method=b'OPTIONS')
+        self.assertFired(_render(kr, request))
+        self.assertEqual(request.getWrittenData(), b'bar')
+
+        request = requestMock(b"/baz", method=b'OPTIONS')
+        self.assertFired(_render(kr, request))
+        self.assertEqual(request.code, 404)
+
+    def test_noAutomaticOptions(self):
+        """
+        By default, C{OPTIONS} requests aren't answered automatically.
+        """
+        app = self.app
+        request = requestMock(b"/foo", method=b'OPTIONS')
+
+        @app.route("/foo", methods=['GET'])
+        def foo(request):
+            return b"foo"
+
+        self.assertFired(_render(self.kr, request))
+        self.assertEqual(request.code, 405)
+
     def test_noImplicitBranch(self):
         app = self.app
         request = requestMock(b"/foo")
@@ -814,6 +931,76 @@ class KleinResourceTests(TestCase):
         self.assertEqual(len(failures), 1)
         self.assertEqual(request.code, 501)
 
+    def test_failingErrorHandlers(self):
+        """
+        The failure of an error handler is handled by the error handlers
+        registered after it, including those returning a failure and a
+        L{Deferred} failing.
+        """
+        app = self.app
+        request = requestMock(b"/")
+        calls = []
+
+        @app.route("/")
+        def root(request):
+            raise KeyError()
+
+        @app.handle_errors(ValueError)
+        def valueError(request, failure):
+            calls.append("too early")
+
+        @app.handle_errors(KeyError)
+        def keyError(request, failure):
+            calls.append("keyError")
+            raise ValueError()
+
+        @app.handle_errors(KeyError, ValueError)
+        def returnsFailure(request, failure):
+            calls.append("returnsFailure")
+            return fail(TypeError())
+
+        @app.handle_errors(TypeError)
+        def typeError(request, failure):
+            calls.append("typeError")
+            return Failure(IndexError())
+
+        @app.handle_errors(IndexError)
+        def indexError(request, failure):
+            calls.append("indexError")
+            return b"handled"
+
+        self.assertFired(_render(self.kr, request))
+        self.assertEqual(
+            calls, ["keyError", "returnsFailure", "typeError", "indexError"])
+        self.assertEqual(request.getWrittenData(), b"handled")
+
+
+    def test_manyErrorHandlers(self):
+        """
+        Failing through many error handlers doesn't exceed the recursion
+        limit.
+        """
+        app = self.app
+        request = requestMock(b"/")
+
+        @app.route("/")
+        def root(request):
+            raise KeyError()
+
+        def reraise(request, failure):
+            failure.raiseException()
+
+        for i in range(sys.getrecursionlimit()):
+            app.handle_errors(KeyError)(reraise)
+
+        @app.handle_errors(KeyError)
+        def handled(request, failure):
+            return b"handled"
+
+        self.assertFired(_render(self.kr, request))
+        self.assertEqual(request.getWrittenData(), b"handled")
+
+
     def test_notFoundException(self):
         app = self.app
         request = requestMock(b"/foo")
@@ -969,6 +1156,206 @@ class KleinResourceTests(TestCase):
         self.assertFired(d)
         self.assertEqual(relative_url[0], 'http://localhost:8080/foo/2')
 
+    def test_mapperReused(self):
+        """
+        Requests for the same host, script name, URL scheme and method reuse
+        the bound mapper, but each gets its own copy with its own path, which
+        later requests don't change.
+        """
+        app = self.app
+        waiting = []
+
+        @app.route("/foo/<int:bar>")
+        def foo(request, bar):
+            d = Deferred()
+            waiting.append(d)
+            return d.addCallback(lambda _: IKleinRequest(request).url_for(
+                'foo', {'bar': bar + 10}).encode('ascii'))
+
+        request = requestMock(b'/foo/1')
+        request2 = requestMock(b'/foo/2')
+        d = _render(self.kr, request)
+        d2 = _render(self.kr, request2)
+        for waiter in waiting:
+            waiter.callback(None)
+        self.assertFired(d)
+        self.assertFired(d2)
+
+        mapper = IKleinRequest(request).mapper
+        mapper2 = IKleinRequest(request2).mapper
+        self.assertIsNot(mapper, mapper2)
+        self.assertEqual(mapper.path_info, u'/foo/1')
+        self.assertEqual(mapper2.path_info, u'/foo/2')
+        self.assertEqual(request.getWrittenData(), b'/foo/11')
+        self.assertEqual(len(self.kr._adapters._adapters), 1)
+
+    def test_mapperPerHostAndMethod(self):
+        """
+        Requests for different hosts or with different methods get mappers
+        bound accordingly, so C{url_for} builds URLs for the right host.
+        """
+        app = self.app
+        urls = []
+
+        @app.route("/foo", methods=['GET', 'POST'])
+        def foo(request):
+            urls.append(
+                IKleinRequest(request).url_for('foo', force_external=True))
+            return b'foo'
+
+        requests = [requestMock(b'/foo'),
+                    requestMock(b'/foo', host=b'example.com'),
+                    requestMock(b'/foo', method=b'POST')]
+        for request in requests:
+            self.assertFired(_render(self.kr, request))
+
+        self.assertEqual(urls, ['http://localhost:8080/foo',
+                                'http://example.com:8080/foo',
+                                'http://localhost:8080/foo'])
+        mappers = set(IKleinRequest(r).mapper for r in requests)
+        self.assertEqual(len(mappers), 3)
+
+    def test_mapperPoolBounded(self):
+        """
+        The pool of mappers doesn't grow past its maximum size.
+        """
+        self.kr._adapters.maxsize = 2
+        for host in [b'a', b'b', b'c']:
+            self.assertFired(_render(self.kr, requestMock(b'/', host=host)))
+        self.assertEqual(len(self.kr._adapters._adapters), 2)
+
+    def test_mapperPoolLRU(self):
+        """
+        The mappers used least recently are forgotten first.
+        """
+        self.kr._adapters.maxsize = 2
+        for host in [b'a', b'b', b'a', b'c']:
+            self.assertFired(_render(self.kr, requestMock(b'/', host=host)))
+        self.assertEqual(
+            [key[1] for key in self.kr._adapters._adapters],
+            [u'a:8080', u'c:8080'])
+
+    def test_synchronousResult(self):
+        """
+        A result which isn't a L{Deferred} is written and the request finished
+        before C{render} returns, without waiting for the request to finish.
+        """
+        app = self.app
+        request = requestMock(b'/')
+        request.notifyFinish = Mock(wraps=request.notifyFinish)
+
+        @app.route("/")
+        def root(request):
+            return b'sync'
+
+        self.assertEqual(self.kr.render(request), server.NOT_DONE_YET)
+        self.assertEqual(request.getWrittenData(), b'sync')
+        self.assertEqual(request.finishCount, 1)
+        self.assertEqual(request.notifyFinish.call_count, 0)
+
+
+    def test_synchronousResultProcessingFails(self):
+        """
+        An exception raised while processing a synchronous result is handled
+        by the error handlers.
+        """
+        app = self.app
+        request = requestMock(b'/')
+
+        @app.route("/")
+        def root(request):
+            return Resource()
+
+        @app.handle_errors(KeyError)
+        def keyError(request, failure):
+            return b'handled'
+
+        request.render = Mock(side_effect=KeyError())
+        self.assertFired(_render(self.kr, request))
+        self.assertEqual(request.getWrittenData(), b'handled')
+
+
+    def test_host(self):
+        """
+        Routes added within a L{Klein.host} block only apply to requests for
+        that host, whatever the case and port, and requests for other hosts
+        are routed with the routes added outside of any host.
+        """
+        app = self.app
+
+        @app.route("/")
+        def root(request):
+            return b'default'
+
+        with app.host("API.example.com") as api:
+            @api.route("/", endpoint="apiRoot")
+            def apiRoot(request):
+                return b'api'
+
+            with api.subroute("/v1") as v1:
+                @v1.route("/users/<int:uid>")
+                def user(request, uid):
+                    return IKleinRequest(request).url_for(
+                        'user', {'uid': uid + 1}, force_external=True)
+
+        def get(path, host):
+            request = requestMock(path, host=host)
+            self.assertFired(_render(self.kr, request))
+            return request.getWrittenData()
+
+        self.assertEqual(get(b'/', b'api.example.com'), b'api')
+        self.assertEqual(get(b'/', b'Api.Example.COM'), b'api')
+        self.assertEqual(get(b'/', b'localhost'), b'default')
+        self.assertEqual(get(b'/v1/users/1', b'api.example.com'),
+                         b'http://api.example.com:8080/v1/users/2')
+        self.assertIn(b'404', get(b'/v1/users/1', b'localhost'))
+
+
+    def test_hostSameHandlerName(self):
+        """
+        Handlers of the same name added within different L{Klein.host}
+        blocks, and outside of any, each serve their own host.
+        """
+        def addIndex(app, path, answer):
+            @app.route(path)
+            def index(request):
+                return answer + IKleinRequest(request).url_for('index')
+
+        addIndex(self.app, "/", u"default ")
+        with self.app.host("a.example.com") as a:
+            addIndex(a, "/a", u"a ")
+        with self.app.host("b.example.com") as b:
+            addIndex(b, "/b", u"b ")
+
+        def get(path, host):
+            request = requestMock(path, host=host)
+            self.assertFired(_render(self.kr, request))
+            return request.getWrittenData()
+
+        self.assertEqual(get(b'/', b'localhost'), b'default /')
+        self.assertEqual(get(b'/a', b'a.example.com'), b'a /a')
+        self.assertEqual(get(b'/b', b'b.example.com'), b'b /b')
+        self.assertIn(b'404', get(b'/', b'a.example.com'))
+
+
+    def test_hostIndexed(self):
+        """
+        Hosts added with L{Klein.host} use indexed routing if the app does.
+        """
+        app = Klein(indexed_routing=True)
+        kr = KleinResource(app)
+
+        with app.host("a.example.com") as a:
+            @a.route("/<name>")
+            def hello(request, name):
+                return name.encode("ascii")
+
+        request = requestMock(b"/you", host=b"a.example.com")
+        self.assertFired(_render(kr, request))
+        self.assertEqual(request.getWrittenData(), b"you")
+        self.assertIsNot(app._hosts[u"a.example.com"].route_index, None)
+
+
     def test_cancelledIsEatenOnConnectionLost(self):
         app = self.app
         request = requestMock(b"/")
@@ -0,0 +1,196 @@
+"""
+Tests for L{klein._routecache}.
+"""
+
+from __future__ import absolute_import, division
+
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+
+from klein import Klein
+from klein._routecache import RouteCache
+from klein.test.test_resource import requestMock, _render
+from klein.test.util import TestCase
+
+
+
+class CountingMapper(object):
+    """
+    A stand-in for C{werkzeug.routing.MapAdapter} which records how often it
+    is asked to match.
+    """
+    def __init__(self, result):
+        self.result = result
+        self.calls = 0
+
+
+    def match(self, return_rule=False):
+        self.calls += 1
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+
+class RouteCacheTests(TestCase):
+    """
+    Tests for L{RouteCache}.
+    """
+
+    def test_hit(self):
+        """
+        A second lookup of the same key is answered without consulting the
+        mapper, and returns a fresh copy of the arguments.
+        """
+        cache = RouteCache(2)
+        mapper = CountingMapper(("rule", {"a": 1}))
+
+        rule, kwargs = cache.match(mapper, "k")
+        kwargs["a"] = 2
+        self.assertEqual(cache.match(mapper, "k"), ("rule", {"a": 1}))
+        self.assertEqual(mapper.calls, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+    def test_negativeEntries(self):
+        """
+        C{NotFound} and C{MethodNotAllowed} are cached and re-raised.
+        """
+        cache = RouteCache(2)
+        notFound = CountingMapper(NotFound())
+        notAllowed = CountingMapper(MethodNotAllowed(valid_methods=["GET"]))
+
+        for i in range(2):
+            self.assertRaises(NotFound, cache.match, notFound, "a")
+            e = self.assertRaises(MethodNotAllowed,
+                                  cache.match, notAllowed, "b")
+            self.assertEqual(e.valid_methods, ["GET"])
+
+        self.assertEqual((notFound.calls, notAllowed.calls), (1, 1))
+        self.assertEqual(cache.hits, 2)
+
+
+    def test_otherExceptionsNotCached(self):
+        """
+        Exceptions other than C{NotFound} and C{MethodNotAllowed} are not
+        cached.
+        """
+        cache = RouteCache(2)
+        mapper = CountingMapper(ValueError())
+
+        self.assertRaises(ValueError, cache.match, mapper, "k")
+        self.assertRaises(ValueError, cache.match, mapper, "k")
+        self.assertEqual(mapper.calls, 2)
+        self.assertEqual(len(cache), 0)
+
+
+    def test_evictsLeastRecentlyUsed(self):
+        """
+        Once full, the least recently used entry is evicted.
+        """
+        cache = RouteCache(2)
+        mapper = CountingMapper(("rule", {}))
+
+        cache.match(mapper, "a")
+        cache.match(mapper, "b")
+        cache.match(mapper, "a")
+        cache.match(mapper, "c")
+
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(cache), 2)
+        cache.match(mapper, "a")
+        self.assertEqual(mapper.calls, 3)
+        cache.match(mapper, "b")
+        self.assertEqual(mapper.calls, 4)
+
+
+    def test_invalidSize(self):
+        """
+        A cache must be able to hold at least one entry.
+        """
+        self.assertRaises(ValueError, RouteCache, 0)
+
+
+
+class KleinRouteCacheTests(TestCase):
+    """
+    Tests for the integration of L{RouteCache} with L{Klein}.
+    """
+
+    def test_disabledByDefault(self):
+        """
+        L{Klein} does not cache resolution unless asked to.
+        """
+        self.assertIdentical(Klein().route_cache, None)
+
+
+    def test_render(self):
+        """
+        Requests for the same URL are resolved once.
+        """
+        app = Klein(route_cache_size=10)
+
+        @app.route("/foo/<int:bar>")
+        def foo(request, bar):
+            return b"foo" + str(bar).encode("ascii")
+
+        for i in range(2):
+            request = requestMock(b"/foo/1")
+            self.successResultOf(_render(app.resource(), request))
+            self.assertEqual(request.getWrittenData(), b"foo1")
+
+        request = requestMock(b"/missing")
+        self.successResultOf(_render(app.resource(), request))
+        self.assertEqual(request.code, 404)
+
+        self.assertEqual(app.route_cache.misses, 2)
+        self.assertEqual(app.route_cache.hits, 1)
+
+
+    def test_invalidatedByRoute(self):
+        """
+        Adding a route discards cached resolutions, including negative ones.
+        """
+        app = Klein(route_cache_size=10)
+
+        request = requestMock(b"/foo")
+        self.successResultOf(_render(app.resource(), request))
+        self.assertEqual(request.code, 404)
+
+        @app.route("/foo")
+        def foo(request):
+            return b"foo"
+
+        request = requestMock(b"/foo")
+        self.successResultOf(_render(app.resource(), request))
+        self.assertEqual(request.getWrittenData(), b"foo")
+
+
+    def test_invalidatedBySubroute(self):
+        """
+        Leaving a L{Klein.subroute} block discards cached resolutions.
+        """
+        app = Klein(route_cache_size=10)
+
+        request = requestMock(b"/sub/foo")
+        self.successResultOf(_render(app.resource(), request))
+        self.assertEqual(request.code, 404)
+
+        with app.subroute("/sub") as sub:
+            @sub.route("/foo")
+            def foo(request):
+                return b"foo"
+
+        request = requestMock(b"/sub/foo")
+        self.successResultOf(_render(app.resource(), request))
+        self.assertEqual(request.getWrittenData(), b"foo")
+
+
+    def test_sharedWithBoundInstances(self):
+        """
+        L{Klein} instances bound through C{__get__} share the cache of the
+        L{Klein} they were bound from.
+        """
+        class Foo(object):
+            app = Klein(route_cache_size=10)
+
+        self.assertIdentical(Foo().app.route_cache, Foo.app.route_cache)
@@ -0,0 +1,357 @@
+"""
+Tests for L{klein._stream}.
+"""
+
+from __future__ import absolute_import, division
+
+import sys
+
+from mock import Mock
+
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock, Cooperator
+
+from klein import Klein
+from klein._stream import (
+    IterableProducer, _StopAsyncIteration, isStreamable)
+from klein.test.test_resource import requestMock, _render
+from klein.test.util import TestCase
+
+
+
+def _define(source, **namespace):
+    """
+    Define the functions of C{source}, which older versions of Python can't
+    compile.
+
+    @return: A L{dict} of the names defined by C{source}.
+    """
+    exec(source, namespace)
+    return namespace
+
+
+
+class _StreamTestMixin(object):
+    """
+    Consume streamed iterables with a cooperator driven by a clock.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        # One chunk of every stream per second of the clock.
+        self.cooperator = Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=lambda f: self.clock.callLater(1, f))
+
+
+    def pump(self):
+        """
+        Run the cooperator until it has nothing left to do.
+        """
+        while self.clock.getDelayedCalls():
+            self.clock.advance(1)
+
+
+
+class IsStreamableTests(TestCase):
+    """
+    Tests for L{isStreamable}.
+    """
+
+    def test_streamable(self):
+        """
+        Iterators are streamed, but not other iterables.
+        """
+        self.assertTrue(isStreamable(iter([b"a"])))
+        self.assertTrue(isStreamable(b"a" for i in range(1)))
+        self.assertFalse(isStreamable([b"a"]))
+        self.assertFalse(isStreamable((b"a",)))
+        self.assertFalse(isStreamable(set([b"a"])))
+        self.assertFalse(isStreamable(bytearray(b"a")))
+        self.assertFalse(isStreamable(b"a"))
+        self.assertFalse(isStreamable(u"a"))
+        self.assertFalse(isStreamable({"a": 1}))
+        self.assertFalse(isStreamable(None))
+
+
+
+class IterableProducerTests(_StreamTestMixin, TestCase):
+    """
+    Tests for L{IterableProducer}.
+    """
+
+    def setUp(self):
+        _StreamTestMixin.setUp(self)
+        self.request = requestMock(b"/")
+
+
+    def produce(self, iterable):
+        producer = IterableProducer(self.request, iterable,
+                                    self.cooperator.cooperate)
+        return producer, producer.start()
+
+
+    def test_chunks(self):
+        """
+        The chunks are written one by one, text encoded as UTF-8, and the
+        producer is unregistered once they all are.
+        """
+        producer, d = self.produce(iter([b"a", u"\N{SNOWMAN}", b"c"]))
+        self.assertIdentical(self.request.producer, producer)
+        self.assertNoResult(d)
+
+        self.pump()
+        self.assertIdentical(self.successResultOf(d), None)
+        self.assertEqual(self.request.getWrittenData(),
+                         b"a\xe2\x98\x83c")
+        self.assertIdentical(self.request.producer, None)
+        self.assertEqual(self.request.finishCount, 0)
+
+
+    def test_pause(self):
+        """
+        No chunks are written while the producer is paused.
+        """
+        producer, d = self.produce(iter([b"a", b"b"]))
+        producer.pauseProducing()
+        self.pump()
+        self.assertEqual(self.request.getWrittenData(), b"")
+
+        producer.resumeProducing()
+        self.pump()
+        self.assertEqual(self.request.getWrittenData(), b"ab")
+        self.successResultOf(d)
+
+
+    def test_stop(self):
+        """
+        Stopping the producer closes the iterable and fails the L{Deferred}
+        returned by C{start} with L{CancelledError}.
+        """
+        closed = []
+
+        def chunks():
+            try:
+                yield b"a"
+                yield b"b"
+            finally:
+                closed.append(True)
+
+        producer, d = self.produce(chunks())
+        self.clock.advance(1)
+        producer.stopProducing()
+        self.pump()
+
+        self.failureResultOf(d, CancelledError)
+        self.assertEqual(self.request.getWrittenData(), b"a")
+        self.assertEqual(closed, [True])
+
+
+    def test_failure(self):
+        """
+        The L{Deferred} returned by C{start} fails with the failure of the
+        iterable, and says whether anything was written.
+        """
+        def chunks():
+            yield b"a"
+            raise ValueError()
+
+        producer, d = self.produce(chunks())
+        self.pump()
+        self.failureResultOf(d, ValueError)
+        self.assertTrue(producer.written)
+
+
+    def test_notAChunk(self):
+        """
+        Chunks which aren't strings fail with L{TypeError}.
+        """
+        producer, d = self.produce([1])
+        self.pump()
+        self.failureResultOf(d, TypeError)
+        self.assertFalse(producer.written)
+
+
+    def test_asynchronous(self):
+        """
+        The chunks of asynchronous iterables are awaited.
+        """
+        if sys.version_info < (3, 6) or _StopAsyncIteration is None:
+            raise self.skipTest("Asynchronous generators require Python 3.6")
+        waiting = Deferred()
+        ns = _define("async def chunks():\n"
+                     "    yield b'a'\n"
+                     "    yield await waiting\n",
+                     waiting=waiting)
+
+        producer, d = self.produce(ns["chunks"]())
+        self.pump()
+        self.assertEqual(self.request.getWrittenData(), b"a")
+        self.assertNoResult(d)
+
+        waiting.callback(b"b")
+        self.pump()
+        self.assertEqual(self.request.getWrittenData(), b"ab")
+        self.successResultOf(d)
+
+
+    def test_asynchronousStop(self):
+        """
+        Stopping the producer of an asynchronous iterable cancels what it is
+        awaiting and closes it.
+        """
+        if sys.version_info < (3, 6) or _StopAsyncIteration is None:
+            raise self.skipTest("Asynchronous generators require Python 3.6")
+        events = []
+        ns = _define("async def chunks():\n"
+                     "    try:\n"
+                     "        yield await Deferred()\n"
+                     "    except CancelledError:\n"
+                     "        events.append('cancelled')\n"
+                     "        raise\n"
+                     "    finally:\n"
+                     "        events.append('closed')\n",
+                     Deferred=Deferred, CancelledError=CancelledError,
+                     events=events)
+
+        producer, d = self.produce(ns["chunks"]())
+        self.pump()
+        producer.stopProducing()
+        self.pump()
+        self.failureResultOf(d, CancelledError)
+        self.assertEqual(events, ["cancelled", "closed"])
+
+
+
+class StreamedResponseTests(_StreamTestMixin, TestCase):
+    """
+    Tests for handlers returning iterables.
+    """
+
+    def setUp(self):
+        _StreamTestMixin.setUp(self)
+        self.app = Klein()
+        self.kr = self.app.resource()
+        self.kr._cooperate = self.cooperator.cooperate
+
+
+    def test_streamed(self):
+        """
+        The chunks of an iterable returned by a handler are written, and the
+        request finished.
+        """
+        @self.app.route("/")
+        def root(request):
+            return (str(i).encode("ascii") for i in range(3))
+
+        request = requestMock(b"/")
+        d = _render(self.kr, request)
+        self.pump()
+        self.successResultOf(d)
+        self.assertEqual(request.getWrittenData(), b"012")
+        self.assertEqual(request.finishCount, 1)
+
+
+    def test_streamedLater(self):
+        """
+        An iterable a handler's L{Deferred} fires with is streamed too.
+        """
+        later = Deferred()
+
+        @self.app.route("/")
+        def root(request):
+            return later
+
+        request = requestMock(b"/")
+        d = _render(self.kr, request)
+        later.callback(iter([b"a", b"b"]))
+        self.pump()
+        self.successResultOf(d)
+        self.assertEqual(request.getWrittenData(), b"ab")
+
+
+    def test_bytearray(self):
+        """
+        A L{bytearray} returned by a handler is written whole, rather than
+        streamed one byte at a time.
+        """
+        @self.app.route("/")
+        def root(request):
+            return bytearray(b"abc")
+
+        request = requestMock(b"/")
+        d = _render(self.kr, request)
+        self.pump()
+        self.successResultOf(d)
+        self.assertEqual(request.getWrittenData(), b"abc")
+        self.assertEqual(request.writeCount, 1)
+
+
+    def test_failsBeforeWriting(self):
+        """
+        An iterable failing before anything was written is handled by the
+        error handlers.
+        """
+        @self.app.route("/")
+        def root(request):
+            raise KeyError()
+            yield
+
+        @self.app.handle_errors(KeyError)
+        def keyError(request, failure):
+            request.setResponseCode(400)
+            return b"bad key"
+
+        request = requestMock(b"/")
+        d = _render(self.kr, request)
+        self.pump()
+        self.successResultOf(d)
+        self.assertEqual(request.code, 400)
+        self.assertEqual(request.getWrittenData(), b"bad key")
+
+
+    def test_failsAfterWriting(self):
+        """
+        An iterable failing after chunks were written is logged, and the
+        connection closed without finishing the request.
+        """
+        @self.app.route("/")
+        def root(request):
+            yield b"a"
+            raise KeyError()
+
+        request = requestMock(b"/")
+        request.loseConnection = Mock()
+        _render(self.kr, request)
+        self.pump()
+
+        self.assertEqual(len(self.flushLoggedErrors(KeyError)), 1)
+        self.assertEqual(request.getWrittenData(), b"a")
+        request.loseConnection.assert_called_once_with()
+        self.assertEqual(request.finishCount, 0)
+
+
+    def test_connectionLost(self):
+        """
+        Iteration stops when the connection is lost.
+        """
+        closed = []
+
+        @self.app.route("/")
+        def root(request):
+            try:
+                while True:
+                    yield b"a"
+            finally:
+                closed.append(True)
+
+        request = requestMock(b"/")
+        d = _render(self.kr, request)
+        self.clock.advance(1)
+        request.connectionLost(ConnectionLost())
+        self.pump()
+
+        self.assertEqual(closed, [True])
+        self.failureResultOf(d, ConnectionLost)
+        self.assertEqual(self.flushLoggedErrors(), [])
@@ -0,0 +1,232 @@
+"""
+Tests for L{klein._threads}.
+"""
+
+from __future__ import absolute_import, division
+
+import threading
+
+from twisted.internet.defer import CancelledError, inlineCallbacks
+
+from klein import Klein, ThreadPoolFull
+from klein._threads import HandlerThreadPool
+from klein.test.test_resource import _AppTestMixin, requestMock, _render
+from klein.test.util import TestCase
+
+
+
+class ThreadPoolFullTests(TestCase):
+    """
+    Tests for L{ThreadPoolFull}.
+    """
+
+    def test_response(self):
+        """
+        The response to a refused call is a 503 saying how many calls were
+        waiting and for how long, with a C{Retry-After} of the wait time
+        rounded up, with every version of werkzeug.
+        """
+        response = ThreadPoolFull(u"test", 5, 2.25).get_response({})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get("Retry-After"), "3")
+        body = response.get_data()
+        self.assertIn(b"5 calls", body)
+        self.assertIn(b"2.250 seconds", body)
+
+
+    def test_noWait(self):
+        """
+        Clients are asked to retry after a second at least.
+        """
+        response = ThreadPoolFull(u"test", 0, 0.0).get_response({})
+        self.assertEqual(response.headers.get("Retry-After"), "1")
+
+
+
+class HandlerThreadPoolTests(TestCase):
+    """
+    Tests for L{HandlerThreadPool}.
+    """
+
+    def setUp(self):
+        self.pool = HandlerThreadPool(u"test", max_threads=1, max_queue=1)
+        self.addCleanup(self.pool.stop)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+
+    def block(self):
+        """
+        Keep the thread of the pool busy until C{self.release} is set.
+
+        @return: A L{Deferred} firing once it is released.
+        """
+        started = threading.Event()
+
+        def wait():
+            started.set()
+            self.release.wait(10)
+
+        d = self.pool.submit(wait)
+        started.wait(10)
+        return d
+
+
+    @inlineCallbacks
+    def test_submit(self):
+        """
+        L{HandlerThreadPool.submit} calls a function in one of the threads,
+        and delivers its result.
+        """
+        result = yield self.pool.submit(
+            lambda a, b: (threading.current_thread().name, a, b), 1, b=2)
+        name, a, b = result
+        self.assertIn(u"test", name)
+        self.assertEqual((a, b), (1, 2))
+        self.assertEqual(self.pool.queue_depth, 0)
+
+
+    @inlineCallbacks
+    def test_failure(self):
+        """
+        Exceptions are delivered as failures.
+        """
+        def fail():
+            raise KeyError()
+
+        yield self.assertFailure(self.pool.submit(fail), KeyError)
+
+
+    @inlineCallbacks
+    def test_full(self):
+        """
+        Calls are refused with L{ThreadPoolFull} while C{max_queue} calls are
+        waiting for a thread.
+        """
+        blocked = self.block()
+        queued = self.pool.submit(lambda: u"queued")
+        self.assertEqual(self.pool.queue_depth, 1)
+
+        e = self.assertRaises(ThreadPoolFull, self.pool.submit, lambda: None)
+        self.assertEqual((e.pool, e.queue_depth), (u"test", 1))
+        self.assertEqual(e.code, 503)
+
+        self.release.set()
+        yield blocked
+        self.assertEqual((yield queued), u"queued")
+        self.assertEqual(self.pool.queue_depth, 0)
+
+
+    @inlineCallbacks
+    def test_cancel(self):
+        """
+        Calls cancelled while waiting for a thread aren't made.
+        """
+        called = []
+        blocked = self.block()
+        queued = self.pool.submit(called.append, True)
+        queued.cancel()
+        self.release.set()
+        yield blocked
+        yield self.assertFailure(queued, CancelledError)
+        # Wait for the cancelled call to be dequeued.
+        yield self.pool.submit(lambda: None)
+        self.assertEqual(called, [])
+
+
+    def test_resize(self):
+        """
+        L{HandlerThreadPool.resize} changes the bounds which are given.
+        """
+        self.pool.resize(max_threads=3)
+        self.assertEqual((self.pool.max_threads, self.pool.max_queue), (3, 1))
+        self.pool.resize(max_queue=5)
+        self.assertEqual((self.pool.max_threads, self.pool.max_queue), (3, 5))
+
+
+
+class ThreadedRouteTests(_AppTestMixin, TestCase):
+    """
+    Tests for routes added with C{threaded}.
+    """
+
+    def tearDown(self):
+        for pool in self.app._thread_pools.values():
+            pool.stop()
+
+
+    @inlineCallbacks
+    def test_threaded(self):
+        """
+        The handlers of routes added with C{threaded=True} are called in the
+        default pool, and their result is written.
+        """
+        @self.app.route("/", threaded=True)
+        def root(request):
+            return threading.current_thread().name.encode("ascii")
+
+        request = requestMock(b"/")
+        yield _render(self.kr, request)
+        self.assertIn(b"default", request.getWrittenData())
+
+
+    @inlineCallbacks
+    def test_named(self):
+        """
+        The handlers of routes added with the name of a pool are called in
+        that pool, and their failures are handled by the error handlers.
+        """
+        pool = self.app.thread_pool(u"blocking", max_threads=2)
+
+        @self.app.route("/", threaded=u"blocking")
+        def root(request):
+            raise KeyError(threading.current_thread().name)
+
+        @self.app.handle_errors(KeyError)
+        def keyError(request, failure):
+            return failure.value.args[0].encode("ascii")
+
+        request = requestMock(b"/")
+        yield _render(self.kr, request)
+        self.assertIn(b"blocking", request.getWrittenData())
+        self.assertIdentical(self.app.thread_pool(u"blocking"), pool)
+        self.assertEqual(pool.max_threads, 2)
+
+
+    def test_full(self):
+        """
+        Requests for threaded routes whose pool is full are answered with
+        503 and C{Retry-After}.
+        """
+        self.app.thread_pool(u"full", max_queue=0)
+
+        @self.app.route("/", threaded=u"full")
+        def root(request):
+            return b"ok"
+
+        request = self.get()
+        self.assertEqual(request.code, 503)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b"retry-after"), [b"1"])
+
+
+    @inlineCallbacks
+    def test_boundInstance(self):
+        """
+        Threaded handlers of apps bound to instances are called with the
+        instance.
+        """
+        class Application(object):
+            app = Klein()
+
+            @app.route("/", threaded=True)
+            def root(self, request):
+                return self.name
+
+        instance = Application()
+        instance.name = b"bound"
+        self.addCleanup(Application.app.thread_pool().stop)
+
+        request = requestMock(b"/")
+        yield _render(instance.app.resource(), request)
+        self.assertEqual(request.getWrittenData(), b"bound")
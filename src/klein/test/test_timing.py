@@ -0,0 +1,237 @@
+"""
+Tests for L{klein._timing}.
+"""
+
+from __future__ import absolute_import, division
+
+from functools import partial
+from itertools import count
+
+from twisted.internet.defer import Deferred
+from twisted.python import log
+
+from klein import HistogramTimingSink, Klein, LogTimingSink
+from klein import _timing
+from klein._timing import Histogram
+from klein.test.test_resource import requestMock, _render
+from klein.test.util import TestCase
+
+
+
+class _RecordingSink(object):
+    """
+    A sink remembering the timings it records.
+    """
+
+    def __init__(self):
+        self.recorded = []
+
+
+    def record(self, endpoint, timings):
+        self.recorded.append((endpoint, timings))
+
+
+
+class RequestTimingTests(TestCase):
+    """
+    Tests for timing the phases of handling requests.
+    """
+
+    def setUp(self):
+        # Every reading of the clock is a second later.
+        self.patch(_timing, "_clock", partial(next, count()))
+        self.app = Klein()
+        self.kr = self.app.resource()
+        self.sink = _RecordingSink()
+        self.app.add_timing_sink(self.sink)
+
+
+    def assertPhases(self, endpoint, phases):
+        """
+        One request was timed, routed to C{endpoint}, with the given phases.
+        """
+        self.assertEqual(len(self.sink.recorded), 1)
+        recordedEndpoint, timings = self.sink.recorded[0]
+        self.assertEqual(recordedEndpoint, endpoint)
+        self.assertEqual([phase for phase, duration in timings], phases)
+        return dict(timings)
+
+
+    def test_phases(self):
+        """
+        The phases of answering a request are timed one after the other, and
+        recorded with the endpoint once it is answered.
+        """
+        @self.app.route("/")
+        def root(request):
+            return b"ok"
+
+        self.successResultOf(_render(self.kr, requestMock(b"/")))
+        timings = self.assertPhases(
+            "root",
+            ["extract", "bind", "match", "handler", "process", "write"])
+        self.assertEqual(timings["extract"], 1)
+
+
+    def test_deferred(self):
+        """
+        The handler phase lasts until the L{Deferred} returned by the handler
+        fires, and the timings are recorded once the request is answered.
+        """
+        later = Deferred()
+
+        @self.app.route("/")
+        def root(request):
+            return later
+
+        request = requestMock(b"/")
+        d = _render(self.kr, request)
+        self.assertEqual(self.sink.recorded, [])
+        _timing._clock()
+        _timing._clock()
+        later.callback(b"ok")
+        self.successResultOf(d)
+
+        timings = self.assertPhases(
+            "root",
+            ["extract", "bind", "match", "handler", "process", "write"])
+        self.assertEqual(timings["handler"], 3)
+
+
+    def test_error(self):
+        """
+        Running the error handlers is timed as the error phase.
+        """
+        @self.app.route("/")
+        def root(request):
+            raise KeyError()
+
+        @self.app.handle_errors(KeyError)
+        def keyError(request, failure):
+            return b"handled"
+
+        self.successResultOf(_render(self.kr, requestMock(b"/")))
+        self.assertPhases(
+            "root", ["extract", "bind", "match", "handler", "error", "write"])
+
+
+    def test_notFound(self):
+        """
+        Requests which aren't routed to any endpoint are recorded with
+        C{None}.
+        """
+        self.successResultOf(_render(self.kr, requestMock(b"/nope")))
+        self.assertPhases(None, ["extract", "bind", "match", "error",
+                                 "write"])
+
+
+    def test_noSinks(self):
+        """
+        Requests aren't timed when there are no sinks.
+        """
+        self.app.remove_timing_sink(self.sink)
+        self.patch(_timing, "_clock", None)
+
+        @self.app.route("/")
+        def root(request):
+            return b"ok"
+
+        request = requestMock(b"/")
+        self.successResultOf(_render(self.kr, request))
+        self.assertEqual(request.getWrittenData(), b"ok")
+
+
+    def test_failingSink(self):
+        """
+        Sinks failing to record timings are logged, and don't affect the
+        response.
+        """
+        class FailingSink(object):
+            def record(self, endpoint, timings):
+                raise ZeroDivisionError()
+
+        self.app.add_timing_sink(FailingSink())
+
+        @self.app.route("/")
+        def root(request):
+            return b"ok"
+
+        request = requestMock(b"/")
+        self.successResultOf(_render(self.kr, request))
+        self.assertEqual(request.getWrittenData(), b"ok")
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+        self.assertEqual(len(self.sink.recorded), 1)
+
+
+    def test_boundInstances(self):
+        """
+        Apps bound to instances share the sinks of their app.
+        """
+        class Application(object):
+            app = self.app
+
+            @app.route("/")
+            def root(self, request):
+                return b"ok"
+
+        resource = Application().app.resource()
+        self.successResultOf(_render(resource, requestMock(b"/")))
+        self.assertEqual(len(self.sink.recorded), 1)
+
+
+
+class HistogramTests(TestCase):
+    """
+    Tests for L{Histogram}.
+    """
+
+    def test_observe(self):
+        """
+        Values are counted in the first bucket whose upper bound they don't
+        exceed, or the last one.
+        """
+        histogram = Histogram([1, 2])
+        for value in [0.5, 1, 1.5, 3]:
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.cumulative(), [2, 3, 4])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.total, 6)
+
+
+
+class SinkTests(TestCase):
+    """
+    Tests for L{HistogramTimingSink} and L{LogTimingSink}.
+    """
+
+    def test_histograms(self):
+        """
+        L{HistogramTimingSink} keeps a histogram of every phase of every
+        endpoint.
+        """
+        sink = HistogramTimingSink([0.5])
+        sink.record("a", [("match", 0.25), ("handler", 1.0)])
+        sink.record("a", [("match", 0.75)])
+        sink.record(None, [("match", 0.25)])
+
+        self.assertEqual(set(sink.histograms),
+                         set([("a", "handler"), ("a", "match"),
+                              (None, "match")]))
+        self.assertEqual(sink.histograms["a", "match"].counts, [1, 1])
+        self.assertEqual(sink.histograms["a", "handler"].counts, [0, 1])
+
+
+    def test_log(self):
+        """
+        L{LogTimingSink} logs the timings of a request in milliseconds.
+        """
+        messages = []
+        log.addObserver(messages.append)
+        self.addCleanup(log.removeObserver, messages.append)
+
+        LogTimingSink().record("root", [("match", 0.0015),
+                                        ("handler", 0.25)])
+        self.assertEqual(
+            [" ".join(event["message"]) for event in messages],
+            ["Timings of root: match=1.500ms handler=250.000ms"])
@@ -0,0 +1,220 @@
+"""
+Tests for L{klein._urlbuilder}.
+"""
+
+from __future__ import absolute_import, division
+
+from werkzeug.datastructures import MultiDict
+from werkzeug.routing import BuildError, Map, Rule
+
+from klein import Klein
+from klein.interfaces import IKleinRequest
+from klein._urlbuilder import URLBuilder
+from klein.test.test_resource import requestMock, _render
+from klein.test.util import TestCase
+
+
+
+class URLBuilderTests(TestCase):
+    """
+    Tests for L{URLBuilder}.
+    """
+
+    def setUp(self):
+        self.url_map = Map([
+            Rule("/", endpoint="root"),
+            Rule("/users/<int:uid>", endpoint="user"),
+            Rule("/users/<int:uid>", endpoint="editUser", methods=["POST"]),
+            Rule("/users/new", endpoint="editUser", methods=["GET"]),
+            Rule("/posts/<slug>", endpoint="post"),
+            Rule("/posts/<int:year>/<slug>", endpoint="post"),
+            Rule("/pages/", defaults={"page": 1}, endpoint="paged"),
+            Rule("/pages/<int:page>", endpoint="paged"),
+            Rule("/files/<path:rest>", endpoint="files"),
+        ])
+        self.builder = URLBuilder()
+
+
+    def mappers(self):
+        """
+        Adapters bound in several different ways.
+        """
+        yield self.url_map.bind(u"localhost:8080", u"/")
+        yield self.url_map.bind(u"localhost:8080", u"/app/",
+                                url_scheme=u"https")
+        yield self.url_map.bind(u"localhost:8080", u"/",
+                                default_method=u"POST")
+
+
+    def assertSameAsWerkzeug(self, endpoint, values=None, **kwargs):
+        """
+        Building a URL with the builder has the same outcome as building it
+        with werkzeug, for every adapter of L{mappers}.
+        """
+        for mapper in self.mappers():
+            try:
+                expected = mapper.build(endpoint, values, **kwargs)
+            except (BuildError, ValueError) as e:
+                self.assertRaises(e.__class__, self.builder.build, mapper,
+                                  endpoint, values, **kwargs)
+            else:
+                # Twice, to also build with the remembered rule.
+                for i in range(2):
+                    self.assertEqual(
+                        self.builder.build(mapper, endpoint, values,
+                                           **kwargs),
+                        expected)
+
+
+    def test_sameAsWerkzeug(self):
+        """
+        L{URLBuilder.build} builds the same URLs as
+        C{werkzeug.routing.MapAdapter.build}.
+        """
+        self.assertSameAsWerkzeug("root")
+        self.assertSameAsWerkzeug("root", {"q": u"x y"})
+        self.assertSameAsWerkzeug("root", {"q": u"x"}, append_unknown=False)
+        self.assertSameAsWerkzeug("root", force_external=True)
+        self.assertSameAsWerkzeug("user", {"uid": 3})
+        self.assertSameAsWerkzeug("user", {"uid": 3, "extra": None})
+        self.assertSameAsWerkzeug("user", {"uid": u"x"})
+        self.assertSameAsWerkzeug("user", {})
+        self.assertSameAsWerkzeug("editUser", {"uid": 3})
+        self.assertSameAsWerkzeug("editUser", {"uid": 3}, method="POST")
+        self.assertSameAsWerkzeug("editUser", {}, method="GET")
+        self.assertSameAsWerkzeug("editUser", {}, method="PUT")
+        self.assertSameAsWerkzeug("post", {"slug": u"hi"})
+        self.assertSameAsWerkzeug("post", {"slug": u"hi", "year": 2016})
+        self.assertSameAsWerkzeug("paged")
+        self.assertSameAsWerkzeug("paged", {"page": 1})
+        self.assertSameAsWerkzeug("paged", {"page": 2})
+        self.assertSameAsWerkzeug("files", {"rest": u"a/b c"},
+                                  force_external=True)
+        self.assertSameAsWerkzeug("files", {"rest": u"a/../b"})
+        self.assertSameAsWerkzeug("nope")
+
+
+    def test_multiDict(self):
+        """
+        Values given as a C{MultiDict} are built with werkzeug.
+        """
+        self.assertSameAsWerkzeug(
+            "root", MultiDict([("q", u"a"), ("q", u"b"), ("r", None)]))
+
+
+    def test_rememberedRule(self):
+        """
+        The rule building an endpoint's URLs is only looked for once per
+        method and set of argument names.
+        """
+        mapper = self.url_map.bind(u"localhost", u"/")
+        self.builder.build(mapper, "user", {"uid": 1})
+        self.builder.build(mapper, "user", {"uid": 2})
+        self.assertEqual(len(self.builder._rules), 1)
+        self.builder.build(mapper, "user", {"uid": 2, "q": u"x"})
+        self.assertEqual(len(self.builder._rules), 2)
+
+
+    def test_bounded(self):
+        """
+        No more than C{maxsize} rules are remembered.
+        """
+        builder = URLBuilder(maxsize=2)
+        mapper = self.url_map.bind(u"localhost", u"/")
+        for name in ["a", "b", "c"]:
+            builder.build(mapper, "root", {name: u"x"})
+        self.assertTrue(len(builder._rules) <= 2)
+
+
+    def test_invalidate(self):
+        """
+        L{URLBuilder.invalidate} makes the builder pick up new rules.
+        """
+        url_map = Map([Rule("/a", endpoint="a")])
+        mapper = url_map.bind(u"localhost", u"/")
+        builder = URLBuilder()
+        self.assertRaises(BuildError, builder.build, mapper, "b")
+
+        url_map.add(Rule("/b", endpoint="b"))
+        builder.invalidate()
+        self.assertEqual(builder.build(mapper, "b"), "/b")
+
+
+    def test_buildMany(self):
+        """
+        L{URLBuilder.build_many} builds a URL for each of the given values, in
+        order.
+        """
+        mapper = self.url_map.bind(u"localhost", u"/")
+        self.assertEqual(
+            self.builder.build_many(mapper, "user",
+                                    [{"uid": i} for i in range(3)]),
+            ["/users/0", "/users/1", "/users/2"])
+
+
+
+class KleinURLBuilderTests(TestCase):
+    """
+    Tests for building URLs through L{IKleinRequest}.
+    """
+
+    def test_urlForMany(self):
+        """
+        L{IKleinRequest.url_for_many} builds a URL for each of the given
+        values.
+        """
+        app = Klein()
+        resource = app.resource()
+        urls = []
+
+        @app.route("/items/<int:item>")
+        def item(request, item):
+            urls.append(IKleinRequest(request).url_for_many(
+                "item", [{"item": i} for i in range(3)]))
+            return b""
+
+        self.successResultOf(_render(resource, requestMock(b"/items/1")))
+        self.assertEqual(urls, [["/items/0", "/items/1", "/items/2"]])
+
+
+    def test_hosts(self):
+        """
+        URLs are built with the rules of the request's own host, even when
+        other hosts have endpoints of the same name.
+        """
+        app = Klein()
+        resource = app.resource()
+        urls = []
+
+        def urlFor(request):
+            try:
+                urls.append(IKleinRequest(request).url_for("page"))
+            except BuildError:
+                urls.append(None)
+            return b""
+
+        app.route("/", endpoint="page")(urlFor)
+        with app.host("a.example.com"):
+            app.route("/a/", endpoint="page")(urlFor)
+        with app.host("b.example.com"):
+            app.route("/b/", endpoint="other")(urlFor)
+
+        for (path, host) in [(b"/", b"localhost"),
+                             (b"/a/", b"a.example.com"),
+                             (b"/b/", b"b.example.com"),
+                             (b"/a/", b"a.example.com"),
+                             (b"/", b"localhost")]:
+            self.successResultOf(
+                _render(resource, requestMock(path, host=host)))
+        self.assertEqual(urls, ["/", "/a/", None, "/a/", "/"])
+
+
+    def test_routesChanged(self):
+        """
+        Adding a route makes L{Klein}'s builder forget the rules it
+        remembered.
+        """
+        app = Klein()
+        app._url_builder._rules["key"] = None
+        app.route("/")(lambda request: None)
+        self.assertEqual(app._url_builder._rules, {})